@@ -0,0 +1 @@
+"""ArtGuard performance benchmarks"""
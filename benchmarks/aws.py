@@ -0,0 +1,238 @@
+"""
+moto-backed stand-ins for the AWS resources the pipeline and API use.
+
+moto answers in-process, so add_latency() can delay every request by a fixed
+round trip to make concurrency effects visible in the benchmarks.
+"""
+from __future__ import annotations
+
+import os
+import random
+import threading
+import time
+from collections import Counter
+from io import BytesIO
+from typing import Dict, Iterable, Optional
+
+import boto3
+from boto3.dynamodb.types import TypeSerializer
+from botocore.awsrequest import AWSResponse
+
+# Resource names as the API and driver read them from the environment.
+BENCH_ENV: Dict[str, str] = {
+    "AWS_REGION": "us-east-1",
+    "AWS_DEFAULT_REGION": "us-east-1",
+    "AWS_ACCESS_KEY_ID": "bench",
+    "AWS_SECRET_ACCESS_KEY": "bench",
+    "S3_IMAGES_RAW_BUCKET": "artguard-bench-raw",
+    "S3_IMAGES_PROCESSED_BUCKET": "artguard-bench-processed",
+    "DDB_INFERENCES_TABLE": "artguard-bench-inference-records",
+    "DDB_IMAGES_TABLE": "artguard-bench-image-records",
+    "DDB_PATCHES_TABLE": "artguard-bench-patch-records",
+    "DDB_RUNS_TABLE": "artguard-bench-runs",
+    "DDB_CONTENT_INDEX_TABLE": "artguard-bench-content-index",
+}
+
+_TABLE_KEYS = {
+    "DDB_INFERENCES_TABLE": "inference_id",
+    "DDB_IMAGES_TABLE": "image_id",
+    "DDB_PATCHES_TABLE": "patch_id",
+    "DDB_RUNS_TABLE": "run_id",
+    "DDB_CONTENT_INDEX_TABLE": "content_hash",
+}
+
+
+def use_bench_env() -> None:
+    """Point the API and driver at the benchmark resources."""
+    os.environ.update(BENCH_ENV)
+
+
+def create_resources() -> None:
+    """Create the buckets and tables named in BENCH_ENV. Call inside mock_aws()."""
+    s3 = boto3.client("s3", region_name=BENCH_ENV["AWS_REGION"])
+    for var in ("S3_IMAGES_RAW_BUCKET", "S3_IMAGES_PROCESSED_BUCKET"):
+        s3.create_bucket(Bucket=BENCH_ENV[var])
+
+    ddb = boto3.client("dynamodb", region_name=BENCH_ENV["AWS_REGION"])
+    for var, key in _TABLE_KEYS.items():
+        ddb.create_table(
+            TableName=BENCH_ENV[var],
+            KeySchema=[{"AttributeName": key, "KeyType": "HASH"}],
+            AttributeDefinitions=[{"AttributeName": key, "AttributeType": "S"}],
+            BillingMode="PAY_PER_REQUEST",
+        )
+
+
+def add_latency(target, rtt_ms: float, event: str = "before-send") -> None:
+    """
+    Sleep rtt_ms in the calling thread before each request is sent. target is a
+    client, or a boto3 Session to affect every client it creates afterwards.
+    event narrows the hook, e.g. "before-send.s3.PutObject".
+    """
+    def _sleep(**kwargs):
+        time.sleep(rtt_ms / 1000.0)
+
+    events = target.events if isinstance(target, boto3.Session) else target.meta.events
+    events.register(event, _sleep)
+
+
+_DISCARDED_S3_WRITES = {
+    "PutObject": {"ETag": '"discarded"'},
+    "CreateMultipartUpload": {"UploadId": "discarded"},
+    "UploadPart": {"ETag": '"discarded"'},
+    "CompleteMultipartUpload": {"ETag": '"discarded"'},
+}
+
+
+class _Accepted:
+    status_code = 200
+    headers: Dict[str, str] = {}
+
+
+def discard_s3_writes(target, bucket: str) -> None:
+    """
+    Answer object writes to bucket with success without storing them. moto keeps
+    every object in this process, which would swamp memory measurements of the
+    code under test. target is a client or a boto3 Session, as for add_latency.
+    """
+    events = target.events if isinstance(target, boto3.Session) else target.meta.events
+
+    def _mark(params, context, **kwargs):
+        if params.get("Bucket") == bucket:
+            context["bench_discard"] = True
+
+    def _answer(model, context, **kwargs):
+        if context.get("bench_discard") and model.name in _DISCARDED_S3_WRITES:
+            body = kwargs["params"].get("body")
+            if hasattr(body, "read"):
+                body.read()
+            return _Accepted(), dict(_DISCARDED_S3_WRITES[model.name])
+        return None
+
+    events.register("provide-client-params.s3", _mark)
+    events.register("before-call.s3", _answer)
+
+
+def count_aws_requests(target) -> Counter:
+    """
+    Count the requests sent (retries included) as "service.Operation" keys.
+    target is a client or a boto3 Session, as for add_latency.
+    """
+    counts: Counter = Counter()
+    lock = threading.Lock()
+
+    def _count(event_name, **kwargs):
+        _, service, operation = event_name.split(".")[:3]
+        with lock:
+            counts[f"{service}.{operation}"] += 1
+
+    events = target.events if isinstance(target, boto3.Session) else target.meta.events
+    events.register("before-send", _count)
+    return counts
+
+
+def drop_batch_writes(target, fraction: float, seed: int = 0) -> None:
+    """
+    Make BatchWriteItem behave like a throttled table: a random fraction of the
+    requested writes is not performed and is handed back in UnprocessedItems.
+    target is a client or a boto3 Session, as for add_latency.
+    """
+    rng = random.Random(seed)
+    serializer = TypeSerializer()
+
+    def _drop(params, context, **kwargs):
+        dropped = {}
+        for table, requests in params.get("RequestItems", {}).items():
+            # Like DynamoDB, always make some progress.
+            keep = [r for r in requests if rng.random() >= fraction] or requests[:1]
+            if len(keep) < len(requests):
+                dropped[table] = [r for r in requests if r not in keep]
+                requests[:] = keep
+        context["bench_unprocessed"] = dropped
+
+    def _report(parsed, context, **kwargs):
+        for table, requests in context.get("bench_unprocessed", {}).items():
+            typed = [{"PutRequest": {"Item": {k: serializer.serialize(v) for k, v in r["PutRequest"]["Item"].items()}}}
+                     for r in requests]
+            parsed.setdefault("UnprocessedItems", {}).setdefault(table, []).extend(typed)
+
+    events = target.events if isinstance(target, boto3.Session) else target.meta.events
+    events.register("before-parameter-build.dynamodb.BatchWriteItem", _drop)
+    events.register("after-call.dynamodb.BatchWriteItem", _report)
+
+
+class _RawBody(BytesIO):
+    def stream(self, **kwargs):
+        yield self.read()
+
+
+_THROTTLED = {
+    "dynamodb": (
+        400,
+        {"Content-Type": "application/x-amz-json-1.0"},
+        b'{"__type":"com.amazonaws.dynamodb.v20120810#ProvisionedThroughputExceededException",'
+        b'"message":"The level of configured provisioned throughput for the table was exceeded."}',
+    ),
+    "s3": (
+        503,
+        {"Content-Type": "application/xml"},
+        b"<Error><Code>SlowDown</Code><Message>Please reduce your request rate.</Message></Error>",
+    ),
+}
+
+
+class Throttle:
+    """
+    A service that accepts capacity_per_s requests per second (with a burst of
+    one second's worth) and throttles the rest, as DynamoDB does with
+    ProvisionedThroughputExceededException and S3 with SlowDown. Counts
+    accepted and throttled requests.
+    """
+
+    def __init__(self, capacity_per_s: float):
+        self.capacity_per_s = capacity_per_s
+        self.accepted = 0
+        self.throttled = 0
+        self._tokens = capacity_per_s
+        self._filled_at = time.monotonic()
+        self._lock = threading.Lock()
+
+    def admit(self) -> bool:
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.capacity_per_s, self._tokens + (now - self._filled_at) * self.capacity_per_s)
+            self._filled_at = now
+            if self._tokens >= 1:
+                self._tokens -= 1
+                self.accepted += 1
+                return True
+            self.throttled += 1
+            return False
+
+
+def throttle_requests(
+    target, service: str, capacity_per_s: float, operations: Optional[Iterable[str]] = None,
+) -> Throttle:
+    """
+    Throttle a service's requests (of operations, or all of them) past
+    capacity_per_s, shared by every client of target. target is a client or a
+    boto3 Session, as for add_latency. Returns the Throttle for its counts.
+    """
+    throttle = Throttle(capacity_per_s)
+    status, headers, body = _THROTTLED[service]
+    operations = set(operations) if operations is not None else None
+
+    def _answer(event_name, request, **kwargs):
+        if operations is not None and event_name.split(".")[2] not in operations:
+            return None
+        if throttle.admit():
+            return None
+        # moto answers every request it recognises, even one that already has
+        # a response; it leaves URLs outside AWS alone.
+        request.url = "http://throttled.invalid/"
+        return AWSResponse(request.url, status, dict(headers), _RawBody(body))
+
+    events = target.events if isinstance(target, boto3.Session) else target.meta.events
+    # After any rate limiter hook on the same event, so it sees limited traffic.
+    events.register_last(f"before-send.{service}", _answer)
+    return throttle
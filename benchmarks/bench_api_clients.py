@@ -0,0 +1,151 @@
+"""
+API client reuse benchmark -- per-request boto3 clients vs. the app's registry.
+
+Until clients.py, every /inference, /process_data and /rag-query request built
+its own boto3 clients and DynamoDB resource. This times:
+
+    setup      building the clients /inference needs (S3 client, DynamoDB
+               resource, three tables) against looking them up in AWSClients
+    status     GET /process_data/{run_id} (one GetItem) over ASGI
+    inference  POST /inference (sync persistence) with distinct images
+
+The endpoints run once with a fresh AWSClients for every request, which is
+what creating the clients per request cost, and once with the shared one.
+moto answers in-process with --rtt-ms added per request, so the difference
+is the client setup alone.
+
+Requires moto and the API's dependencies (pip install "moto[s3,dynamodb]").
+
+Usage:
+    python -m benchmarks.bench_api_clients [--requests 30] [--rtt-ms 5]
+"""
+from __future__ import annotations
+
+import argparse
+import asyncio
+import time
+from typing import Callable, List, Tuple
+
+import boto3
+import numpy as np
+from moto import mock_aws
+
+from benchmarks.aws import BENCH_ENV, add_latency, create_resources, use_bench_env
+from benchmarks.bench_inference_latency import asgi_post, multipart_body
+from benchmarks.corpus import make_corpus
+from src.apps.data_pipeline.process import s3_client_config
+
+
+async def asgi_get(app, path: str) -> Tuple[int, float]:
+    """GET path from app. Returns (status, seconds to response)."""
+    scope = {
+        "type": "http",
+        "asgi": {"version": "3.0"},
+        "http_version": "1.1",
+        "method": "GET",
+        "scheme": "http",
+        "path": path,
+        "raw_path": path.encode(),
+        "root_path": "",
+        "query_string": b"",
+        "headers": [],
+        "client": ("bench", 1),
+        "server": ("bench", 80),
+    }
+    state = {"status": 0}
+
+    async def receive():
+        return {"type": "http.request", "body": b"", "more_body": False}
+
+    async def send(message):
+        if message["type"] == "http.response.start":
+            state["status"] = message["status"]
+
+    t0 = time.perf_counter()
+    await app(scope, receive, send)
+    return state["status"], time.perf_counter() - t0
+
+
+def per_request_setup() -> None:
+    """What /inference did on every request before the registry."""
+    region = BENCH_ENV["AWS_REGION"]
+    boto3.client("s3", region_name=region, config=s3_client_config())
+    ddb = boto3.resource("dynamodb", region_name=region)
+    for var in ("DDB_INFERENCES_TABLE", "DDB_IMAGES_TABLE", "DDB_PATCHES_TABLE"):
+        ddb.Table(BENCH_ENV[var])
+
+
+def timed(fn: Callable[[], object], n: int) -> List[float]:
+    times = []
+    for _ in range(n):
+        t0 = time.perf_counter()
+        fn()
+        times.append((time.perf_counter() - t0) * 1000.0)
+    return times
+
+
+def run_endpoint(app_module, fresh: bool, request: Callable[[int], Tuple[int, float]], n: int) -> List[float]:
+    latencies = []
+    # The first request warms up the model path and, when shared, the clients.
+    for i in range(n + 1):
+        if fresh:
+            app_module.app.state.aws = None
+            app_module.get_content_index.cache_clear()
+        status, seconds = request(i)
+        assert status == 200, status
+        if i:
+            latencies.append(seconds * 1000.0)
+    return latencies
+
+
+def main() -> None:
+    ap = argparse.ArgumentParser(description="Benchmark shared vs. per-request AWS clients in the API")
+    ap.add_argument("--requests", type=int, default=30)
+    ap.add_argument("--rtt-ms", type=float, default=5.0)
+    args = ap.parse_args()
+
+    use_bench_env()
+    from src.apps.backend import main as app_module
+    from src.apps.data_pipeline.runs import create_run
+
+    app_module.INFERENCE_PERSIST_MODE = "sync"
+    images = make_corpus(2 * (args.requests + 1), seed=7, sizes=[(1024, 768)], extensions=[".jpg"])
+    bodies = [multipart_body("bench.jpg", image.data, "image/jpeg") for image in images]
+
+    with mock_aws():
+        create_resources()
+        boto3.setup_default_session()
+        add_latency(boto3.DEFAULT_SESSION, args.rtt_ms)
+        app_module.app.state.aws = None
+        create_run(app_module.aws_clients().table(BENCH_ENV["DDB_RUNS_TABLE"]), "bench-run", 1)
+
+        rows = [("setup", timed(per_request_setup, args.requests),
+                 timed(lambda: app_module.aws_clients().table(BENCH_ENV["DDB_PATCHES_TABLE"]), args.requests))]
+
+        def status(i: int) -> Tuple[int, float]:
+            return asyncio.run(asgi_get(app_module.app, "/process_data/bench-run"))
+
+        rows.append(("status", run_endpoint(app_module, True, status, args.requests),
+                     run_endpoint(app_module, False, status, args.requests)))
+
+        offset = {"fresh": 0, "shared": args.requests + 1}
+
+        def inference(mode: str) -> Callable[[int], Tuple[int, float]]:
+            def request(i: int) -> Tuple[int, float]:
+                body, content_type = bodies[offset[mode] + i]
+                code, responded_s, _ = asyncio.run(asgi_post(app_module.app, "/inference", body, content_type))
+                return code, responded_s
+            return request
+
+        rows.append(("inference", run_endpoint(app_module, True, inference("fresh"), args.requests),
+                     run_endpoint(app_module, False, inference("shared"), args.requests)))
+
+    print(f"{args.requests} requests each, rtt {args.rtt_ms:g} ms")
+    print(f"{'':>10} {'per-request p50':>16} {'shared p50':>11} {'saved ms':>9}")
+    for name, fresh, shared in rows:
+        fresh_p50, shared_p50 = np.percentile(fresh, 50), np.percentile(shared, 50)
+        print(f"{name:>10} {fresh_p50:>16.2f} {shared_p50:>11.2f} {fresh_p50 - shared_p50:>9.2f}")
+
+
+if __name__ == "__main__":
+    main()
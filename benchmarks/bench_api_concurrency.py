@@ -0,0 +1,91 @@
+"""
+API concurrency benchmark -- /inference throughput against requests in flight.
+
+Sends --requests distinct images to POST /inference (sync persistence) over
+ASGI, with 1, 2, 4, ... --max-inflight requests in flight on one event loop,
+as a uvicorn worker would have them. moto answers in-process with --rtt-ms
+added to every AWS request, so most of a request is spent waiting on the
+network. While the handlers ran boto3 calls and decodes on the event loop,
+throughput stayed at that of one request in flight; with the work on the
+offload pools (backend/offload.py) it grows with the requests in flight
+until the CPU or the pools are saturated.
+
+Requires moto and the API's dependencies (pip install "moto[s3,dynamodb]").
+
+Usage:
+    python -m benchmarks.bench_api_concurrency [--requests 32] [--max-inflight 16] [--rtt-ms 20]
+"""
+from __future__ import annotations
+
+import argparse
+import asyncio
+import time
+from typing import List, Tuple
+
+import boto3
+import numpy as np
+from moto import mock_aws
+
+from benchmarks.aws import add_latency, create_resources, use_bench_env
+from benchmarks.bench_inference_latency import asgi_post, multipart_body
+from benchmarks.corpus import make_corpus
+
+
+async def post_all(app, bodies: List[Tuple[bytes, str]], inflight: int) -> Tuple[float, List[float]]:
+    """POST every body with at most inflight at once. Returns (seconds, latencies in ms)."""
+    limit = asyncio.Semaphore(inflight)
+    latencies: List[float] = []
+
+    async def post(body: bytes, content_type: str) -> None:
+        async with limit:
+            status, responded_s, _ = await asgi_post(app, "/inference", body, content_type)
+            assert status == 200, status
+            latencies.append(responded_s * 1000.0)
+
+    t0 = time.perf_counter()
+    await asyncio.gather(*(post(body, content_type) for body, content_type in bodies))
+    return time.perf_counter() - t0, latencies
+
+
+def main() -> None:
+    ap = argparse.ArgumentParser(description="Benchmark /inference throughput against requests in flight")
+    ap.add_argument("--requests", type=int, default=32)
+    ap.add_argument("--max-inflight", type=int, default=16)
+    ap.add_argument("--rtt-ms", type=float, default=20.0)
+    ap.add_argument("--size", default="1024x768")
+    args = ap.parse_args()
+
+    use_bench_env()
+    from src.apps.backend import main as app_module
+
+    app_module.INFERENCE_PERSIST_MODE = "sync"
+    levels = [1]
+    while levels[-1] * 2 <= args.max_inflight:
+        levels.append(levels[-1] * 2)
+    w, h = (int(v) for v in args.size.split("x"))
+    # Distinct images for every request, so none is answered from the content index.
+    corpus = make_corpus(args.requests * len(levels) + 1, seed=8, sizes=[(w, h)], extensions=[".jpg"])
+    bodies = [multipart_body("bench.jpg", image.data, "image/jpeg") for image in corpus]
+
+    with mock_aws():
+        create_resources()
+        boto3.setup_default_session()
+        add_latency(boto3.DEFAULT_SESSION, args.rtt_ms)
+        app_module.app.state.aws = None
+        # Warm up the clients and the decode path.
+        asyncio.run(post_all(app_module.app, bodies[:1], 1))
+
+        print(f"{args.requests} requests per level, {args.size} JPEGs, rtt {args.rtt_ms:g} ms")
+        print(f"{'in flight':>10} {'req/s':>8} {'speedup':>8} {'p50 ms':>8} {'p99 ms':>8}")
+        base = None
+        for i, inflight in enumerate(levels):
+            batch = bodies[1 + i * args.requests:1 + (i + 1) * args.requests]
+            seconds, latencies = asyncio.run(post_all(app_module.app, batch, inflight))
+            rate = len(batch) / seconds
+            base = base or rate
+            print(f"{inflight:>10} {rate:>8.2f} {rate / base:>7.2f}x "
+                  f"{np.percentile(latencies, 50):>8.1f} {np.percentile(latencies, 99):>8.1f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,123 @@
+"""
+Archive benchmark -- per-image copy + delete vs. the batched Archiver.
+
+Moves --objects raw images from training/unprocessed/ to training/processed/
+against moto, with every S3 request delayed by --rtt-ms: once one object at a
+time with move_to_processed (CopyObject + DeleteObject each), and once through
+an Archiver driven by --workers threads, as the driver's archive stage does
+(concurrent CopyObject, DeleteObjects of up to 1000 keys). Reports wall time and
+requests by operation and checks that every object arrived intact and no source
+is left.
+
+Then copies one --large-mb object with a multipart copy in 5 MB parts and
+checks the copy is byte-identical.
+
+Requires moto (pip install "moto[s3]").
+
+Usage:
+    python -m benchmarks.bench_archive [--objects 200] [--workers 8] [--rtt-ms 20]
+"""
+from __future__ import annotations
+
+import argparse
+import hashlib
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict
+
+import boto3
+from moto import mock_aws
+
+from benchmarks.aws import BENCH_ENV, add_latency, count_aws_requests, create_resources, use_bench_env
+from src.apps.data_pipeline.archive import Archiver, multipart_copy, processed_key
+from src.apps.data_pipeline.driver import move_to_processed
+from src.apps.data_pipeline.process import s3_client_config
+from src.apps.data_pipeline.storage import S3Storage
+
+BUCKET = BENCH_ENV["S3_IMAGES_RAW_BUCKET"]
+
+
+def seed(s3, n: int) -> Dict[str, str]:
+    digests = {}
+    for i in range(n):
+        body = os.urandom(32 * 1024)
+        key = f"training/unprocessed/bench-{i:06d}/image_{i:06d}.jpg"
+        s3.put_object(Bucket=BUCKET, Key=key, Body=body)
+        digests[key] = hashlib.sha256(body).hexdigest()
+    return digests
+
+
+def check_moved(s3, digests: Dict[str, str]) -> None:
+    left = s3.list_objects_v2(Bucket=BUCKET, Prefix="training/unprocessed/")["KeyCount"]
+    assert left == 0, f"{left} sources left behind"
+    for key, digest in digests.items():
+        body = s3.get_object(Bucket=BUCKET, Key=processed_key(key))["Body"].read()
+        assert hashlib.sha256(body).hexdigest() == digest, f"{key} copied wrong"
+
+
+def run(mode: str, n: int, workers: int, rtt_ms: float):
+    with mock_aws():
+        create_resources()
+        s3 = boto3.client("s3", region_name=BENCH_ENV["AWS_REGION"], config=s3_client_config(max(10, workers)))
+        digests = seed(s3, n)
+        add_latency(s3, rtt_ms)
+        counts = count_aws_requests(s3)
+
+        t0 = time.perf_counter()
+        if mode == "per-image":
+            for key in digests:
+                move_to_processed(s3, BUCKET, key, size=32 * 1024)
+        else:
+            archiver = Archiver(S3Storage(s3), BUCKET)
+            with ThreadPoolExecutor(max_workers=workers) as pool:
+                list(pool.map(lambda k: archiver.archive(k, size=32 * 1024), digests))
+            archiver.close()
+        seconds = time.perf_counter() - t0
+        ops = {k.split(".")[1]: v for k, v in counts.items()}
+        check_moved(s3, digests)
+        return seconds, ops
+
+
+def run_large(size_mb: int) -> Dict[str, int]:
+    with mock_aws():
+        create_resources()
+        s3 = boto3.client("s3", region_name=BENCH_ENV["AWS_REGION"])
+        body = os.urandom(size_mb * 1024 * 1024)
+        key = "training/unprocessed/bench-large/large.tif"
+        s3.put_object(Bucket=BUCKET, Key=key, Body=body, ContentType="image/tiff")
+        counts = count_aws_requests(s3)
+        multipart_copy(s3, BUCKET, key, processed_key(key), part_mb=5)
+        ops = {k.split(".")[1]: v for k, v in counts.items()}
+        copied = s3.get_object(Bucket=BUCKET, Key=processed_key(key))
+        assert copied["Body"].read() == body, "multipart copy differs"
+        assert copied["ContentType"] == "image/tiff", "content type not kept"
+        return ops
+
+
+def main() -> None:
+    ap = argparse.ArgumentParser(description="Benchmark batched archiving")
+    ap.add_argument("--objects", type=int, default=200)
+    ap.add_argument("--workers", type=int, default=8)
+    ap.add_argument("--rtt-ms", type=float, default=20.0)
+    ap.add_argument("--large-mb", type=int, default=12)
+    args = ap.parse_args()
+
+    use_bench_env()
+    results = {mode: run(mode, args.objects, args.workers, args.rtt_ms) for mode in ("per-image", "archiver")}
+
+    base = results["per-image"][0]
+    print(f"{args.objects} objects, rtt {args.rtt_ms:.0f} ms, archiver with {args.workers} workers")
+    print(f"{'path':>10} {'seconds':>8} {'objects/s':>10} {'speedup':>8}  requests")
+    for mode, (seconds, ops) in results.items():
+        reqs = ", ".join(f"{k} {v}" for k, v in sorted(ops.items()))
+        print(f"{mode:>10} {seconds:>8.2f} {args.objects / seconds:>10.1f} {base / seconds:>7.2f}x  {reqs}")
+    print("all objects moved intact")
+
+    ops = run_large(args.large_mb)
+    print(f"\n{args.large_mb} MB object, multipart copy in 5 MB parts: "
+          + ", ".join(f"{k} {v}" for k, v in sorted(ops.items())) + " -- identical")
+
+
+if __name__ == "__main__":
+    main()
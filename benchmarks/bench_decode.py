@@ -0,0 +1,111 @@
+"""
+Decode benchmark -- full-resolution vs. reduced-resolution decode.
+
+For each size and format, decodes and extracts patches in a fresh process so
+peak RSS (VmHWM, Linux only) reflects that image alone, and checks that the reduced
+path stays within the tolerance documented next to REDUCED_DECODE in
+process.py (mean abs diff < 1, 99th percentile <= 3 levels).
+
+Usage:
+    python -m benchmarks.bench_decode [--repeat 3]
+"""
+from __future__ import annotations
+
+import argparse
+import multiprocessing as mp
+import time
+from io import BytesIO
+from typing import Dict
+
+import numpy as np
+from PIL import Image
+
+from src.apps.data_pipeline.process import decode_image, extract_patches, plan_decode_reduction
+
+SIZES = [(3000, 2000), (6000, 4000), (8000, 5000)]
+FORMATS = ["JPEG", "PNG", "TIFF"]
+
+MEAN_TOLERANCE = 1.0
+P99_TOLERANCE = 3
+
+
+def photo_like(w: int, h: int, seed: int = 0) -> Image.Image:
+    """Upsampled noise plus grain: smooth regions with fine texture, like a scan."""
+    rng = np.random.default_rng(seed)
+    small = Image.fromarray(rng.integers(0, 256, size=(h // 16 + 1, w // 16 + 1, 3), dtype=np.uint8))
+    base = np.asarray(small.resize((w, h), resample=Image.BICUBIC)).astype(np.int16)
+    grain = rng.integers(-10, 10, size=(h, w, 3), dtype=np.int16)
+    return Image.fromarray(np.clip(base + grain, 0, 255).astype(np.uint8))
+
+
+def encode(img: Image.Image, fmt: str) -> bytes:
+    buf = BytesIO()
+    if fmt == "JPEG":
+        img.save(buf, format=fmt, quality=92)
+    elif fmt == "PNG":
+        img.save(buf, format=fmt, compress_level=1)
+    else:
+        img.save(buf, format=fmt)
+    return buf.getvalue()
+
+
+def peak_rss_kb() -> int:
+    """
+    High-water RSS of this process. ru_maxrss is inherited across fork/exec on
+    Linux, so it would report the parent's peak in a fresh child.
+    """
+    with open("/proc/self/status") as f:
+        for line in f:
+            if line.startswith("VmHWM:"):
+                return int(line.split()[1])
+    return 0
+
+
+def _measure(data: bytes, reduced: bool, repeat: int, out: "mp.Queue") -> None:
+    base_kb = peak_rss_kb()
+    best = float("inf")
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        img, size = decode_image(data, reduced=reduced)
+        batch, _ = extract_patches(img, source_size=size)
+        best = min(best, time.perf_counter() - t0)
+        del img
+    peak_kb = peak_rss_kb()
+    out.put({"seconds": best, "peak_mb": (peak_kb - base_kb) / 1024.0, "batch": batch})
+
+
+def measure(data: bytes, reduced: bool, repeat: int) -> Dict:
+    ctx = mp.get_context("spawn")
+    q = ctx.Queue()
+    proc = ctx.Process(target=_measure, args=(data, reduced, repeat, q))
+    proc.start()
+    result = q.get()
+    proc.join()
+    return result
+
+
+def main() -> None:
+    ap = argparse.ArgumentParser(description="Benchmark reduced-resolution decode")
+    ap.add_argument("--repeat", type=int, default=3)
+    args = ap.parse_args()
+
+    print(f"{'image':>16} {'factor':>6} {'full ms':>8} {'reduced ms':>10} {'full MB':>8} "
+          f"{'reduced MB':>10} {'mean diff':>9} {'p99 diff':>8}")
+    for w, h in SIZES:
+        img = photo_like(w, h)
+        for fmt in FORMATS:
+            data = encode(img, fmt)
+            full = measure(data, reduced=False, repeat=args.repeat)
+            reduced = measure(data, reduced=True, repeat=args.repeat)
+
+            diff = np.abs(full["batch"].astype(np.int16) - reduced["batch"].astype(np.int16))
+            mean_diff, p99_diff = diff.mean(), np.percentile(diff, 99)
+            assert mean_diff < MEAN_TOLERANCE and p99_diff <= P99_TOLERANCE, (fmt, w, h, mean_diff, p99_diff)
+
+            print(f"{fmt:>5} {w:>5}x{h:<5} {plan_decode_reduction(w, h):>6} "
+                  f"{full['seconds'] * 1e3:>8.1f} {reduced['seconds'] * 1e3:>10.1f} "
+                  f"{full['peak_mb']:>8.1f} {reduced['peak_mb']:>10.1f} {mean_diff:>9.2f} {p99_diff:>8.0f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,83 @@
+"""
+Decode-stage scaling benchmark -- in-process threads vs. DecodePool processes.
+
+Decodes, patches and encodes an in-memory synthetic corpus (no S3 involved:
+the driver keeps I/O in the parent process) with 1, 2, 4 and 8 decode threads
+in this process, and with DecodePool at the same worker counts. Reports
+images/s and the speedup over one in-process thread, and checks that the pool
+produces byte-identical encoded patches. Scaling is capped by the cores
+available (os.sched_getaffinity).
+
+Usage:
+    python -m benchmarks.bench_decode_pool [--images 32] [--workers 1 2 4 8]
+"""
+from __future__ import annotations
+
+import argparse
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import List
+
+from benchmarks.bench_decode import encode, photo_like
+from src.apps.data_pipeline.procpool import DecodePool
+from src.apps.data_pipeline.process import decode_image, encode_patches, extract_patches
+
+SIZES = [(1600, 1200), (2400, 1800), (3000, 2000), (1200, 1600)]
+
+
+def corpus(n: int) -> List[bytes]:
+    return [encode(photo_like(*SIZES[i % len(SIZES)], seed=i), "JPEG") for i in range(n)]
+
+
+def decode_in_process(data: bytes, patch_format: str) -> List[bytes]:
+    img, (w, h) = decode_image(data)
+    batch, _ = extract_patches(img, source_size=(w, h))
+    return encode_patches(batch, patch_format)
+
+
+def run_threads(images: List[bytes], workers: int, patch_format: str) -> float:
+    t0 = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        list(pool.map(lambda d: decode_in_process(d, patch_format), images))
+    return time.perf_counter() - t0
+
+
+def run_pool(images: List[bytes], workers: int, patch_format: str):
+    pool = DecodePool(workers)
+    try:
+        pool.warm_up()
+        t0 = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=workers) as threads:
+            results = list(threads.map(lambda d: pool.decode(d, patch_format), images))
+        return time.perf_counter() - t0, results
+    finally:
+        pool.close()
+
+
+def main() -> None:
+    ap = argparse.ArgumentParser(description="Benchmark process-pool decode scaling")
+    ap.add_argument("--images", type=int, default=32)
+    ap.add_argument("--workers", type=int, nargs="+", default=[1, 2, 4, 8])
+    ap.add_argument("--patch-format", default="jpeg")
+    args = ap.parse_args()
+
+    images = corpus(args.images)
+    expected = [decode_in_process(d, args.patch_format) for d in images[:4]]
+    cores = len(os.sched_getaffinity(0))
+    print(f"{args.images} images ({sum(map(len, images)) / 2**20:.1f} MB JPEG), {cores} cores available")
+
+    base = run_threads(images, 1, args.patch_format)
+    print(f"{'workers':>8} {'threads img/s':>14} {'x':>6} {'processes img/s':>16} {'x':>6}")
+    for workers in args.workers:
+        t_threads = base if workers == 1 else run_threads(images, workers, args.patch_format)
+        t_pool, results = run_pool(images, workers, args.patch_format)
+        for got, want in zip(results, expected):
+            assert got.encoded == want, "pool output differs from in-process output"
+        print(f"{workers:>8} {args.images / t_threads:>14.2f} {base / t_threads:>5.2f}x "
+              f"{args.images / t_pool:>16.2f} {base / t_pool:>5.2f}x")
+    print("pool output matches in-process output")
+
+
+if __name__ == "__main__":
+    main()
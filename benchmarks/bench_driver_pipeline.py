@@ -0,0 +1,142 @@
+"""
+Driver throughput benchmark -- sequential loop vs. staged pipeline.
+
+Runs the driver end to end against moto on a synthetic corpus, with every AWS
+call delayed by --rtt-ms, once with --sequential and once per pipeline
+configuration. Reports images/s and checks that every run leaves the same
+records behind: one PatchRecord per patch, one ImageRecord per image and
+nothing left under training/unprocessed/.
+
+Each run's metrics (--metrics_json, see metrics.py) are collected: --json
+saves them, --compare prints this run's images/s and stage latencies next to
+a file saved earlier, e.g. on the previous commit.
+
+Requires moto (pip install "moto[s3,dynamodb]").
+
+Usage:
+    python -m benchmarks.bench_driver_pipeline [--images 40] [--rtt-ms 20]
+    python -m benchmarks.bench_driver_pipeline --json new.json --compare old.json
+"""
+from __future__ import annotations
+
+import argparse
+import contextlib
+import io
+import json
+import os
+import tempfile
+
+import boto3
+from moto import mock_aws
+
+from benchmarks.aws import BENCH_ENV, add_latency, create_resources, use_bench_env
+from benchmarks.bench_shards import run_driver
+from benchmarks.corpus import seed_unprocessed
+
+CONFIGS = [
+    ("sequential", ["--sequential"]),
+    ("pipeline", []),
+    ("pipeline x2", ["--stage_workers", "download=16,upload=8,metadata=8,archive=8"]),
+]
+
+
+def run_once(name: str, extra, images: int, rtt_ms: float, size) -> dict:
+    with mock_aws():
+        create_resources()
+        seed_unprocessed(images, size=size)
+        boto3.setup_default_session()
+        add_latency(boto3.DEFAULT_SESSION, rtt_ms)
+
+        fd, metrics_path = tempfile.mkstemp(suffix=".json")
+        os.close(fd)
+        log = io.StringIO()
+        try:
+            with contextlib.redirect_stdout(log):
+                seconds = run_driver(f"bench-{name.replace(' ', '-')}", [*extra, "--metrics_json", metrics_path])
+            with open(metrics_path) as f:
+                metrics = json.load(f)
+        finally:
+            os.remove(metrics_path)
+
+        ddb = boto3.resource("dynamodb", region_name=BENCH_ENV["AWS_REGION"])
+        s3 = boto3.client("s3", region_name=BENCH_ENV["AWS_REGION"])
+        left = s3.list_objects_v2(Bucket=BENCH_ENV["S3_IMAGES_RAW_BUCKET"], Prefix="training/unprocessed/")
+        stage_table = log.getvalue().split("Pipeline:", 1)
+        return {
+            "seconds": seconds,
+            "images": ddb.Table(BENCH_ENV["DDB_IMAGES_TABLE"]).scan(Select="COUNT")["Count"],
+            "patches": ddb.Table(BENCH_ENV["DDB_PATCHES_TABLE"]).scan(Select="COUNT")["Count"],
+            "left": left.get("KeyCount", 0),
+            "stages": "Pipeline:" + stage_table[1].split("\n\n", 1)[0] if len(stage_table) > 1 else "",
+            "metrics": metrics["metrics"],
+        }
+
+
+def print_latencies(name: str, metrics: dict, baseline: dict = None) -> None:
+    """p50/p99 per histogram, with the baseline's p99 alongside if given."""
+    print(f"\n[{name}] latency")
+    print(f"{'histogram':>18} {'count':>6} {'p50 ms':>8} {'p99 ms':>8} {'max ms':>8}"
+          + (f" {'base p99':>9}" if baseline else ""))
+    for hist_name, h in metrics["latency"].items():
+        line = (f"{hist_name:>18} {h['count']:>6} {h['p50_s'] * 1000:>8.0f} "
+                f"{h['p99_s'] * 1000:>8.0f} {h['max_s'] * 1000:>8.0f}")
+        if baseline:
+            base = baseline["latency"].get(hist_name)
+            line += f" {base['p99_s'] * 1000:>9.0f}" if base else f" {'-':>9}"
+        print(line)
+
+
+def main() -> None:
+    ap = argparse.ArgumentParser(description="Benchmark the staged driver pipeline")
+    ap.add_argument("--images", type=int, default=40)
+    ap.add_argument("--rtt-ms", type=float, default=20.0)
+    ap.add_argument("--size", default="1600x1200")
+    ap.add_argument("--json", help="Save every config's images/s and metrics to this file")
+    ap.add_argument("--compare", help="Show a file saved with --json next to these results")
+    args = ap.parse_args()
+    size = tuple(int(v) for v in args.size.split("x"))
+
+    use_bench_env()
+    results = {name: run_once(name, extra, args.images, args.rtt_ms, size) for name, extra in CONFIGS}
+
+    base = results["sequential"]["seconds"]
+    print(f"\n{args.images} images of {args.size}, rtt {args.rtt_ms:.0f} ms")
+    print(f"{'config':>12} {'seconds':>8} {'images/s':>9} {'speedup':>8} {'patches':>8}")
+    for name, r in results.items():
+        print(f"{name:>12} {r['seconds']:>8.2f} {args.images / r['seconds']:>9.2f} "
+              f"{base / r['seconds']:>7.2f}x {r['patches']:>8}")
+    for name, r in results.items():
+        if r["stages"]:
+            print(f"\n[{name}] {r['stages']}")
+
+    saved = {
+        name: {"images_per_s": args.images / r["seconds"], "metrics": r["metrics"]}
+        for name, r in results.items()
+    }
+    baseline = {}
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        print(f"\nvs {args.compare}")
+        print(f"{'config':>12} {'images/s':>9} {'base':>9} {'change':>8}")
+        for name, r in saved.items():
+            if name in baseline:
+                base = baseline[name]["images_per_s"]
+                print(f"{name:>12} {r['images_per_s']:>9.2f} {base:>9.2f} "
+                      f"{r['images_per_s'] / base - 1:>+8.0%}")
+    for name, r in saved.items():
+        print_latencies(name, r["metrics"], (baseline.get(name) or {}).get("metrics"))
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(saved, f, indent=2, sort_keys=True)
+        print(f"\nsaved results to {args.json}")
+
+    expected = results["sequential"]
+    for name, r in results.items():
+        assert r["left"] == 0, f"{name}: {r['left']} images left unprocessed"
+        assert (r["images"], r["patches"]) == (expected["images"], expected["patches"]), name
+    print(f"\nall configs wrote {expected['images']} images / {expected['patches']} patch records")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,172 @@
+"""
+Batch inference benchmark -- N calls to /inference vs. one /inference/batch.
+
+Scores --images distinct JPEGs once as separate /inference requests (with
+--inflight of them at a time) and once as a single /inference/batch request,
+both with sync persistence against moto with --rtt-ms added to every AWS
+request. Reports wall time and the AWS requests each way took: the batch
+writes its ImageRecords, InferenceRecords and PatchRecords with
+batch_write_item instead of a put_item (and an update_item) per image.
+
+The batch also carries one file that is not an image, which must come back
+as its own 400 while every image is scored, and every image's records must
+be in DynamoDB afterwards. A last, small batch has one image whose records
+DynamoDB rejects: only that image may come back as a 500.
+
+Requires moto and the API's dependencies (pip install "moto[s3,dynamodb]").
+
+Usage:
+    python -m benchmarks.bench_inference_batch [--images 16] [--inflight 4] [--rtt-ms 20]
+"""
+from __future__ import annotations
+
+import argparse
+import asyncio
+import json
+import time
+import uuid
+from typing import Callable, Counter, List, Tuple
+
+import boto3
+from moto import mock_aws
+
+from benchmarks.aws import BENCH_ENV, add_latency, count_aws_requests, create_resources, use_bench_env
+from benchmarks.bench_api_concurrency import post_all
+from benchmarks.bench_inference_latency import multipart_body
+from benchmarks.corpus import make_corpus
+
+
+def multipart_files(files: List[Tuple[str, bytes, str]]) -> Tuple[bytes, str]:
+    """A multipart body with every (filename, data, content type) as a "files" field."""
+    boundary = uuid.uuid4().hex
+    parts = []
+    for filename, data, content_type in files:
+        parts.append((
+            f"--{boundary}\r\n"
+            f'Content-Disposition: form-data; name="files"; filename="{filename}"\r\n'
+            f"Content-Type: {content_type}\r\n\r\n"
+        ).encode() + data + b"\r\n")
+    return b"".join(parts) + f"--{boundary}--\r\n".encode(), f"multipart/form-data; boundary={boundary}"
+
+
+async def asgi_post_json(app, path: str, body: bytes, content_type: str) -> Tuple[int, dict]:
+    """POST body to app. Returns (status, decoded JSON response)."""
+    chunks: List[bytes] = []
+    scope = {
+        "type": "http",
+        "asgi": {"version": "3.0"},
+        "http_version": "1.1",
+        "method": "POST",
+        "scheme": "http",
+        "path": path,
+        "raw_path": path.encode(),
+        "root_path": "",
+        "query_string": b"",
+        "headers": [(b"content-type", content_type.encode()), (b"content-length", str(len(body)).encode())],
+        "client": ("bench", 1),
+        "server": ("bench", 80),
+    }
+    state = {"status": 0, "sent": False}
+
+    async def receive():
+        if not state["sent"]:
+            state["sent"] = True
+            return {"type": "http.request", "body": body, "more_body": False}
+        return {"type": "http.disconnect"}
+
+    async def send(message):
+        if message["type"] == "http.response.start":
+            state["status"] = message["status"]
+        elif message["type"] == "http.response.body":
+            chunks.append(message.get("body", b""))
+
+    await app(scope, receive, send)
+    return state["status"], json.loads(b"".join(chunks) or b"null")
+
+
+def reject_writes_of(target, filename: str) -> None:
+    """Fail every DynamoDB write whose request mentions filename."""
+    def _reject(params, **kwargs):
+        if filename.encode() in params["body"]:
+            raise RuntimeError(f"stubbed DynamoDB rejection of {filename}")
+
+    events = target.events if isinstance(target, boto3.Session) else target.meta.events
+    for operation in ("PutItem", "BatchWriteItem"):
+        events.register(f"before-call.dynamodb.{operation}", _reject)
+
+
+def measured(counts: Counter, fn: Callable[[], object]) -> Tuple[float, int, object]:
+    """(seconds, AWS requests sent, result) of fn()."""
+    counts.clear()
+    t0 = time.perf_counter()
+    result = fn()
+    return time.perf_counter() - t0, sum(counts.values()), result
+
+
+def main() -> None:
+    ap = argparse.ArgumentParser(description="Benchmark /inference/batch against one /inference per image")
+    ap.add_argument("--images", type=int, default=16)
+    ap.add_argument("--inflight", type=int, default=4)
+    ap.add_argument("--rtt-ms", type=float, default=20.0)
+    args = ap.parse_args()
+
+    use_bench_env()
+    from src.apps.backend import main as app_module
+
+    app_module.INFERENCE_PERSIST_MODE = "sync"
+    # Distinct images for each way plus one for warming up, so none is
+    # answered from the content index.
+    corpus = make_corpus(2 * args.images + 1, seed=9, sizes=[(1024, 768)], extensions=[".jpg"])
+    single = [multipart_body(f"single-{i}.jpg", image.data, "image/jpeg") for i, image in enumerate(corpus[1:args.images + 1])]
+    batch_files = [(f"batch-{i}.jpg", image.data, "image/jpeg") for i, image in enumerate(corpus[args.images + 1:])]
+    batch_files.insert(len(batch_files) // 2, ("notes.txt", b"not an image", "text/plain"))
+    batch_body, batch_type = multipart_files(batch_files)
+
+    with mock_aws():
+        create_resources()
+        boto3.setup_default_session()
+        add_latency(boto3.DEFAULT_SESSION, args.rtt_ms)
+        counts = count_aws_requests(boto3.DEFAULT_SESSION)
+        app_module.app.state.aws = None
+        asyncio.run(post_all(app_module.app, [multipart_body("warm.jpg", corpus[0].data, "image/jpeg")], 1))
+
+        single_s, single_requests, _ = measured(
+            counts, lambda: asyncio.run(post_all(app_module.app, single, args.inflight)),
+        )
+        batch_s, batch_requests, (status, response) = measured(
+            counts, lambda: asyncio.run(asgi_post_json(app_module.app, "/inference/batch", batch_body, batch_type)),
+        )
+
+        assert status == 200, (status, response)
+        results = response["results"]
+        assert [r["filename"] for r in results] == [name for name, _, _ in batch_files]
+        failed = [r for r in results if r["status_code"] != 200]
+        assert [r["filename"] for r in failed] == ["notes.txt"] and failed[0]["status_code"] == 400, failed
+        scored = [r for r in results if r["status_code"] == 200]
+        inference_table = app_module.aws_clients().table(BENCH_ENV["DDB_INFERENCES_TABLE"])
+        for r in scored:
+            item = inference_table.get_item(Key={"inference_id": r["inference_id"]}).get("Item")
+            assert item is not None and item["persist_status"] == "persisted", r
+
+        reject_writes_of(app_module.aws_clients().dynamodb.meta.client, "unstorable.jpg")
+        fresh = make_corpus(4, seed=10, sizes=[(1024, 768)], extensions=[".jpg"])
+        partial_files = [(f"partial-{i}.jpg", image.data, "image/jpeg") for i, image in enumerate(fresh[1:])]
+        partial_files.insert(1, ("unstorable.jpg", fresh[0].data, "image/jpeg"))
+        status, response = asyncio.run(asgi_post_json(app_module.app, "/inference/batch", *multipart_files(partial_files)))
+        assert status == 200, (status, response)
+        partial = {r["filename"]: r for r in response["results"]}
+        assert partial.pop("unstorable.jpg")["status_code"] == 500, response
+        for r in partial.values():
+            item = inference_table.get_item(Key={"inference_id": r["inference_id"]}).get("Item")
+            assert r["status_code"] == 200 and item["persist_status"] == "persisted", r
+
+    print(f"{args.images} images, 1024x768 JPEGs, rtt {args.rtt_ms:g} ms")
+    print(f"{'':>28} {'seconds':>8} {'AWS requests':>13}")
+    print(f"{f'/inference x{args.images} ({args.inflight} in flight)':>28} {single_s:>8.2f} {single_requests:>13}")
+    print(f"{'/inference/batch':>28} {batch_s:>8.2f} {batch_requests:>13}")
+    print(f"speedup {single_s / batch_s:.2f}x; {len(scored)} scored, non-image rejected on its own, "
+          f"unstorable image failed on its own")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,133 @@
+"""
+/inference latency benchmark -- "sync" vs. "background" persistence.
+
+Drives the FastAPI app directly over ASGI against moto-backed S3 and DynamoDB,
+with every AWS call delayed by --rtt-ms. Response latency is taken when the
+last body chunk is sent, so persistence running after the response (background
+mode) is excluded from it but still reported as total handler time.
+
+Requires moto (pip install "moto[s3,dynamodb]").
+
+Usage:
+    python -m benchmarks.bench_inference_latency [--rtt-ms 20] [--requests 20]
+"""
+from __future__ import annotations
+
+import argparse
+import asyncio
+import time
+import uuid
+from io import BytesIO
+from typing import List, Tuple
+
+import boto3
+import numpy as np
+from moto import mock_aws
+
+from benchmarks.aws import add_latency, create_resources, use_bench_env
+from benchmarks.bench_patch_extraction import synthetic_image
+
+
+def multipart_body(filename: str, data: bytes, content_type: str) -> Tuple[bytes, str]:
+    boundary = uuid.uuid4().hex
+    body = (
+        f"--{boundary}\r\n"
+        f'Content-Disposition: form-data; name="file"; filename="{filename}"\r\n'
+        f"Content-Type: {content_type}\r\n\r\n"
+    ).encode() + data + f"\r\n--{boundary}--\r\n".encode()
+    return body, f"multipart/form-data; boundary={boundary}"
+
+
+async def asgi_post(
+    app,
+    path: str,
+    body: bytes,
+    content_type: str,
+    chunk_size: int = 0,
+) -> Tuple[int, float, float]:
+    """
+    POST body to app, in one message or, like a real server, in chunk_size
+    pieces. Returns (status, seconds to response, seconds in handler).
+    """
+    scope = {
+        "type": "http",
+        "asgi": {"version": "3.0"},
+        "http_version": "1.1",
+        "method": "POST",
+        "scheme": "http",
+        "path": path,
+        "raw_path": path.encode(),
+        "root_path": "",
+        "query_string": b"",
+        "headers": [(b"content-type", content_type.encode()), (b"content-length", str(len(body)).encode())],
+        "client": ("bench", 1),
+        "server": ("bench", 80),
+    }
+    done = asyncio.Event()
+    state = {"status": 0, "responded": 0.0, "offset": 0}
+    step = chunk_size or len(body) or 1
+
+    async def receive():
+        offset = state["offset"]
+        if offset < len(body) or offset == 0:
+            state["offset"] = offset + step
+            chunk = body[offset:offset + step]
+            return {"type": "http.request", "body": chunk, "more_body": offset + step < len(body)}
+        await done.wait()
+        return {"type": "http.disconnect"}
+
+    async def send(message):
+        if message["type"] == "http.response.start":
+            state["status"] = message["status"]
+        elif message["type"] == "http.response.body" and not message.get("more_body"):
+            state["responded"] = time.perf_counter()
+
+    t0 = time.perf_counter()
+    await app(scope, receive, send)
+    t_end = time.perf_counter()
+    done.set()
+    return state["status"], state["responded"] - t0, t_end - t0
+
+
+def run_mode(app_module, mode: str, body: bytes, content_type: str, n: int) -> Tuple[List[float], List[float]]:
+    app_module.INFERENCE_PERSIST_MODE = mode
+    responded, handled = [], []
+    for _ in range(n):
+        status, resp_s, total_s = asyncio.run(asgi_post(app_module.app, "/inference", body, content_type))
+        assert status == 200, status
+        responded.append(resp_s)
+        handled.append(total_s)
+    return responded, handled
+
+
+def main() -> None:
+    ap = argparse.ArgumentParser(description="Benchmark /inference persistence modes")
+    ap.add_argument("--rtt-ms", type=float, default=20.0)
+    ap.add_argument("--requests", type=int, default=20)
+    ap.add_argument("--size", default="1600x1200")
+    args = ap.parse_args()
+
+    use_bench_env()
+    from src.apps.backend import main as app_module
+
+    w, h = (int(v) for v in args.size.split("x"))
+    buf = BytesIO()
+    synthetic_image(w, h).save(buf, format="JPEG", quality=90)
+    body, content_type = multipart_body("bench.jpg", buf.getvalue(), "image/jpeg")
+
+    with mock_aws():
+        create_resources()
+        boto3.setup_default_session()
+        add_latency(boto3.DEFAULT_SESSION, args.rtt_ms)
+
+        print(f"{args.size} upload, rtt {args.rtt_ms:.0f} ms, {args.requests} requests per mode")
+        print(f"{'mode':>11} {'p50 ms':>8} {'p99 ms':>8} {'handler p50 ms':>15}")
+        for mode in ("sync", "background"):
+            responded, handled = run_mode(app_module, mode, body, content_type, args.requests)
+            r = np.array(responded) * 1e3
+            print(f"{mode:>11} {np.percentile(r, 50):>8.1f} {np.percentile(r, 99):>8.1f} "
+                  f"{np.percentile(np.array(handled) * 1e3, 50):>15.1f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,100 @@
+"""
+Listing benchmark -- full list vs. streaming vs. parallel key ranges.
+
+Seeds --keys raw image keys under training/unprocessed/{image_id}/ (UUID
+image_ids, plus a few flat and non-hex keys) in moto and lists them with every
+ListObjectsV2 page delayed by --rtt-ms and limited to --page-size keys, so a
+small corpus behaves like a large one:
+
+    list         driver.list_unprocessed_objects (everything before the first key)
+    stream       iter_unprocessed_objects, one sequential listing
+    parallel     iter_unprocessed_objects with --workers threads over 16 hex ranges
+
+Reports time to the first key and to the last, and checks every mode returns
+exactly the same keys. moto answers each page by scanning the whole bucket in
+this process, so at small --rtt-ms its CPU time hides the parallel speedup.
+
+Requires moto (pip install "moto[s3]").
+
+Usage:
+    python -m benchmarks.bench_listing [--keys 3000] [--page-size 100] [--rtt-ms 150] [--workers 16]
+"""
+from __future__ import annotations
+
+import argparse
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from typing import List
+
+import boto3
+from moto import mock_aws
+
+from benchmarks.aws import BENCH_ENV, add_latency, create_resources, use_bench_env
+from src.apps.data_pipeline import listing
+from src.apps.data_pipeline.driver import RAW_PREFIX, iter_unprocessed_objects, list_unprocessed_objects
+from src.apps.data_pipeline.process import s3_client_config
+
+BUCKET = BENCH_ENV["S3_IMAGES_RAW_BUCKET"]
+
+
+def seed(s3, n: int) -> List[str]:
+    keys = [f"{RAW_PREFIX}{uuid.uuid5(uuid.NAMESPACE_URL, str(i))}/image_{i:06d}.jpg" for i in range(n)]
+    keys += [f"{RAW_PREFIX}flat_{i}.png" for i in range(5)]
+    keys += [f"{RAW_PREFIX}Upper-{i}/image.jpg" for i in range(5)]
+    keys += [f"{RAW_PREFIX}notes-{i}.txt" for i in range(5)]
+    with ThreadPoolExecutor(max_workers=16) as pool:
+        list(pool.map(lambda k: s3.put_object(Bucket=BUCKET, Key=k, Body=b"x"), keys))
+    return sorted(k for k in keys if not k.endswith(".txt"))
+
+
+def timed(fn):
+    t0 = time.perf_counter()
+    first = None
+    keys = []
+    for obj in fn():
+        if first is None:
+            first = time.perf_counter() - t0
+        keys.append(obj["Key"])
+    return first, time.perf_counter() - t0, keys
+
+
+def main() -> None:
+    ap = argparse.ArgumentParser(description="Benchmark streaming and partitioned listing")
+    ap.add_argument("--keys", type=int, default=3000)
+    ap.add_argument("--page-size", type=int, default=100)
+    ap.add_argument("--rtt-ms", type=float, default=150.0)
+    ap.add_argument("--workers", type=int, default=16)
+    args = ap.parse_args()
+
+    use_bench_env()
+    with mock_aws():
+        create_resources()
+        s3 = boto3.client("s3", region_name=BENCH_ENV["AWS_REGION"], config=s3_client_config())
+        expected = seed(s3, args.keys)
+        add_latency(s3, args.rtt_ms, event="before-send.s3.ListObjectsV2")
+
+        # Every mode pages the same way.
+        iter_objects = listing.iter_objects
+        listing.iter_objects = lambda *a, **kw: iter_objects(*a, **{**kw, "page_size": args.page_size})
+        from src.apps.data_pipeline import driver
+        driver.iter_objects = listing.iter_objects
+
+        modes = {
+            "list": lambda: list_unprocessed_objects(s3, BUCKET, RAW_PREFIX),
+            "stream": lambda: iter_unprocessed_objects(s3, BUCKET, RAW_PREFIX),
+            "parallel": lambda: iter_unprocessed_objects(s3, BUCKET, RAW_PREFIX, list_workers=args.workers),
+        }
+        results = {name: timed(fn) for name, fn in modes.items()}
+
+    print(f"{len(expected)} image keys, {args.page_size} per page, {args.rtt_ms:.0f} ms per page")
+    print(f"{'mode':>10} {'first key s':>12} {'all keys s':>11}")
+    for name, (first, total, keys) in results.items():
+        assert sorted(keys) == expected, f"{name}: listed {len(keys)} keys, expected {len(expected)}"
+        assert len(set(keys)) == len(keys), f"{name}: duplicate keys"
+        print(f"{name:>10} {first:>12.2f} {total:>11.2f}")
+    print("all modes listed the same keys")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,171 @@
+"""
+DynamoDB metadata write benchmark -- per-item writes vs. batched upserts.
+
+Writes the ImageRecords and PatchRecords of a synthetic set of images against
+moto twice: the old way (get_item on the ImageRecord, then put_item or
+update_item, then one put_item per patch) and with the metadata writer
+(one update_item upsert per image, PatchRecords through a BatchWriter in
+batches of 25). Half the ImageRecords exist beforehand with a label, as the
+upload script leaves them. With --drop, BatchWriteItem hands that fraction of
+each batch back as UnprocessedItems, so the retry path is exercised. Reports
+DynamoDB requests for each and checks both leave the same PatchRecords and
+ImageRecords (the upsert also fills in fields a pre-existing record lacks).
+
+Then runs the driver end to end and reports its DynamoDB requests per image.
+
+Requires moto (pip install "moto[s3,dynamodb]").
+
+Usage:
+    python -m benchmarks.bench_metadata_writes [--images 200] [--patches 21] [--drop 0.1]
+"""
+from __future__ import annotations
+
+import argparse
+import contextlib
+import io
+from collections import Counter
+from typing import Dict, List
+
+import boto3
+from moto import mock_aws
+
+from benchmarks.aws import BENCH_ENV, count_aws_requests, create_resources, drop_batch_writes, use_bench_env
+from benchmarks.bench_shards import run_driver
+from benchmarks.corpus import seed_unprocessed
+from src.apps.data_pipeline.metadata import BatchWriter, patch_record_item, upsert_image_record
+
+
+def synthetic_images(n: int, patches: int) -> List[Dict]:
+    images = []
+    for i in range(n):
+        image_id = f"bench-{i:06d}"
+        images.append({
+            "image_id": image_id,
+            "fields": {
+                "created_at": 1_700_000_000_000 + i,
+                "image_name": f"image_{i:06d}.jpg",
+                "image_path": f"s3://raw/training/unprocessed/{image_id}/image_{i:06d}.jpg",
+                "image_width": 1600,
+                "image_height": 1200,
+            },
+            "patches": [{
+                "patch_id": f"{image_id}-{j:03d}",
+                "patch_type": "center_square" if j == 0 else "grid",
+                "patch_path": f"s3://processed/training/{image_id}/grid/{j:03d}.jpg",
+                "patch_format": "jpeg",
+                "patch_x": j * 10, "patch_y": j * 10, "patch_width": 300, "patch_height": 300,
+            } for j in range(patches)],
+        })
+    return images
+
+
+def write_per_item(img_table, patch_table, images: List[Dict], run_id: str) -> None:
+    """The read-then-write, one-put-per-patch path the writer replaces."""
+    for image in images:
+        exists = "Item" in img_table.get_item(Key={"image_id": image["image_id"]}, ProjectionExpression="image_id")
+        if not exists:
+            img_table.put_item(Item={"image_id": image["image_id"], **image["fields"], "run_id": run_id})
+        else:
+            img_table.update_item(
+                Key={"image_id": image["image_id"]},
+                UpdateExpression="SET run_id = :r",
+                ExpressionAttributeValues={":r": run_id},
+            )
+        for p in image["patches"]:
+            patch_table.put_item(Item=patch_record_item(image["image_id"], p, image["fields"]["created_at"]))
+
+
+def write_batched(img_table, patch_table, images: List[Dict], run_id: str) -> int:
+    writer = BatchWriter(patch_table, base_delay_s=0.001)
+    failures: List[Exception] = []
+    for image in images:
+        upsert_image_record(img_table, image["image_id"], image["fields"], run_id=run_id)
+        writer.put(
+            [patch_record_item(image["image_id"], p, image["fields"]["created_at"]) for p in image["patches"]],
+            lambda: None, failures.append,
+        )
+    writer.close()
+    assert not failures, failures
+    return writer.batches
+
+
+def scan(table) -> List[Dict]:
+    items = table.scan()["Items"]
+    return sorted(items, key=lambda i: i.get("patch_id") or i["image_id"])
+
+
+def run_writer(mode: str, images: List[Dict], drop: float):
+    with mock_aws():
+        create_resources()
+        boto3.setup_default_session()
+        ddb = boto3.resource("dynamodb", region_name=BENCH_ENV["AWS_REGION"])
+        img_table = ddb.Table(BENCH_ENV["DDB_IMAGES_TABLE"])
+        patch_table = ddb.Table(BENCH_ENV["DDB_PATCHES_TABLE"])
+        for image in images[::2]:
+            img_table.put_item(Item={"image_id": image["image_id"], "label": "real",
+                                     "image_name": image["fields"]["image_name"]})
+
+        if drop > 0:
+            drop_batch_writes(ddb.meta.client, drop)
+        counts = count_aws_requests(ddb.meta.client)
+        if mode == "per-item":
+            write_per_item(img_table, patch_table, images, "bench-run")
+        else:
+            write_batched(img_table, patch_table, images, "bench-run")
+        return Counter(counts), scan(img_table), scan(patch_table)
+
+
+def run_end_to_end(images: int) -> Counter:
+    with mock_aws():
+        create_resources()
+        seed_unprocessed(images, size=(1600, 1200))
+        boto3.setup_default_session()
+        counts = count_aws_requests(boto3.DEFAULT_SESSION)
+        with contextlib.redirect_stdout(io.StringIO()):
+            run_driver("bench-metadata", [])
+        return Counter({k: v for k, v in counts.items() if k.startswith("dynamodb.")})
+
+
+def main() -> None:
+    ap = argparse.ArgumentParser(description="Benchmark batched DynamoDB metadata writes")
+    ap.add_argument("--images", type=int, default=200)
+    ap.add_argument("--patches", type=int, default=21, help="Patches per image (21 for p=2)")
+    ap.add_argument("--drop", type=float, default=0.1, help="Fraction of batch writes returned unprocessed")
+    ap.add_argument("--e2e-images", type=int, default=20)
+    args = ap.parse_args()
+
+    use_bench_env()
+    images = synthetic_images(args.images, args.patches)
+    runs = {"per-item": run_writer("per-item", images, 0.0), "batched": run_writer("batched", images, 0.0)}
+    if args.drop > 0:
+        runs[f"batched, {args.drop:.0%} unprocessed"] = run_writer("batched", images, args.drop)
+
+    _, old_images, old_patches = runs["per-item"]
+    for name, (_, new_images, new_patches) in runs.items():
+        # The upsert also fills fields a pre-existing record lacks; everything
+        # the per-item path wrote must be there unchanged.
+        for old_item, new_item in zip(old_images, new_images):
+            assert {k: new_item.get(k) for k in old_item} == old_item, f"{name}: ImageRecord differs"
+        assert new_patches == old_patches, f"{name}: PatchRecords differ"
+        assert all(i.get("label") == "real" for i in new_images[::2]), f"{name}: pre-existing labels lost"
+
+    print(f"{args.images} images x {args.patches} patches")
+    print(f"{'path':>26} {'requests':>9} {'per image':>10} {'x fewer':>8}  by operation")
+    base = sum(runs["per-item"][0].values())
+    for name, (counts, _, _) in runs.items():
+        total = sum(counts.values())
+        ops = ", ".join(f"{k.split('.')[1]} {v}" for k, v in sorted(counts.items()))
+        print(f"{name:>26} {total:>9} {total / args.images:>10.2f} {base / total:>7.1f}x  {ops}")
+    patch_old = args.images * args.patches
+    patch_new = runs["batched"][0]["dynamodb.BatchWriteItem"]
+    print(f"PatchRecord requests: {patch_old} -> {patch_new} ({patch_old / patch_new:.1f}x fewer)")
+    print("records match")
+
+    e2e = run_end_to_end(args.e2e_images)
+    print(f"\ndriver, {args.e2e_images} images: {sum(e2e.values()) / args.e2e_images:.2f} DynamoDB requests per image")
+    for op, n in sorted(e2e.items()):
+        print(f"{op:>28} {n:>5}")
+
+
+if __name__ == "__main__":
+    main()
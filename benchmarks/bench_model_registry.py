@@ -0,0 +1,242 @@
+"""
+Model registry benchmark -- hot swaps under load vs. a cold start.
+
+Sets up moto-backed RunRecords (with StatusIndex) and ConfigRecords tables and
+three stand-in model versions in an S3 mirror of the Modal volume. A training
+run's best_config_id then moves v1 -> v2 -> v1 -> v3 while --threads threads
+keep scoring through the registry's MicroBatcher. A newer processing run
+(completed, no best_config_id) checks that only training runs are picked.
+
+Reports, per swap, how long the new version took to be served and whether it
+was a load or an LRU hit (--cache-versions 2 keeps v1 and v2 around for the
+rollback), the worst gap between two scored requests and p50/p99 latency
+during the swaps, against what a worker restart costs before its first score
+(resolve, download, load, first pass). No request may fail, each version's
+scores must match its model's, and /inference must record the served version
+and only answer from the content index with a score of that version.
+
+Requires moto (pip install "moto[s3,dynamodb]").
+
+Usage:
+    python -m benchmarks.bench_model_registry [--threads 8] [--rtt-ms 20]
+"""
+from __future__ import annotations
+
+import argparse
+import asyncio
+import os
+import tempfile
+import threading
+import time
+from typing import Dict, List
+
+import boto3
+import numpy as np
+from moto import mock_aws
+
+from benchmarks.aws import BENCH_ENV, add_latency, create_resources, use_bench_env
+from benchmarks.bench_inference_batch import asgi_post_json
+from benchmarks.bench_inference_latency import multipart_body
+from benchmarks.bench_model_serving import stand_in_model
+from benchmarks.corpus import make_corpus
+from src.apps.backend.registry import ModelRegistry
+from src.apps.data_pipeline.process import PATCH_SIZE
+
+REGION = BENCH_ENV["AWS_REGION"]
+RUNS_TABLE = "artguard-bench-model-runs"
+CONFIGS_TABLE = "artguard-bench-model-configs"
+MIRROR_BUCKET = "artguard-bench-models"
+
+
+def create_model_tables(ddb) -> None:
+    ddb.create_table(
+        TableName=RUNS_TABLE,
+        KeySchema=[{"AttributeName": "run_id", "KeyType": "HASH"}],
+        AttributeDefinitions=[
+            {"AttributeName": "run_id", "AttributeType": "S"},
+            {"AttributeName": "status", "AttributeType": "S"},
+            {"AttributeName": "created_at", "AttributeType": "N"},
+        ],
+        GlobalSecondaryIndexes=[{
+            "IndexName": "StatusIndex",
+            "KeySchema": [
+                {"AttributeName": "status", "KeyType": "HASH"},
+                {"AttributeName": "created_at", "KeyType": "RANGE"},
+            ],
+            "Projection": {"ProjectionType": "ALL"},
+        }],
+        BillingMode="PAY_PER_REQUEST",
+    )
+    ddb.create_table(
+        TableName=CONFIGS_TABLE,
+        KeySchema=[{"AttributeName": "config_id", "KeyType": "HASH"}],
+        AttributeDefinitions=[{"AttributeName": "config_id", "AttributeType": "S"}],
+        BillingMode="PAY_PER_REQUEST",
+    )
+
+
+class Load:
+    """threads threads scoring requests through the registry until stopped."""
+
+    def __init__(self, registry: ModelRegistry, requests: List[np.ndarray], threads: int):
+        self.registry = registry
+        self.requests = requests
+        self.latencies: List[float] = []
+        self.finished: List[float] = []
+        self.versions: Dict[str, int] = {}
+        self.scores: Dict[str, np.ndarray] = {}
+        self.errors: List[Exception] = []
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._threads = [threading.Thread(target=self._run, args=(i,)) for i in range(threads)]
+
+    def start(self) -> None:
+        for t in self._threads:
+            t.start()
+
+    def stop(self) -> None:
+        self._stop.set()
+        for t in self._threads:
+            t.join()
+
+    def _run(self, seed: int) -> None:
+        i = seed
+        while not self._stop.is_set():
+            t0 = time.perf_counter()
+            try:
+                scores, version = self.registry.batcher.submit(self.requests[i % len(self.requests)]).result()
+            except Exception as exc:
+                with self._lock:
+                    self.errors.append(exc)
+                continue
+            t1 = time.perf_counter()
+            with self._lock:
+                self.latencies.append((t1 - t0) * 1000.0)
+                self.finished.append(t1)
+                self.versions[version] = self.versions.get(version, 0) + 1
+                if i % len(self.requests) == 0:
+                    self.scores[version] = scores
+            i += 1
+
+    def served(self, version: str) -> bool:
+        with self._lock:
+            return version in self.versions
+
+
+def main() -> None:
+    ap = argparse.ArgumentParser(description="Benchmark model hot swaps against a cold start")
+    ap.add_argument("--threads", type=int, default=8)
+    ap.add_argument("--rtt-ms", type=float, default=20.0)
+    ap.add_argument("--refresh-s", type=float, default=0.2)
+    ap.add_argument("--cache-versions", type=int, default=2)
+    args = ap.parse_args()
+
+    use_bench_env()
+    rng = np.random.default_rng(3)
+    requests = [rng.integers(0, 256, (5, PATCH_SIZE, PATCH_SIZE, 3), dtype=np.uint8) for _ in range(16)]
+    models = {f"v{i}": stand_in_model(hidden=(1024, 256), seed=i) for i in (1, 2, 3)}
+
+    with mock_aws(), tempfile.TemporaryDirectory() as cache_dir:
+        create_resources()
+        boto3.setup_default_session()
+        s3 = boto3.client("s3", region_name=REGION)
+        ddb = boto3.client("dynamodb", region_name=REGION)
+        s3.create_bucket(Bucket=MIRROR_BUCKET)
+        create_model_tables(ddb)
+        resource = boto3.resource("dynamodb", region_name=REGION)
+        runs, configs = resource.Table(RUNS_TABLE), resource.Table(CONFIGS_TABLE)
+        for version, model in models.items():
+            with tempfile.TemporaryDirectory() as tmp:
+                path = os.path.join(tmp, "best.npz")
+                model.save(path)
+                with open(path, "rb") as f:
+                    s3.put_object(Bucket=MIRROR_BUCKET, Key=f"volume/runs/train/{version}/best.npz", Body=f.read())
+            configs.put_item(Item={"config_id": version, "run_id": "train",
+                                   "modal_volume_path": f"/runs/train/{version}/best.npz"})
+        runs.put_item(Item={"run_id": "train", "status": "completed", "created_at": 1, "best_config_id": "v1"})
+        runs.put_item(Item={"run_id": "processing", "status": "completed", "created_at": 2})
+        add_latency(boto3.DEFAULT_SESSION, args.rtt_ms)
+
+        def registry(cache: str, **kwargs) -> ModelRegistry:
+            return ModelRegistry(runs, configs, s3, mirror_uri=f"s3://{MIRROR_BUCKET}/volume", cache_dir=cache,
+                                 cache_versions=args.cache_versions, **kwargs)
+
+        # What a restarted worker does before it can score anything.
+        with tempfile.TemporaryDirectory() as cold_cache:
+            cold = registry(cold_cache)
+            t0 = time.perf_counter()
+            cold.refresh()
+            cold.batcher.submit(requests[0]).result()
+            cold_start_ms = (time.perf_counter() - t0) * 1000.0
+            cold.close()
+
+        live = registry(cache_dir, refresh_s=args.refresh_s)
+        live.start()
+        assert live.active_version == "v1", live.active_version
+        load = Load(live, requests, args.threads)
+        load.start()
+        time.sleep(0.5)
+        swaps = []
+        for version in ("v2", "v1", "v3"):
+            loads = live.loads
+            t0 = time.perf_counter()
+            runs.update_item(Key={"run_id": "train"}, UpdateExpression="SET best_config_id = :c",
+                             ExpressionAttributeValues={":c": version})
+            while live.active_version != version:
+                time.sleep(0.005)
+            swapped_s = time.perf_counter() - t0
+            while not load.served(version):
+                time.sleep(0.005)
+            swaps.append((version, swapped_s * 1000.0, "load" if live.loads > loads else "LRU hit"))
+            time.sleep(0.5)
+        load.stop()
+        stats = live.to_dict()
+
+        # The API serves the registry's model when no MODEL_PATH is set.
+        os.environ.update({"DDB_RUNS_TABLE": RUNS_TABLE, "DDB_CONFIGS_TABLE": CONFIGS_TABLE})
+        from src.apps.backend import main as app_module
+
+        app_module.INFERENCE_PERSIST_MODE = "sync"
+        app_module.app.state.aws = None
+        app_module.app.state.model_registry = live
+        image = make_corpus(1, seed=12, sizes=[(1024, 768)], extensions=[".jpg"])[0]
+        body, ctype = multipart_body("registry.jpg", image.data, "image/jpeg")
+        status, response = asyncio.run(asgi_post_json(app_module.app, "/inference", body, ctype))
+        assert status == 200, response
+        record = app_module.aws_clients().table(BENCH_ENV["DDB_INFERENCES_TABLE"]).get_item(
+            Key={"inference_id": response["inference_id"]})["Item"]
+        assert record["model_version"] == "v3", record
+
+        # The same bytes again are answered from the content index while v3 is
+        # served, and rescored once v2 is.
+        status, again = asyncio.run(asgi_post_json(app_module.app, "/inference", body, ctype))
+        assert status == 200 and again["inference_id"] == response["inference_id"], again
+        runs.update_item(Key={"run_id": "train"}, UpdateExpression="SET best_config_id = :c",
+                         ExpressionAttributeValues={":c": "v2"})
+        while live.active_version != "v2":
+            time.sleep(0.005)
+        status, rescored = asyncio.run(asgi_post_json(app_module.app, "/inference", body, ctype))
+        assert status == 200 and rescored["inference_id"] != response["inference_id"], rescored
+        record = app_module.aws_clients().table(BENCH_ENV["DDB_INFERENCES_TABLE"]).get_item(
+            Key={"inference_id": rescored["inference_id"]})["Item"]
+        assert record["model_version"] == "v2", record
+        live.close()
+        app_module.app.state.model_registry = None
+
+    assert not load.errors, load.errors[:3]
+    for version, model in models.items():
+        assert np.allclose(load.scores[version], model.predict(requests[0]), atol=1e-5), version
+    gaps = np.diff(sorted(load.finished)) * 1000.0
+
+    print(f"{args.threads} threads scoring 5-patch requests, rtt {args.rtt_ms:g} ms, "
+          f"refresh every {args.refresh_s:g} s, {args.cache_versions} versions cached")
+    print(f"cold start (resolve, download, load, first pass): {cold_start_ms:.1f} ms")
+    for version, ms, how in swaps:
+        print(f"  swap to {version}: served {ms:.1f} ms after the RunRecord changed ({how})")
+    print(f"{len(load.latencies)} requests, 0 failed: p50 {np.percentile(load.latencies, 50):.1f} ms, "
+          f"p99 {np.percentile(load.latencies, 99):.1f} ms, worst gap between results {gaps.max():.1f} ms")
+    print(f"requests per version: {load.versions}; registry: {stats}")
+
+
+if __name__ == "__main__":
+    main()
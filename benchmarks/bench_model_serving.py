@@ -0,0 +1,144 @@
+"""
+Model serving benchmark -- a forward pass per request vs. MicroBatcher.
+
+A stand-in NumpyPatchModel (an MLP over 8x8-pooled patches, random weights)
+scores requests of --patches patches each, sent from --concurrency threads
+at once as the API's CPU threads would:
+
+    direct   every request runs its own forward pass
+    batched  requests go through MicroBatcher with each --max-wait-ms
+
+Reports requests/s, p50/p99 latency and the mean forward pass size, and
+checks that batched scores match direct ones. With --api, it then serves the
+model from the app (moto-backed, sync persistence) and checks that every
+/inference and /inference/batch score and model_version lands in its
+InferenceRecord.
+
+Usage:
+    python -m benchmarks.bench_model_serving [--requests 256] [--concurrency 1 8 32] [--api]
+"""
+from __future__ import annotations
+
+import argparse
+import asyncio
+import os
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, List, Tuple
+
+import numpy as np
+
+from src.apps.backend.batching import MicroBatcher
+from src.apps.backend.model import NumpyPatchModel
+from src.apps.data_pipeline.process import PATCH_SIZE
+
+
+def stand_in_model(pool: int = 8, hidden: Tuple[int, ...] = (512, 128), seed: int = 0) -> NumpyPatchModel:
+    rng = np.random.default_rng(seed)
+    sizes = [(PATCH_SIZE // pool) ** 2 * 3, *hidden, 1]
+    layers = [
+        (rng.normal(0, 1 / np.sqrt(n_in), (n_in, n_out)), np.zeros(n_out))
+        for n_in, n_out in zip(sizes, sizes[1:])
+    ]
+    return NumpyPatchModel(layers, pool=pool, mean=np.full(sizes[0], 0.5), std=np.full(sizes[0], 0.25),
+                           name="stand-in.npz")
+
+
+def run_load(score: Callable[[np.ndarray], np.ndarray], requests: List[np.ndarray], concurrency: int):
+    """Score every request from concurrency threads. Returns (seconds, latencies ms, scores)."""
+    latencies = [0.0] * len(requests)
+    scores: List[np.ndarray] = [None] * len(requests)
+
+    def one(i: int) -> None:
+        t0 = time.perf_counter()
+        scores[i] = score(requests[i])
+        latencies[i] = (time.perf_counter() - t0) * 1000.0
+
+    t0 = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        list(pool.map(one, range(len(requests))))
+    return time.perf_counter() - t0, latencies, scores
+
+
+def check_api(model: NumpyPatchModel, images: int) -> None:
+    import boto3
+    from moto import mock_aws
+
+    from benchmarks.aws import BENCH_ENV, create_resources, use_bench_env
+    from benchmarks.bench_inference_batch import asgi_post_json, multipart_files
+    from benchmarks.bench_inference_latency import multipart_body
+    from benchmarks.corpus import make_corpus
+
+    use_bench_env()
+    from src.apps.backend import main as app_module
+
+    with tempfile.TemporaryDirectory() as tmp, mock_aws():
+        path = os.path.join(tmp, model.name)
+        model.save(path)
+        app_module.MODEL_PATH = path
+        app_module.INFERENCE_PERSIST_MODE = "sync"
+        app_module.app.state.model_batcher = None
+        create_resources()
+        boto3.setup_default_session()
+        app_module.app.state.aws = None
+        corpus = make_corpus(2 * images, seed=11, sizes=[(1024, 768)], extensions=[".jpg"])
+
+        singles = [multipart_body(f"s{i}.jpg", c.data, "image/jpeg") for i, c in enumerate(corpus[:images])]
+        results = [asyncio.run(asgi_post_json(app_module.app, "/inference", body, ctype)) for body, ctype in singles]
+        assert all(status == 200 for status, _ in results), results
+        body, ctype = multipart_files([(f"b{i}.jpg", c.data, "image/jpeg") for i, c in enumerate(corpus[images:])])
+        status, batch = asyncio.run(asgi_post_json(app_module.app, "/inference/batch", body, ctype))
+        assert status == 200, batch
+
+        table = app_module.aws_clients().table(BENCH_ENV["DDB_INFERENCES_TABLE"])
+        scored = [r for _, r in results] + batch["results"]
+        for r in scored:
+            item = table.get_item(Key={"inference_id": r["inference_id"]})["Item"]
+            assert abs(float(item["score"]) - r["score"]) < 1e-9 and item["model_version"] == model.name, (r, item)
+        stats = app_module.model_batcher().to_dict()
+        app_module.model_batcher().close()
+        app_module.app.state.model_batcher = None
+        app_module.MODEL_PATH = ""
+    print(f"api: {len(scored)} inferences scored by {model.name} and stored; "
+          f"{stats['batches']} forward passes, {stats['mean_batch_patches']:.1f} patches each")
+
+
+def main() -> None:
+    ap = argparse.ArgumentParser(description="Benchmark micro-batched model serving")
+    ap.add_argument("--requests", type=int, default=256)
+    ap.add_argument("--patches", type=int, default=5, help="patches per request (5 for p=1, 17 for p=2)")
+    ap.add_argument("--concurrency", type=int, nargs="+", default=[1, 8, 32])
+    ap.add_argument("--max-batch", type=int, default=64)
+    ap.add_argument("--max-wait-ms", type=float, nargs="+", default=[2.0, 5.0])
+    ap.add_argument("--api", action="store_true", help="also check scoring end to end through the app")
+    args = ap.parse_args()
+
+    model = stand_in_model()
+    rng = np.random.default_rng(1)
+    requests = [rng.integers(0, 256, (args.patches, PATCH_SIZE, PATCH_SIZE, 3), dtype=np.uint8)
+                for _ in range(args.requests)]
+    expected = [model.predict(r) for r in requests]
+
+    print(f"{args.requests} requests of {args.patches} patches, max batch {args.max_batch} patches")
+    print(f"{'mode':>16} {'threads':>8} {'req/s':>8} {'p50 ms':>8} {'p99 ms':>8} {'patches/pass':>13}")
+    for concurrency in args.concurrency:
+        seconds, latencies, _ = run_load(model.predict, requests, concurrency)
+        print(f"{'direct':>16} {concurrency:>8} {len(requests) / seconds:>8.1f} "
+              f"{np.percentile(latencies, 50):>8.2f} {np.percentile(latencies, 99):>8.2f} {args.patches:>13.1f}")
+        for wait_ms in args.max_wait_ms:
+            batcher = MicroBatcher(model, max_batch_patches=args.max_batch, max_wait_ms=wait_ms)
+            seconds, latencies, scores = run_load(lambda r: batcher.submit(r).result()[0], requests, concurrency)
+            batcher.close()
+            for got, want in zip(scores, expected):
+                assert np.allclose(got, want, atol=1e-5), "batched scores differ from direct ones"
+            print(f"{f'batched {wait_ms:g} ms':>16} {concurrency:>8} {len(requests) / seconds:>8.1f} "
+                  f"{np.percentile(latencies, 50):>8.2f} {np.percentile(latencies, 99):>8.2f} "
+                  f"{batcher.to_dict()['mean_batch_patches']:>13.1f}")
+
+    if args.api:
+        check_api(model, images=4)
+
+
+if __name__ == "__main__":
+    main()
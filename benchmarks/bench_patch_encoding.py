@@ -0,0 +1,60 @@
+"""
+Patch encoding benchmark -- encode time, decode time and bytes per patch for
+every format in encoding.PATCH_ENCODERS.
+
+Patches come from extract_patches() on photo-like synthetic images. Each
+format is round-tripped once first; lossless formats must reproduce the
+pixels exactly.
+
+Usage:
+    python -m benchmarks.bench_patch_encoding [--repeat 3]
+"""
+from __future__ import annotations
+
+import argparse
+import time
+
+import numpy as np
+
+from benchmarks.bench_decode import photo_like
+from src.apps.data_pipeline.encoding import PATCH_ENCODERS
+from src.apps.data_pipeline.process import extract_patches
+
+LOSSLESS = {"webp_lossless", "png", "raw"}
+
+
+def main() -> None:
+    ap = argparse.ArgumentParser(description="Benchmark patch encoding formats")
+    ap.add_argument("--repeat", type=int, default=3)
+    args = ap.parse_args()
+
+    batch = np.concatenate([extract_patches(photo_like(3000, 2000, seed=s))[0] for s in range(3)])
+    n = len(batch)
+
+    print(f"{n} patches of {batch.shape[1]}x{batch.shape[2]}")
+    print(f"{'format':>14} {'encode ms':>10} {'decode ms':>10} {'KB/patch':>9} {'max diff':>9}")
+    for name, enc in PATCH_ENCODERS.items():
+        blobs = [enc.encode(p) for p in batch]
+        decoded = np.stack([enc.decode(b) for b in blobs])
+        max_diff = int(np.abs(decoded.astype(np.int16) - batch.astype(np.int16)).max())
+        if name in LOSSLESS:
+            assert max_diff == 0, f"{name} is not lossless (max diff {max_diff})"
+
+        encode_s = decode_s = float("inf")
+        for _ in range(args.repeat):
+            t0 = time.perf_counter()
+            for p in batch:
+                enc.encode(p)
+            encode_s = min(encode_s, time.perf_counter() - t0)
+
+            t0 = time.perf_counter()
+            for b in blobs:
+                enc.decode(b)
+            decode_s = min(decode_s, time.perf_counter() - t0)
+
+        kb = sum(len(b) for b in blobs) / n / 1024.0
+        print(f"{name:>14} {encode_s / n * 1e3:>10.2f} {decode_s / n * 1e3:>10.2f} {kb:>9.1f} {max_diff:>9}")
+
+
+if __name__ == "__main__":
+    main()
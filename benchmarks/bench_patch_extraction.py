@@ -0,0 +1,97 @@
+"""
+Patch extraction benchmark -- extract_patches() batch vs. the per-patch PIL path.
+
+Before timing, checks that extract_patches() produces the same patch
+coordinates as the original crop + resize loop for every size tested, and
+pixels within the tolerance documented in extract_patches (see check_parity;
+tests/test_patch_extraction.py runs the same check).
+
+Usage:
+    python -m benchmarks.bench_patch_extraction [--repeat 5]
+"""
+from __future__ import annotations
+
+import argparse
+import time
+from typing import Dict, List, Tuple
+
+import numpy as np
+from PIL import Image
+
+from src.apps.data_pipeline.process import (
+    PATCH_SIZE,
+    _center_crop_square,
+    _choose_p,
+    extract_patches,
+)
+
+SIZES = [(640, 480), (1000, 800), (1600, 1200), (3000, 2000), (6000, 4000)]
+
+
+def synthetic_image(w: int, h: int, seed: int = 0) -> Image.Image:
+    """Smooth gradients plus noise, so resampling has real detail to work on."""
+    rng = np.random.default_rng(seed)
+    yy, xx = np.mgrid[0:h, 0:w]
+    base = np.stack([xx * 255 // max(w - 1, 1), yy * 255 // max(h - 1, 1), (xx + yy) % 256], axis=-1)
+    noise = rng.integers(-40, 40, size=(h, w, 3))
+    return Image.fromarray(np.clip(base + noise, 0, 255).astype(np.uint8), "RGB")
+
+
+def legacy_extract(img: Image.Image) -> Tuple[List[Image.Image], List[Dict]]:
+    """The original per-patch crop + resize path, without the upload."""
+    square, sq_left, sq_top, sq_side = _center_crop_square(img)
+    grid_n = 2 ** _choose_p(img)
+    cell = sq_side // grid_n
+
+    imgs = [square.resize((PATCH_SIZE, PATCH_SIZE), resample=Image.BICUBIC)]
+    meta = [{"patch_type": "center_square", "x": sq_left, "y": sq_top, "width": sq_side, "height": sq_side}]
+    for row in range(grid_n):
+        for col in range(grid_n):
+            x0, y0 = col * cell, row * cell
+            patch = square.crop((x0, y0, x0 + cell, y0 + cell))
+            imgs.append(patch.resize((PATCH_SIZE, PATCH_SIZE), resample=Image.BICUBIC))
+            meta.append({"patch_type": "grid", "x": sq_left + x0, "y": sq_top + y0, "width": cell, "height": cell})
+    return imgs, meta
+
+
+def check_parity(img: Image.Image, max_mean: float = 0.5, max_p99: float = 2) -> None:
+    """Same shape and coordinates as legacy_extract, pixels within max_mean / max_p99 levels per patch."""
+    legacy_imgs, legacy_meta = legacy_extract(img)
+    batch, meta = extract_patches(img)
+
+    assert batch.shape == (len(legacy_imgs), PATCH_SIZE, PATCH_SIZE, 3), batch.shape
+    assert batch.dtype == np.uint8 and batch.flags["C_CONTIGUOUS"]
+    assert meta == legacy_meta, (meta, legacy_meta)
+    for i, ref in enumerate(legacy_imgs):
+        diff = np.abs(batch[i].astype(np.int16) - np.asarray(ref).astype(np.int16))
+        assert diff.mean() < max_mean, f"patch {i} differs by {diff.mean():.3f} levels on average"
+        assert np.percentile(diff, 99) <= max_p99, f"patch {i} differs by {np.percentile(diff, 99)} levels at p99"
+
+
+def best_of(fn, repeat: int) -> float:
+    best = float("inf")
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        fn()
+        best = min(best, time.perf_counter() - t0)
+    return best
+
+
+def main() -> None:
+    ap = argparse.ArgumentParser(description="Benchmark patch extraction")
+    ap.add_argument("--repeat", type=int, default=5)
+    args = ap.parse_args()
+
+    print(f"{'size':>12} {'patches':>8} {'legacy ms':>10} {'batched ms':>11} {'speedup':>8}")
+    for w, h in SIZES:
+        img = synthetic_image(w, h)
+        check_parity(img)
+
+        legacy = best_of(lambda: legacy_extract(img), args.repeat)
+        batched = best_of(lambda: extract_patches(img), args.repeat)
+        n = 1 + (2 ** _choose_p(img)) ** 2
+        print(f"{w:>5}x{h:<6} {n:>8} {legacy * 1e3:>10.1f} {batched * 1e3:>11.1f} {legacy / batched:>7.2f}x")
+
+
+if __name__ == "__main__":
+    main()
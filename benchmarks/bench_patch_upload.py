@@ -0,0 +1,65 @@
+"""
+Patch upload benchmark -- serial vs. concurrent uploads per image.
+
+Runs process_image_to_patches against a moto-backed S3 bucket. moto answers
+in-process, so each put_object is delayed by --rtt-ms in the calling thread to
+stand in for the S3 round trip. With concurrent uploads, per-image wall time
+should approach one round trip instead of one per patch.
+
+Requires moto (pip install "moto[s3]").
+
+Usage:
+    python -m benchmarks.bench_patch_upload [--rtt-ms 40] [--repeat 3]
+"""
+from __future__ import annotations
+
+import argparse
+import os
+import time
+
+import boto3
+from moto import mock_aws
+
+from benchmarks.aws import add_latency
+from benchmarks.bench_patch_extraction import synthetic_image
+from src.apps.data_pipeline.process import process_image_to_patches, s3_client_config
+
+BUCKET = "artguard-bench-processed"
+WORKERS = [1, 2, 4, 8, 17]
+
+
+def main() -> None:
+    ap = argparse.ArgumentParser(description="Benchmark concurrent patch uploads")
+    ap.add_argument("--rtt-ms", type=float, default=40.0)
+    ap.add_argument("--repeat", type=int, default=3)
+    args = ap.parse_args()
+
+    os.environ.setdefault("AWS_DEFAULT_REGION", "us-east-1")
+    img = synthetic_image(1600, 1200)  # p = 2 -> 17 patches
+
+    with mock_aws():
+        s3 = boto3.client("s3", config=s3_client_config(max(WORKERS)))
+        s3.create_bucket(Bucket=BUCKET)
+        add_latency(s3, args.rtt_ms, event="before-send.s3.PutObject")
+
+        print(f"rtt {args.rtt_ms:.0f} ms, 17 patches per image")
+        print(f"{'workers':>8} {'ms/image':>10} {'round trips':>12}")
+        for workers in WORKERS:
+            best = float("inf")
+            for i in range(args.repeat):
+                t0 = time.perf_counter()
+                patches = process_image_to_patches(
+                    img=img,
+                    image_id=f"bench-{workers}-{i}",
+                    processed_bucket=BUCKET,
+                    processed_prefix="training",
+                    s3_client=s3,
+                    max_workers=workers,
+                )
+                best = min(best, time.perf_counter() - t0)
+            assert len(patches) == 17
+            print(f"{workers:>8} {best * 1e3:>10.1f} {best * 1e3 / args.rtt_ms:>12.1f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,230 @@
+"""
+/rag-query response cache benchmark, against a stubbed Bedrock client.
+
+StubBedrock stands in for bedrock-agent-runtime: retrieve_and_generate sleeps
+--bedrock-ms and counts its calls. The app runs over ASGI with moto-backed
+DynamoDB for the shared store. It checks that:
+
+    workload   --requests questions about a handful of artists, phrased with
+               varying case, punctuation and spacing, --inflight at a time,
+               need one Bedrock call per distinct question (vs. one per
+               request without the cache), with p50/p99 latency for both
+    collapse   --burst identical concurrent questions make a single call
+    shared     a second worker's cache answers from the DynamoDB store
+    ttl, lru   expired and evicted entries are fetched again
+    errors     a failed call is not cached and its waiters see the error
+
+Requires moto and the API's dependencies (pip install "moto[dynamodb]").
+
+Usage:
+    python -m benchmarks.bench_rag_cache [--requests 200] [--inflight 16] [--bedrock-ms 300]
+"""
+from __future__ import annotations
+
+import argparse
+import asyncio
+import json
+import os
+import random
+import threading
+import time
+from typing import Dict, List, Tuple
+
+import boto3
+import numpy as np
+from moto import mock_aws
+
+from benchmarks.aws import BENCH_ENV, create_resources, use_bench_env
+from src.apps.backend.clients import AWSClients
+from src.apps.backend.ragcache import DynamoRagStore, RagResponseCache, normalize_query
+
+RAG_CACHE_TABLE = "artguard-bench-rag-cache"
+ARTISTS = ["Claude Monet", "Frida Kahlo", "Hokusai", "Artemisia Gentileschi", "Jean-Michel Basquiat"]
+QUESTIONS = ["Which movement is {} associated with?", "What techniques did {} use?", "Who influenced {}?"]
+
+
+class StubBedrock:
+    """retrieve_and_generate with a fixed delay, counting calls; fails while fail is set."""
+
+    def __init__(self, delay_s: float):
+        self.delay_s = delay_s
+        self.calls = 0
+        self.fail = False
+        self._lock = threading.Lock()
+
+    def retrieve_and_generate(self, input, retrieveAndGenerateConfiguration):
+        with self._lock:
+            self.calls += 1
+        time.sleep(self.delay_s)
+        if self.fail:
+            raise RuntimeError("stubbed Bedrock failure")
+        return {
+            "output": {"text": f"Answer to: {input['text']}"},
+            "citations": [{"retrievedReferences": [{
+                "location": {"s3Location": {"uri": "s3://artguard-kb/artists.md"}},
+                "content": {"text": "Stubbed reference."},
+            }]}],
+        }
+
+
+class StubClients(AWSClients):
+    """The app's clients with StubBedrock for bedrock-agent-runtime."""
+
+    def __init__(self, bedrock: StubBedrock):
+        super().__init__(BENCH_ENV["AWS_REGION"], {})
+        self.bedrock = bedrock
+
+    def client(self, service: str):
+        return self.bedrock if service == "bedrock-agent-runtime" else super().client(service)
+
+
+def phrasings(n: int, seed: int = 0) -> List[str]:
+    """n questions drawn from the artist questions, each with random case, punctuation and spacing."""
+    rng = random.Random(seed)
+    out = []
+    for _ in range(n):
+        q = rng.choice(QUESTIONS).format(rng.choice(ARTISTS))
+        q = rng.choice([q, q.lower(), q.upper(), q.rstrip("?"), f"  {q}  ", q.replace(" ", "  "), q + "??"])
+        out.append(q)
+    return out
+
+
+async def ask(app, query: str) -> Tuple[int, dict, float]:
+    """POST /rag-query over ASGI. Returns (status, JSON body, seconds)."""
+    body = json.dumps({"query": query}).encode()
+    scope = {
+        "type": "http", "asgi": {"version": "3.0"}, "http_version": "1.1", "method": "POST",
+        "scheme": "http", "path": "/rag-query", "raw_path": b"/rag-query", "root_path": "",
+        "query_string": b"", "client": ("bench", 1), "server": ("bench", 80),
+        "headers": [(b"content-type", b"application/json"), (b"content-length", str(len(body)).encode())],
+    }
+    state: Dict = {"status": 0, "chunks": [], "sent": False}
+
+    async def receive():
+        if not state["sent"]:
+            state["sent"] = True
+            return {"type": "http.request", "body": body, "more_body": False}
+        return {"type": "http.disconnect"}
+
+    async def send(message):
+        if message["type"] == "http.response.start":
+            state["status"] = message["status"]
+        elif message["type"] == "http.response.body":
+            state["chunks"].append(message.get("body", b""))
+
+    t0 = time.perf_counter()
+    await app(scope, receive, send)
+    return state["status"], json.loads(b"".join(state["chunks"])), time.perf_counter() - t0
+
+
+async def ask_all(app, queries: List[str], inflight: int) -> List[float]:
+    limit = asyncio.Semaphore(inflight)
+    latencies: List[float] = []
+
+    async def one(query: str) -> None:
+        async with limit:
+            status, body, seconds = await ask(app, query)
+            assert status == 200, (status, body)
+            assert normalize_query(body["answer"]) == normalize_query(f"Answer to: {query}"), (query, body)
+            latencies.append(seconds * 1000.0)
+
+    await asyncio.gather(*(one(q) for q in queries))
+    return latencies
+
+
+async def check_cache(store: DynamoRagStore, bedrock: StubBedrock, burst: int) -> None:
+    """Collapse, shared store, TTL, LRU and error behaviour on RagResponseCache itself."""
+    async def compute() -> Dict:
+        result = await asyncio.get_running_loop().run_in_executor(
+            None, bedrock.retrieve_and_generate, {"text": "q"}, {},
+        )
+        return {"answer": result["output"]["text"], "sources": []}
+
+    now = [1000.0]
+    worker_a = RagResponseCache(ttl_s=60, max_entries=2, store=store, clock=lambda: now[0])
+    worker_b = RagResponseCache(ttl_s=60, max_entries=2, store=store, clock=lambda: now[0])
+
+    bedrock.calls = 0
+    await asyncio.gather(*(worker_a.get_or_compute("burst", compute) for _ in range(burst)))
+    assert bedrock.calls == 1 and worker_a.collapsed == burst - 1, (bedrock.calls, worker_a.to_dict())
+
+    await worker_b.get_or_compute("burst", compute)
+    assert bedrock.calls == 1 and worker_b.shared_hits == 1, worker_b.to_dict()
+
+    now[0] += 61
+    await worker_a.get_or_compute("burst", compute)
+    assert bedrock.calls == 2, "an expired entry was served"
+
+    for key in ("k1", "k2"):
+        await worker_a.get_or_compute(key, compute)
+    assert worker_a.evictions == 1, worker_a.to_dict()
+    worker_a.store = None
+    await worker_a.get_or_compute("burst", compute)
+    assert bedrock.calls == 5, "an evicted entry was served"
+
+    bedrock.fail = True
+    results = await asyncio.gather(*(worker_a.get_or_compute("fails", compute) for _ in range(3)),
+                                   return_exceptions=True)
+    assert all(isinstance(r, RuntimeError) for r in results), results
+    bedrock.fail = False
+    await worker_a.get_or_compute("fails", compute)
+    assert bedrock.calls == 7, "a failed call was cached"
+
+
+def main() -> None:
+    ap = argparse.ArgumentParser(description="Benchmark the /rag-query response cache")
+    ap.add_argument("--requests", type=int, default=200)
+    ap.add_argument("--inflight", type=int, default=16)
+    ap.add_argument("--bedrock-ms", type=float, default=300.0)
+    ap.add_argument("--burst", type=int, default=20)
+    args = ap.parse_args()
+
+    use_bench_env()
+    os.environ.update({"KNOWLEDGE_BASE_ID": "bench-kb", "DDB_RAG_CACHE_TABLE": RAG_CACHE_TABLE})
+    from src.apps.backend import main as app_module
+    from src.apps.backend import ragcache
+
+    queries = phrasings(args.requests)
+    distinct = len({normalize_query(q) for q in queries})
+    bedrock = StubBedrock(args.bedrock_ms / 1000.0)
+
+    with mock_aws():
+        create_resources()
+        boto3.setup_default_session()
+        boto3.client("dynamodb", region_name=BENCH_ENV["AWS_REGION"]).create_table(
+            TableName=RAG_CACHE_TABLE,
+            KeySchema=[{"AttributeName": "cache_key", "KeyType": "HASH"}],
+            AttributeDefinitions=[{"AttributeName": "cache_key", "AttributeType": "S"}],
+            BillingMode="PAY_PER_REQUEST",
+        )
+        app_module.app.state.aws = StubClients(bedrock)
+
+        rows = []
+        for enabled in (False, True):
+            ragcache.RAG_CACHE = enabled
+            app_module.get_rag_cache.cache_clear()
+            bedrock.calls = 0
+            t0 = time.perf_counter()
+            latencies = asyncio.run(ask_all(app_module.app, queries, args.inflight))
+            rows.append(("cached" if enabled else "uncached", time.perf_counter() - t0, bedrock.calls, latencies))
+        stats = app_module.get_rag_cache().to_dict()
+        assert rows[0][2] == args.requests and rows[1][2] == distinct, [(r[0], r[2]) for r in rows]
+        assert stats["hits"] + stats["collapsed"] + stats["misses"] == args.requests, stats
+
+        store = DynamoRagStore(app_module.aws_clients().dynamodb.Table(RAG_CACHE_TABLE))
+        asyncio.run(check_cache(store, bedrock, args.burst))
+        app_module.app.state.aws = None
+        app_module.get_rag_cache.cache_clear()
+
+    print(f"{args.requests} questions ({distinct} distinct once normalized), {args.inflight} in flight, "
+          f"Bedrock {args.bedrock_ms:g} ms")
+    print(f"{'':>9} {'seconds':>8} {'Bedrock calls':>14} {'p50 ms':>8} {'p99 ms':>8}")
+    for name, seconds, calls, latencies in rows:
+        print(f"{name:>9} {seconds:>8.2f} {calls:>14} {np.percentile(latencies, 50):>8.1f} "
+              f"{np.percentile(latencies, 99):>8.1f}")
+    print(f"cache: {stats}")
+    print(f"collapse ({args.burst} identical at once -> 1 call), shared store, TTL, LRU and error checks passed")
+
+
+if __name__ == "__main__":
+    main()
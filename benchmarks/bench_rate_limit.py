@@ -0,0 +1,150 @@
+"""
+Adaptive rate limiter benchmark -- throttled DynamoDB and S3 stand-ins.
+
+throttle_requests (benchmarks/aws.py) makes moto accept only so many requests
+per second and answer the rest with ProvisionedThroughputExceededException
+(DynamoDB) or SlowDown (S3), as the real services do under load.
+
+First --workers threads put items as fast as they can against a table that
+takes --capacity requests per second: once with botocore's own retries, once
+through limit_client (ratelimit.py). Reports items written and failed, the
+throughput, how many requests were throttled and the rate the limiter
+settled at, which should be just under the capacity.
+
+Then runs the driver end to end with S3 and DynamoDB both throttled, with
+AWS_RATE_LIMIT off and on, and reports the images that failed for each.
+
+Requires moto (pip install "moto[s3,dynamodb]").
+
+Usage:
+    python -m benchmarks.bench_rate_limit [--workers 16] [--items 1500] [--capacity 150] [--images 12]
+"""
+from __future__ import annotations
+
+import argparse
+import contextlib
+import io
+import json
+import os
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict
+
+import boto3
+from botocore.exceptions import ClientError
+from moto import mock_aws
+
+from benchmarks.aws import BENCH_ENV, add_latency, create_resources, throttle_requests, use_bench_env
+from benchmarks.bench_shards import run_driver
+from benchmarks.corpus import seed_unprocessed
+from src.apps.data_pipeline import ratelimit
+from src.apps.data_pipeline.ratelimit import AdaptiveRateLimiter, limit_client
+
+
+def run_writers(opts, limited: bool) -> Dict:
+    with mock_aws():
+        create_resources()
+        session = boto3.Session(region_name=BENCH_ENV["AWS_REGION"])
+        add_latency(session, opts.rtt_ms)
+        throttle = throttle_requests(session, "dynamodb", opts.capacity, operations=["PutItem"])
+        ddb = session.resource("dynamodb")
+        limiter = limit_client(ddb.meta.client, AdaptiveRateLimiter("bench")) if limited else None
+        table = ddb.Table(BENCH_ENV["DDB_IMAGES_TABLE"])
+
+        failed = 0
+        finished_at = []
+
+        def put(i: int) -> None:
+            nonlocal failed
+            try:
+                table.put_item(Item={"image_id": f"bench-{i:06d}", "image_name": f"image_{i:06d}.jpg"})
+                finished_at.append(time.perf_counter())
+            except ClientError:
+                failed += 1
+
+        t0 = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=opts.workers) as pool:
+            list(pool.map(put, range(opts.items)))
+        seconds = time.perf_counter() - t0
+        written = table.scan(Select="COUNT")["Count"]
+
+    # Throughput over the second half of the run, once the limiter has settled.
+    finished_at.sort()
+    half = finished_at[len(finished_at) // 2:]
+    settled = (len(half) - 1) / (half[-1] - half[0]) if len(half) > 1 and half[-1] > half[0] else 0.0
+    return {
+        "written": written,
+        "failed": failed,
+        "seconds": seconds,
+        "items_per_s": written / seconds,
+        "settled_per_s": settled,
+        "throttled": throttle.throttled,
+        "limiter_rate": limiter.rate if limiter is not None else None,
+    }
+
+
+def run_throttled_driver(opts, limited: bool) -> Dict:
+    ratelimit.AWS_RATE_LIMIT = limited
+    # A fresh shared limiter per run, as in a new driver task.
+    ratelimit._limiters.clear()
+    with mock_aws(), tempfile.TemporaryDirectory() as tmp:
+        create_resources()
+        boto3.setup_default_session()
+        add_latency(boto3.DEFAULT_SESSION, opts.rtt_ms)
+        seed_unprocessed(opts.images, size=(1024, 768))
+        s3_throttle = throttle_requests(boto3.DEFAULT_SESSION, "s3", opts.driver_s3_capacity)
+        ddb_throttle = throttle_requests(boto3.DEFAULT_SESSION, "dynamodb", opts.driver_ddb_capacity)
+        metrics_path = os.path.join(tmp, "metrics.json")
+        with contextlib.redirect_stdout(io.StringIO()):
+            seconds = run_driver(f"bench-rate-limit-{int(limited)}", ["--metrics_json", metrics_path])
+        with open(metrics_path) as f:
+            metrics = json.load(f)["metrics"]
+        images = boto3.resource("dynamodb").Table(BENCH_ENV["DDB_IMAGES_TABLE"]).scan(Select="COUNT")["Count"]
+    return {
+        "images": images,
+        "errors": metrics["counters"].get("errors", 0),
+        "seconds": seconds,
+        "throttled": s3_throttle.throttled + ddb_throttle.throttled,
+        "rates": {name: gauge["rate_per_s"] for name, gauge in metrics["gauges"].items()
+                  if name.startswith("aws_rate.")},
+    }
+
+
+def main() -> None:
+    ap = argparse.ArgumentParser(description="Benchmark the adaptive AWS rate limiter")
+    ap.add_argument("--workers", type=int, default=16)
+    ap.add_argument("--items", type=int, default=1500)
+    ap.add_argument("--capacity", type=float, default=150.0, help="Requests per second the table accepts")
+    ap.add_argument("--rtt-ms", type=float, default=5.0)
+    ap.add_argument("--images", type=int, default=12)
+    ap.add_argument("--driver-s3-capacity", type=float, default=20.0)
+    ap.add_argument("--driver-ddb-capacity", type=float, default=5.0)
+    opts = ap.parse_args()
+    use_bench_env()
+
+    print(f"{opts.workers} writers, {opts.items} items, table capacity {opts.capacity:g}/s")
+    print(f"{'retries':>10} {'written':>8} {'failed':>7} {'items/s':>8} {'settled/s':>10} "
+          f"{'throttled':>10} {'limiter rate':>13}")
+    results = {}
+    for name, limited in (("botocore", False), ("limiter", True)):
+        r = results[name] = run_writers(opts, limited)
+        rate = f"{r['limiter_rate']:.1f}" if r["limiter_rate"] is not None else "-"
+        print(f"{name:>10} {r['written']:>8} {r['failed']:>7} {r['items_per_s']:>8.1f} "
+              f"{r['settled_per_s']:>10.1f} {r['throttled']:>10} {rate:>13}")
+    assert results["limiter"]["failed"] == 0, "writes failed through the rate limiter"
+    assert results["limiter"]["written"] == opts.items
+
+    print(f"\ndriver, {opts.images} images, S3 capacity {opts.driver_s3_capacity:g}/s, "
+          f"DynamoDB capacity {opts.driver_ddb_capacity:g}/s")
+    print(f"{'retries':>10} {'images':>7} {'errors':>7} {'seconds':>8} {'throttled':>10}  limiter rates")
+    for name, limited in (("botocore", False), ("limiter", True)):
+        r = run_throttled_driver(opts, limited)
+        rates = ", ".join(f"{k[len('aws_rate.'):]} {v:.1f}/s" for k, v in sorted(r["rates"].items()) if v)
+        print(f"{name:>10} {r['images']:>7} {r['errors']:>7} {r['seconds']:>8.1f} {r['throttled']:>10}  {rates or '-'}")
+        if limited:
+            assert r["errors"] == 0 and r["images"] == opts.images, "the driver failed images through the limiter"
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,94 @@
+"""
+Patch shard benchmark -- one S3 object per patch vs. packed shards.
+
+Runs the driver end to end against moto on a small synthetic corpus, once per
+storage layout, and counts the S3 requests made against the processed bucket.
+Then reads every patch back (ranged GETs for shards) and checks it decodes to
+the same pixels in both layouts.
+
+Requires moto (pip install "moto[s3,dynamodb]").
+
+Usage:
+    python -m benchmarks.bench_shards [--images 20] [--shard-max-mb 4]
+"""
+from __future__ import annotations
+
+import argparse
+import sys
+import time
+from collections import Counter
+
+import boto3
+import numpy as np
+from moto import mock_aws
+
+from benchmarks.aws import BENCH_ENV, create_resources, use_bench_env
+from benchmarks.corpus import seed_unprocessed
+
+
+def count_requests(session: boto3.Session, counter: Counter) -> None:
+    def _count(event_name: str, params=None, **kwargs):
+        if params and params.get("Bucket") == BENCH_ENV["S3_IMAGES_PROCESSED_BUCKET"]:
+            counter[event_name.rsplit(".", 1)[-1]] += 1
+    session.events.register("provide-client-params.s3", _count)
+
+
+def run_driver(run_id: str, extra_args) -> float:
+    from src.apps.data_pipeline import driver
+    argv = sys.argv
+    sys.argv = ["driver", "--run_id", run_id, *extra_args]
+    try:
+        t0 = time.perf_counter()
+        driver.main()
+        return time.perf_counter() - t0
+    finally:
+        sys.argv = argv
+
+
+def read_back(run_id: str):
+    from src.apps.data_pipeline.shards import load_patch
+    ddb = boto3.resource("dynamodb", region_name=BENCH_ENV["AWS_REGION"])
+    s3 = boto3.client("s3", region_name=BENCH_ENV["AWS_REGION"])
+    items = ddb.Table(BENCH_ENV["DDB_PATCHES_TABLE"]).scan()["Items"]
+    pixels = {}
+    for item in items:
+        key = (item["image_id"], item["patch_type"], int(item["patch_x"]), int(item["patch_y"]))
+        pixels[key] = load_patch(s3, item)
+    return pixels
+
+
+def main() -> None:
+    ap = argparse.ArgumentParser(description="Benchmark packed patch shards")
+    ap.add_argument("--images", type=int, default=20)
+    ap.add_argument("--shard-max-mb", type=int, default=4)
+    args = ap.parse_args()
+
+    use_bench_env()
+    results = {}
+    for layout, extra in (("objects", ["--shard_max_mb", "0"]), ("shards", ["--shard_max_mb", str(args.shard_max_mb)])):
+        with mock_aws():
+            create_resources()
+            seed_unprocessed(args.images)
+            boto3.setup_default_session()
+            counter: Counter = Counter()
+            count_requests(boto3.DEFAULT_SESSION, counter)
+            seconds = run_driver(f"bench-{layout}", extra)
+            writes = dict(counter)
+            counter.clear()
+            pixels = read_back(f"bench-{layout}")
+            results[layout] = (seconds, writes, dict(counter), pixels)
+
+    print(f"\n{args.images} images, shard size {args.shard_max_mb} MB")
+    print(f"{'layout':>8} {'seconds':>8} {'write requests':>15} {'read requests':>14}")
+    for layout, (seconds, writes, reads, _) in results.items():
+        print(f"{layout:>8} {seconds:>8.2f} {sum(writes.values()):>15} {sum(reads.values()):>14}  {writes}")
+
+    a, b = results["objects"][3], results["shards"][3]
+    assert a.keys() == b.keys()
+    for k in a:
+        assert np.array_equal(a[k], b[k]), k
+    print(f"read-back parity OK for {len(a)} patches")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,105 @@
+"""
+Storage backend benchmark -- the driver on S3 vs. on a local directory.
+
+Runs the driver end to end on a synthetic corpus once against moto S3, with
+every S3 request delayed by --rtt-ms, and then with --storage local:<tmpdir>
+(mmap reads, rename archiving), plain, with decode processes and with packed
+shards. DynamoDB is moto in every run, without added delay. Reports images/s
+and checks that every run writes the same records, that each run's patches
+read back from their patch_path / shard_uri, and that nothing is left under
+training/unprocessed/.
+
+Requires moto (pip install "moto[s3,dynamodb]").
+
+Usage:
+    python -m benchmarks.bench_storage [--images 40] [--rtt-ms 20]
+"""
+from __future__ import annotations
+
+import argparse
+import contextlib
+import io
+import os
+import tempfile
+
+import boto3
+from moto import mock_aws
+
+from benchmarks.aws import BENCH_ENV, add_latency, create_resources, use_bench_env
+from benchmarks.bench_shards import run_driver
+from benchmarks.corpus import seed_unprocessed
+from src.apps.data_pipeline.shards import load_patch
+from src.apps.data_pipeline.storage import LocalStorage, S3Storage
+
+CONFIGS = [
+    ("s3", None, []),
+    ("local", "local", []),
+    ("local procs", "local", ["--decode_processes", "2"]),
+    ("local shards", "local", ["--shard_max_mb", "4"]),
+]
+
+
+def run_once(name: str, backend, extra, images: int, rtt_ms: float, size) -> dict:
+    with mock_aws(), tempfile.TemporaryDirectory() as root:
+        create_resources()
+        boto3.setup_default_session()
+        add_latency(boto3.DEFAULT_SESSION, rtt_ms, event="before-send.s3")
+        s3 = boto3.client("s3", region_name=BENCH_ENV["AWS_REGION"])
+        if backend == "local":
+            storage = LocalStorage(root)
+            extra = ["--storage", f"local:{root}", *extra]
+        else:
+            storage = S3Storage(s3)
+        seed_unprocessed(images, size=size, storage=storage)
+
+        with contextlib.redirect_stdout(io.StringIO()):
+            seconds = run_driver(f"bench-{name.replace(' ', '-')}", extra)
+
+        ddb = boto3.resource("dynamodb", region_name=BENCH_ENV["AWS_REGION"])
+        records = ddb.Table(BENCH_ENV["DDB_PATCHES_TABLE"]).scan()["Items"]
+        # Every patch must read back from where its record says it is.
+        for record in records:
+            assert load_patch(s3, record).shape == (256, 256, 3), record["patch_path"]
+        raw = BENCH_ENV["S3_IMAGES_RAW_BUCKET"]
+        return {
+            "seconds": seconds,
+            "images": ddb.Table(BENCH_ENV["DDB_IMAGES_TABLE"]).scan(Select="COUNT")["Count"],
+            "patches": len(records),
+            "left": sum(1 for _ in storage.iter_objects(raw, "training/unprocessed/")),
+            "archived": sum(1 for _ in storage.iter_objects(raw, "training/processed/")),
+            "local_paths": all(r["patch_path"].startswith("file://") for r in records),
+        }
+
+
+def main() -> None:
+    ap = argparse.ArgumentParser(description="Benchmark the driver on S3 vs. local storage")
+    ap.add_argument("--images", type=int, default=40)
+    ap.add_argument("--rtt-ms", type=float, default=20.0)
+    ap.add_argument("--size", default="1600x1200")
+    args = ap.parse_args()
+    size = tuple(int(v) for v in args.size.split("x"))
+
+    use_bench_env()
+    results = {
+        name: run_once(name, backend, extra, args.images, args.rtt_ms, size)
+        for name, backend, extra in CONFIGS
+    }
+
+    base = results["s3"]["seconds"]
+    print(f"\n{args.images} images of {args.size}, S3 rtt {args.rtt_ms:.0f} ms, {os.cpu_count()} CPUs")
+    print(f"{'config':>13} {'seconds':>8} {'images/s':>9} {'speedup':>8} {'patches':>8}")
+    for name, r in results.items():
+        print(f"{name:>13} {r['seconds']:>8.2f} {args.images / r['seconds']:>9.2f} "
+              f"{base / r['seconds']:>7.2f}x {r['patches']:>8}")
+
+    expected = results["s3"]
+    for (name, backend, _), r in zip(CONFIGS, results.values()):
+        assert r["left"] == 0 and r["archived"] == args.images, f"{name}: {r['left']} left unprocessed"
+        assert (r["images"], r["patches"]) == (expected["images"], expected["patches"]), name
+        assert r["local_paths"] == (backend == "local"), f"{name}: patch paths point at the wrong storage"
+    print(f"\nall configs wrote {expected['images']} images / {expected['patches']} patch records "
+          f"that read back from their storage")
+
+
+if __name__ == "__main__":
+    main()
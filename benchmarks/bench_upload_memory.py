@@ -0,0 +1,113 @@
+"""
+/inference upload memory benchmark.
+
+Posts large JPEG uploads to the FastAPI app over ASGI against moto-backed S3
+and DynamoDB and reports, per request and for a few concurrent requests, the
+Python heap peak (tracemalloc) and the process RSS high-water mark (VmHWM,
+Linux only). Writes to the raw bucket are acknowledged without being stored
+(see discard_s3_writes). With the upload read from Starlette's spooled file
+instead of into one bytes object, the heap peak is bounded by the S3
+transfer's read-ahead rather than growing with the upload; the script asserts
+that, and that an upload over INFERENCE_MAX_UPLOAD_MB gets a 413 without being
+parsed.
+
+Requires moto (pip install "moto[s3,dynamodb]").
+
+Usage:
+    python -m benchmarks.bench_upload_memory [--size 8000x5000] [--concurrency 1 4]
+"""
+from __future__ import annotations
+
+import argparse
+import asyncio
+import os
+import time
+import tracemalloc
+from io import BytesIO
+
+import boto3
+from moto import mock_aws
+
+from benchmarks.aws import BENCH_ENV, create_resources, discard_s3_writes, use_bench_env
+from benchmarks.bench_decode import peak_rss_kb, photo_like
+from benchmarks.bench_inference_latency import asgi_post, multipart_body
+
+
+# uvicorn hands the body to the app in pieces of about this size.
+BODY_CHUNK = 64 * 1024
+
+
+def reset_peak_rss() -> None:
+    """Reset VmHWM to the current RSS (Linux 4.0+), so it covers only what follows."""
+    with open("/proc/self/clear_refs", "w") as f:
+        f.write("5")
+
+
+def large_jpeg(w: int, h: int) -> bytes:
+    buf = BytesIO()
+    photo_like(w, h).save(buf, format="JPEG", quality=98, subsampling=0)
+    return buf.getvalue()
+
+
+async def post_many(app, body: bytes, content_type: str, n: int):
+    return await asyncio.gather(*(
+        asgi_post(app, "/inference", body, content_type, chunk_size=BODY_CHUNK) for _ in range(n)
+    ))
+
+
+def main() -> None:
+    ap = argparse.ArgumentParser(description="Benchmark /inference upload memory")
+    ap.add_argument("--size", default="8000x5000")
+    ap.add_argument("--concurrency", type=int, nargs="+", default=[1, 4])
+    ap.add_argument("--max-upload-mb", type=int, default=64)
+    args = ap.parse_args()
+
+    use_bench_env()
+    os.environ["INFERENCE_MAX_UPLOAD_MB"] = str(args.max_upload_mb)
+    os.environ.pop("DDB_CONTENT_INDEX_TABLE", None)  # every request does the full work
+    from src.apps.backend import main as app_module
+    from src.apps.backend.uploads import RAW_UPLOAD_TRANSFER_CONFIG as cfg
+
+    # s3transfer reads ahead at most this much of each raw upload.
+    raw_buffer_mb = (cfg.max_in_memory_upload_chunks + 1) * cfg.multipart_chunksize / 2**20
+
+    w, h = (int(v) for v in args.size.split("x"))
+    data = large_jpeg(w, h)
+    body, content_type = multipart_body("large.jpg", data, "image/jpeg")
+    upload_mb = len(data) / 2**20
+
+    with mock_aws():
+        create_resources()
+        boto3.setup_default_session()
+        # Raw uploads are accepted but not kept, so moto's own copy of them
+        # does not count towards the heap peak.
+        discard_s3_writes(boto3.DEFAULT_SESSION, BENCH_ENV["S3_IMAGES_RAW_BUCKET"])
+
+        print(f"{args.size} JPEG upload, {upload_mb:.1f} MB")
+        print(f"{'concurrent':>10} {'wall ms':>9} {'heap peak MB':>13} {'heap/upload':>12} {'VmHWM MB':>9}")
+        for n in args.concurrency:
+            reset_peak_rss()
+            tracemalloc.start()
+            t0 = time.perf_counter()
+            results = asyncio.run(post_many(app_module.app, body, content_type, n))
+            wall = time.perf_counter() - t0
+            _, heap_peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+
+            assert all(status == 200 for status, _, _ in results), [r[0] for r in results]
+            heap_mb = heap_peak / 2**20
+            print(f"{n:>10} {wall * 1e3:>9.0f} {heap_mb:>13.1f} {heap_mb / (n * upload_mb):>12.2f} "
+                  f"{peak_rss_kb() / 1024:>9.0f}")
+            assert heap_mb < n * raw_buffer_mb + 16, "heap grew with the upload size"
+
+        oversized = b"\0" * ((args.max_upload_mb + 1) * 2**20)
+        big_body, big_type = multipart_body("huge.jpg", oversized, "image/jpeg")
+        status, resp_s, _ = asyncio.run(asgi_post(
+            app_module.app, "/inference", big_body, big_type, chunk_size=BODY_CHUNK,
+        ))
+        print(f"{args.max_upload_mb + 1} MB upload -> {status} in {resp_s * 1e3:.1f} ms")
+        assert status == 413, status
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,130 @@
+"""
+Synthetic image corpus for the benchmarks.
+
+make_corpus builds a deterministic mixed corpus: every extension the driver
+picks up (driver.IMAGE_EXTENSIONS), landscape and portrait sizes, and a share
+of grayscale and RGBA images so the decoders' conversion paths are exercised
+too. The same n and seed always give the same bytes (corpus_digest), so timings
+from different commits are taken on identical input.
+"""
+from __future__ import annotations
+
+import hashlib
+import random
+from dataclasses import dataclass
+from io import BytesIO
+from typing import List, Optional, Sequence, Tuple
+
+import boto3
+from PIL import Image
+
+from benchmarks.aws import BENCH_ENV
+from benchmarks.bench_decode import photo_like
+from src.apps.data_pipeline.storage import S3Storage
+
+# PIL format for each extension in driver.IMAGE_EXTENSIONS.
+CORPUS_FORMATS = {
+    ".jpg": "JPEG",
+    ".jpeg": "JPEG",
+    ".png": "PNG",
+    ".bmp": "BMP",
+    ".tiff": "TIFF",
+    ".webp": "WEBP",
+}
+CORPUS_SIZES: List[Tuple[int, int]] = [
+    (640, 480), (1024, 768), (1600, 1200), (1200, 1600), (2400, 1600), (3000, 2000),
+]
+
+
+@dataclass
+class CorpusImage:
+    key: str
+    extension: str
+    size: Tuple[int, int]
+    mode: str
+    data: bytes
+
+
+def encode_image(img: Image.Image, extension: str) -> bytes:
+    """img in the format of extension, with fixed encoder settings."""
+    fmt = CORPUS_FORMATS[extension]
+    buf = BytesIO()
+    if fmt == "JPEG":
+        img.save(buf, format=fmt, quality=90)
+    elif fmt == "WEBP":
+        img.save(buf, format=fmt, quality=90, method=4)
+    elif fmt == "PNG":
+        img.save(buf, format=fmt, compress_level=6)
+    else:
+        img.save(buf, format=fmt)
+    return buf.getvalue()
+
+
+def make_corpus(
+    n: int,
+    seed: int = 0,
+    sizes: Sequence[Tuple[int, int]] = CORPUS_SIZES,
+    extensions: Optional[Sequence[str]] = None,
+    prefix: str = "training/unprocessed",
+) -> List[CorpusImage]:
+    """
+    n images cycling through extensions (every CORPUS_FORMATS extension by
+    default), each at a size drawn from sizes. Every 7th image is grayscale,
+    and every 5th PNG/WEBP/TIFF has an alpha channel. Keys follow the upload
+    layout, {prefix}/{image_id}/{filename}.
+    """
+    extensions = list(extensions or CORPUS_FORMATS)
+    rng = random.Random(seed)
+    corpus = []
+    for i in range(n):
+        ext = extensions[i % len(extensions)]
+        w, h = rng.choice(list(sizes))
+        img = photo_like(w, h, seed=seed * 1_000_003 + i)
+        if i % 7 == 6 and CORPUS_FORMATS[ext] != "WEBP":
+            img = img.convert("L")
+        elif i % 5 == 4 and CORPUS_FORMATS[ext] in ("PNG", "WEBP", "TIFF"):
+            img.putalpha(img.getchannel("G"))
+        key = f"{prefix}/corpus-{seed:03d}-{i:06d}/image_{i:06d}{ext}"
+        corpus.append(CorpusImage(key, ext, (w, h), img.mode, encode_image(img, ext)))
+    return corpus
+
+
+def corpus_digest(corpus: Sequence[CorpusImage]) -> str:
+    """SHA-256 over the corpus keys and bytes, to check two runs used the same input."""
+    h = hashlib.sha256()
+    for image in corpus:
+        h.update(image.key.encode("utf-8"))
+        h.update(image.data)
+    return h.hexdigest()
+
+
+def seed_corpus(corpus: Sequence[CorpusImage], storage=None) -> List[str]:
+    """
+    Write corpus into the raw bucket. Call inside mock_aws(), or pass a
+    storage.Storage to write it there instead. Returns the keys.
+    """
+    if storage is None:
+        storage = S3Storage(boto3.client("s3", region_name=BENCH_ENV["AWS_REGION"]))
+    for image in corpus:
+        storage.put(BENCH_ENV["S3_IMAGES_RAW_BUCKET"], image.key, image.data)
+    return [image.key for image in corpus]
+
+
+def seed_unprocessed(
+    n: int, size=(1600, 1200), prefix: str = "training/unprocessed", storage=None,
+) -> List[str]:
+    """
+    Upload n JPEGs to {prefix}/{image_id}/{filename} in the raw bucket, as the
+    upload script does. Call inside mock_aws(), or pass a storage.Storage to
+    write them there instead. Returns the keys.
+    """
+    if storage is None:
+        storage = S3Storage(boto3.client("s3", region_name=BENCH_ENV["AWS_REGION"]))
+    keys = []
+    for i in range(n):
+        buf = BytesIO()
+        photo_like(*size, seed=i).save(buf, format="JPEG", quality=90)
+        key = f"{prefix}/bench-{i:06d}/image_{i:06d}.jpg"
+        storage.put(BENCH_ENV["S3_IMAGES_RAW_BUCKET"], key, buf.getvalue())
+        keys.append(key)
+    return keys
@@ -0,0 +1,258 @@
+"""
+Benchmark suite -- micro and end-to-end timings in one machine-readable file.
+
+Runs, on the deterministic corpus from corpus.py:
+
+    extract    extract_patches (center crop + grid, resize) per image size
+    encode     per-patch encode time for every format in encoding.PATCH_ENCODERS
+    decode     decode_image per raw format the driver accepts
+    process    process_image_to_patches, writing to LocalStorage (no network)
+    driver     driver.main end to end against moto S3 and DynamoDB, pipelined,
+               plus the same run on LocalStorage
+    inference  POST /inference (sync persistence) against moto, over ASGI
+
+Every result is a time in milliseconds, lower is better. They are written as
+JSON with the machine, library versions and corpus digest they were taken with.
+--baseline compares against an earlier file and lists every result more than
+--tolerance slower; with --check the exit status is 1 if there are any.
+benchmarks/baseline.json is the committed baseline; refresh it with
+--update-baseline on the same machine class after an intended change, since
+timings from different hardware are not comparable.
+
+Requires moto and the API's dependencies (pip install "moto[s3,dynamodb]").
+
+Usage:
+    python -m benchmarks.suite [--only extract,encode] [--quick]
+    python -m benchmarks.suite --baseline benchmarks/baseline.json --check
+    python -m benchmarks.suite --update-baseline
+"""
+from __future__ import annotations
+
+import argparse
+import asyncio
+import contextlib
+import io
+import json
+import os
+import platform
+import sys
+import tempfile
+import time
+from typing import Callable, Dict, List
+
+import boto3
+import numpy as np
+import PIL
+from moto import mock_aws
+
+from benchmarks.aws import BENCH_ENV, add_latency, create_resources, use_bench_env
+from benchmarks.bench_decode import photo_like
+from benchmarks.bench_inference_latency import asgi_post, multipart_body
+from benchmarks.bench_shards import run_driver
+from benchmarks.corpus import CORPUS_FORMATS, corpus_digest, make_corpus, seed_corpus
+from src.apps.data_pipeline.encoding import PATCH_ENCODERS
+from src.apps.data_pipeline.process import decode_image, extract_patches, process_image_to_patches
+from src.apps.data_pipeline.storage import LocalStorage
+
+BASELINE_PATH = os.path.join(os.path.dirname(__file__), "baseline.json")
+DEFAULT_TOLERANCE = 0.25
+
+# End-to-end runs use sizes that keep moto's in-process S3 from dominating.
+E2E_SIZES = [(640, 480), (1024, 768), (1600, 1200), (1200, 1600)]
+
+
+def best_ms(fn: Callable[[], object], repeat: int) -> float:
+    best = float("inf")
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        fn()
+        best = min(best, time.perf_counter() - t0)
+    return best * 1000.0
+
+
+def bench_extract(opts) -> Dict[str, float]:
+    results = {}
+    for w, h in [(1024, 768), (1600, 1200), (3000, 2000)]:
+        img = photo_like(w, h, seed=1)
+        results[f"extract.{w}x{h}"] = best_ms(lambda: extract_patches(img), opts.repeat)
+    return results
+
+
+def bench_encode(opts) -> Dict[str, float]:
+    batch, _ = extract_patches(photo_like(1600, 1200, seed=2))
+    results = {}
+    for name, enc in PATCH_ENCODERS.items():
+        total_ms = best_ms(lambda: [enc.encode(p) for p in batch], opts.repeat)
+        results[f"encode.{name}_per_patch"] = total_ms / len(batch)
+    return results
+
+
+def bench_decode(opts) -> Dict[str, float]:
+    # One image per extension, all the same size, so formats compare directly.
+    corpus = make_corpus(len(CORPUS_FORMATS), seed=3, sizes=[(1600, 1200)])
+    return {
+        f"decode.{image.extension.lstrip('.')}": best_ms(lambda: decode_image(image.data), opts.repeat)
+        for image in corpus
+    }
+
+
+def bench_process(opts) -> Dict[str, float]:
+    img = photo_like(1600, 1200, seed=4)
+    with tempfile.TemporaryDirectory() as root:
+        storage = LocalStorage(root)
+
+        def run() -> None:
+            process_image_to_patches(
+                img=img, image_id="bench", processed_bucket="processed", processed_prefix="training",
+                s3_client=storage, source_size=img.size,
+            )
+
+        return {"process_image_to_patches.1600x1200": best_ms(run, opts.repeat)}
+
+
+def _driver_run(corpus, rtt_ms: float, extra: List[str], local_root: str = "") -> float:
+    with mock_aws():
+        create_resources()
+        boto3.setup_default_session()
+        add_latency(boto3.DEFAULT_SESSION, rtt_ms)
+        seed_corpus(corpus, storage=LocalStorage(local_root) if local_root else None)
+        if local_root:
+            extra = [*extra, "--storage", f"local:{local_root}"]
+        with contextlib.redirect_stdout(io.StringIO()):
+            seconds = run_driver("bench-suite", extra)
+        ddb = boto3.resource("dynamodb", region_name=BENCH_ENV["AWS_REGION"])
+        images = ddb.Table(BENCH_ENV["DDB_IMAGES_TABLE"]).scan(Select="COUNT")["Count"]
+        assert images == len(corpus), f"driver wrote {images} of {len(corpus)} image records"
+    return seconds
+
+
+def bench_driver(opts) -> Dict[str, float]:
+    corpus = make_corpus(opts.images, seed=5, sizes=E2E_SIZES)
+    s3_s = _driver_run(corpus, opts.rtt_ms, [])
+    with tempfile.TemporaryDirectory() as root:
+        local_s = _driver_run(corpus, opts.rtt_ms, [], local_root=root)
+    return {
+        "driver.s3_per_image": s3_s * 1000.0 / len(corpus),
+        "driver.local_per_image": local_s * 1000.0 / len(corpus),
+    }
+
+
+def bench_inference(opts) -> Dict[str, float]:
+    from src.apps.backend import main as app_module
+
+    # Distinct images, so no request is answered from the content index; the
+    # first one warms up the model and clients and is not counted.
+    corpus = make_corpus(opts.requests + 1, seed=6, sizes=[(1600, 1200)], extensions=[".jpg"])
+    app_module.INFERENCE_PERSIST_MODE = "sync"
+    latencies = []
+    with mock_aws():
+        create_resources()
+        boto3.setup_default_session()
+        add_latency(boto3.DEFAULT_SESSION, opts.rtt_ms)
+        for image in corpus:
+            body, content_type = multipart_body("bench.jpg", image.data, "image/jpeg")
+            status, responded_s, _ = asyncio.run(asgi_post(app_module.app, "/inference", body, content_type))
+            assert status == 200, status
+            latencies.append(responded_s * 1000.0)
+    latencies = latencies[1:]
+    return {
+        "inference.p50": float(np.percentile(latencies, 50)),
+        "inference.mean": float(np.mean(latencies)),
+    }
+
+
+BENCHMARKS: Dict[str, Callable] = {
+    "extract": bench_extract,
+    "encode": bench_encode,
+    "decode": bench_decode,
+    "process": bench_process,
+    "driver": bench_driver,
+    "inference": bench_inference,
+}
+
+
+def environment(opts) -> Dict:
+    return {
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "machine": platform.machine(),
+        "cpus": os.cpu_count(),
+        "pillow": PIL.__version__,
+        "numpy": np.__version__,
+        "driver_corpus": corpus_digest(make_corpus(opts.images, seed=5, sizes=E2E_SIZES)),
+        "options": {"repeat": opts.repeat, "images": opts.images, "requests": opts.requests,
+                    "rtt_ms": opts.rtt_ms},
+    }
+
+
+def compare(results: Dict[str, float], baseline: Dict[str, float], tolerance: float) -> List[str]:
+    """Print results next to baseline; return the names more than tolerance slower."""
+    regressions = []
+    print(f"\n{'benchmark':>36} {'ms':>10} {'baseline':>10} {'change':>8}")
+    for name, value in results.items():
+        base = baseline.get(name)
+        if base is None:
+            print(f"{name:>36} {value:>10.3f} {'-':>10} {'new':>8}")
+            continue
+        change = value / base - 1 if base > 0 else 0.0
+        flag = ""
+        if change > tolerance:
+            regressions.append(name)
+            flag = "  REGRESSION"
+        print(f"{name:>36} {value:>10.3f} {base:>10.3f} {change:>+8.0%}{flag}")
+    return regressions
+
+
+def main() -> None:
+    ap = argparse.ArgumentParser(description="Run the ArtGuard benchmark suite")
+    ap.add_argument("--only", default="", help=f"Comma-separated subset of: {', '.join(BENCHMARKS)}")
+    ap.add_argument("--quick", action="store_true", help="Fewer repeats, images and requests")
+    ap.add_argument("--repeat", type=int, default=5)
+    ap.add_argument("--images", type=int, default=24)
+    ap.add_argument("--requests", type=int, default=10)
+    ap.add_argument("--rtt-ms", type=float, default=5.0)
+    ap.add_argument("--out", help="Write the results to this JSON file")
+    ap.add_argument("--baseline", help="Compare with this results file")
+    ap.add_argument("--tolerance", type=float, default=DEFAULT_TOLERANCE,
+                    help="Slowdown (fraction) past which a result counts as a regression")
+    ap.add_argument("--check", action="store_true", help="Exit with status 1 on any regression")
+    ap.add_argument("--update-baseline", action="store_true", help=f"Write the results to {BASELINE_PATH}")
+    opts = ap.parse_args()
+    if opts.quick:
+        opts.repeat, opts.images, opts.requests = 2, 12, 5
+
+    names = [n.strip() for n in opts.only.split(",") if n.strip()] or list(BENCHMARKS)
+    unknown = set(names) - set(BENCHMARKS)
+    if unknown:
+        ap.error(f"Unknown benchmarks {sorted(unknown)}; expected some of {list(BENCHMARKS)}")
+
+    use_bench_env()
+    results: Dict[str, float] = {}
+    for name in names:
+        t0 = time.perf_counter()
+        results.update(BENCHMARKS[name](opts))
+        print(f"{name}: {time.perf_counter() - t0:.1f} s", file=sys.stderr)
+
+    doc = {"environment": environment(opts), "results": results}
+    for path in filter(None, [opts.out, BASELINE_PATH if opts.update_baseline else None]):
+        with open(path, "w") as f:
+            json.dump(doc, f, indent=2, sort_keys=True)
+            f.write("\n")
+        print(f"wrote {path}", file=sys.stderr)
+
+    baseline: Dict[str, float] = {}
+    if opts.baseline:
+        with open(opts.baseline) as f:
+            base_doc = json.load(f)
+        baseline = base_doc["results"]
+        if base_doc["environment"].get("driver_corpus") != doc["environment"]["driver_corpus"]:
+            print("note: the baseline was taken on a different driver corpus", file=sys.stderr)
+    regressions = compare(results, baseline, opts.tolerance)
+    if regressions:
+        print(f"\n{len(regressions)} regression(s) over {opts.tolerance:.0%}: {', '.join(regressions)}")
+        if opts.check:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -253,6 +253,11 @@ resource "aws_ecs_task_definition" "backend" {
           name  = "S3_KNOWLEDGE_BASE_BUCKET"
           value = aws_s3_bucket.knowledge_base.id
         },
+        # /inference jobs whose persistence failed, kept for replay
+        {
+          name  = "INFERENCE_PERSIST_FAILURE_URI"
+          value = "s3://${aws_s3_bucket.images_raw.id}/persist_failures"
+        },
         # DynamoDB Tables
         {
           name  = "DDB_USERS_TABLE"
@@ -278,6 +283,14 @@ resource "aws_ecs_task_definition" "backend" {
           name  = "DDB_CONFIGS_TABLE"
           value = aws_dynamodb_table.config_records.name
         },
+        {
+          name  = "DDB_CONTENT_INDEX_TABLE"
+          value = aws_dynamodb_table.content_index.name
+        },
+        {
+          name  = "DDB_RAG_CACHE_TABLE"
+          value = aws_dynamodb_table.rag_cache.name
+        },
         # Legacy (for backward compatibility)
         {
           name  = "DYNAMODB_TABLE_NAME"
@@ -262,3 +262,58 @@ resource "aws_dynamodb_table" "config_records" {
     Environment = var.environment
   }
 }
+
+# Table 7: ContentIndex
+# Maps the SHA-256 of raw upload bytes to the image (and latest inference) that
+# already holds them, so repeated uploads are linked instead of reprocessed
+resource "aws_dynamodb_table" "content_index" {
+  name         = "${local.project_name}-content-index-${var.environment}"
+  billing_mode = "PAY_PER_REQUEST"
+  hash_key     = "content_hash"
+
+  attribute {
+    name = "content_hash"
+    type = "S"
+  }
+
+  point_in_time_recovery {
+    enabled = var.environment == "prod"
+  }
+
+  server_side_encryption {
+    enabled = true
+  }
+
+  tags = {
+    Name        = "${local.project_name}-content-index"
+    Environment = var.environment
+  }
+}
+
+# Table 8: RagCache
+# /rag-query responses keyed by the normalized query, knowledge base and model,
+# shared by every API worker; DynamoDB deletes them once expires_at has passed
+resource "aws_dynamodb_table" "rag_cache" {
+  name         = "${local.project_name}-rag-cache-${var.environment}"
+  billing_mode = "PAY_PER_REQUEST"
+  hash_key     = "cache_key"
+
+  attribute {
+    name = "cache_key"
+    type = "S"
+  }
+
+  ttl {
+    attribute_name = "expires_at"
+    enabled        = true
+  }
+
+  server_side_encryption {
+    enabled = true
+  }
+
+  tags = {
+    Name        = "${local.project_name}-rag-cache"
+    Environment = var.environment
+  }
+}
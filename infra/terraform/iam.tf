@@ -93,6 +93,7 @@ resource "aws_iam_policy" "ecs_task_policy" {
           "s3:GetObject",
           "s3:PutObject",
           "s3:DeleteObject",
+          "s3:AbortMultipartUpload",
           "s3:ListBucket"
         ]
         Resource = [
@@ -127,7 +128,9 @@ resource "aws_iam_policy" "ecs_task_policy" {
           aws_dynamodb_table.run_records.arn,
           "${aws_dynamodb_table.run_records.arn}/index/*",
           aws_dynamodb_table.config_records.arn,
-          "${aws_dynamodb_table.config_records.arn}/index/*"
+          "${aws_dynamodb_table.config_records.arn}/index/*",
+          aws_dynamodb_table.content_index.arn,
+          aws_dynamodb_table.rag_cache.arn
         ]
       },
       # Bedrock Access
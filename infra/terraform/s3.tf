@@ -148,6 +148,20 @@ resource "aws_s3_bucket_lifecycle_configuration" "images_raw" {
       days = var.s3_inference_expiration_days
     }
   }
+
+  # Inference uploads waiting for a persist replay: same retention as above
+  rule {
+    id     = "delete-persist-failures"
+    status = "Enabled"
+
+    filter {
+      prefix = "persist_failures/"
+    }
+
+    expiration {
+      days = var.s3_inference_expiration_days
+    }
+  }
 }
 
 # Resource-Based Policy for Raw Images Bucket
@@ -0,0 +1,137 @@
+"""
+Dynamic micro-batching of patches for the model.
+
+A forward pass over 64 patches costs far less than 64 passes over one image's
+few patches, but each request only has its own. MicroBatcher runs the model on
+one thread that takes requests' patch batches from a queue: the first one
+opens a batch, which then collects whatever else arrives until it holds
+MODEL_MAX_BATCH_PATCHES patches or MODEL_MAX_WAIT_MS have passed, and goes
+through the model in one pass. Under load batches fill up without waiting.
+When the last pass scored a single request and nothing else is queued, there
+is no one to wait for and the request is scored at once.
+
+swap_model() replaces the model between two passes without pausing: queued
+requests go through the new one, and each result names the model that
+produced it.
+"""
+from __future__ import annotations
+
+import os
+import queue
+import threading
+import time
+from concurrent.futures import Future
+from typing import Dict, List, Tuple
+
+import numpy as np
+
+MODEL_MAX_BATCH_PATCHES = int(os.getenv("MODEL_MAX_BATCH_PATCHES", "64"))
+MODEL_MAX_WAIT_MS = float(os.getenv("MODEL_MAX_WAIT_MS", "5"))
+
+
+class MicroBatcher:
+    """
+    Scores patch batches from many threads in shared forward passes of model
+    (anything with predict(patches) -> scores and a name, see model.py).
+    """
+
+    def __init__(
+        self,
+        model,
+        max_batch_patches: int = MODEL_MAX_BATCH_PATCHES,
+        max_wait_ms: float = MODEL_MAX_WAIT_MS,
+    ):
+        self.model = model
+        self.max_batch_patches = max_batch_patches
+        self.max_wait_s = max_wait_ms / 1000.0
+        self.batches = 0
+        self.requests = 0
+        self.patches = 0
+        self.busy_s = 0.0
+        self._last_requests = 0
+        self._queue: "queue.Queue" = queue.Queue()
+        self._closed = False
+        self._thread = threading.Thread(target=self._run, name="model-batcher", daemon=True)
+        self._thread.start()
+
+    def submit(self, patches: np.ndarray) -> Future:
+        """
+        Queue a (N, H, W, 3) patch batch. The future resolves to (its N scores,
+        the name of the model that scored them).
+        """
+        if self._closed:
+            raise RuntimeError("MicroBatcher is closed")
+        future: Future = Future()
+        self._queue.put((patches, future))
+        return future
+
+    def swap_model(self, model) -> None:
+        """Score every pass from the next one on with model."""
+        self.model = model
+
+    def close(self) -> None:
+        """Score what is queued, then stop the model thread."""
+        self._closed = True
+        self._queue.put(None)
+        self._thread.join()
+
+    def _run(self) -> None:
+        while True:
+            first = self._queue.get()
+            if first is None:
+                return
+            pending = [first]
+            size = len(first[0])
+            wait_s = self.max_wait_s if self._last_requests > 1 or not self._queue.empty() else 0.0
+            deadline = time.monotonic() + wait_s
+            closing = False
+            while size < self.max_batch_patches:
+                timeout = deadline - time.monotonic()
+                try:
+                    item = self._queue.get(timeout=timeout) if timeout > 0 else self._queue.get_nowait()
+                except queue.Empty:
+                    break
+                if item is None:
+                    closing = True
+                    break
+                pending.append(item)
+                size += len(item[0])
+            self._forward(pending)
+            if closing:
+                return
+
+    def _forward(self, pending: List[Tuple[np.ndarray, Future]]) -> None:
+        pending = [(patches, f) for patches, f in pending if f.set_running_or_notify_cancel()]
+        if not pending:
+            return
+        # One model for the whole pass, even if it is swapped meanwhile.
+        model = self.model
+        t0 = time.perf_counter()
+        try:
+            batch = pending[0][0] if len(pending) == 1 else np.concatenate([p for p, _ in pending])
+            # A batch can end up past the limit when its last request is large.
+            step = self.max_batch_patches
+            scores = np.concatenate([model.predict(batch[i:i + step]) for i in range(0, len(batch), step)])
+        except Exception as exc:
+            for _, f in pending:
+                f.set_exception(exc)
+            return
+        finally:
+            self.busy_s += time.perf_counter() - t0
+            self.batches += 1
+            self.requests += len(pending)
+            self._last_requests = len(pending)
+        self.patches += len(batch)
+        offset = 0
+        for patches, f in pending:
+            f.set_result((scores[offset:offset + len(patches)], model.name))
+            offset += len(patches)
+
+    def to_dict(self) -> Dict:
+        return {
+            "batches": self.batches,
+            "requests": self.requests,
+            "patches": self.patches,
+            "mean_batch_patches": self.patches / self.batches if self.batches else 0.0,
+            "busy_s": self.busy_s,
+        }
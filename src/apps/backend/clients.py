@@ -0,0 +1,143 @@
+"""
+AWS clients for the API, created once per process.
+
+Creating a boto3 client loads the service model, resolves credentials and
+starts a new connection pool, which costs tens of milliseconds and CPU on every
+request that does it. AWSClients holds one client per service, the DynamoDB
+resource and its Table objects for the app's lifetime: the lifespan hook in
+main.py creates it at startup and closes it at shutdown, and handlers get it
+from aws_clients(). boto3 clients are thread-safe, so one set serves every
+request and worker thread.
+
+Each service's connection pool is sized for API_CONCURRENCY requests at once:
+an /inference request uploads its patches on PATCH_UPLOAD_WORKERS threads, and
+the RAW_UPLOAD_WORKERS raw uploads use several connections each.
+API_POOL_CONNECTIONS overrides single services, e.g. "s3=128,dynamodb=32".
+S3 and DynamoDB requests go through the process-wide rate limiters (see
+data_pipeline/ratelimit.py).
+"""
+from __future__ import annotations
+
+import os
+import threading
+from typing import Dict, Optional
+
+import boto3
+from botocore.config import Config
+
+from src.apps.backend.uploads import RAW_UPLOAD_TRANSFER_CONFIG, RAW_UPLOAD_WORKERS
+from src.apps.data_pipeline.process import PATCH_UPLOAD_WORKERS, s3_client_config
+from src.apps.data_pipeline.ratelimit import limit_client
+
+API_CONCURRENCY = int(os.getenv("API_CONCURRENCY", "16"))
+API_POOL_CONNECTIONS = os.getenv("API_POOL_CONNECTIONS", "")
+
+DEFAULT_POOL_CONNECTIONS: Dict[str, int] = {
+    "s3": (
+        RAW_UPLOAD_WORKERS * RAW_UPLOAD_TRANSFER_CONFIG.max_request_concurrency
+        + API_CONCURRENCY * PATCH_UPLOAD_WORKERS
+    ),
+    # Content index lookups and the persistence writes.
+    "dynamodb": 2 * API_CONCURRENCY,
+    "bedrock-agent-runtime": API_CONCURRENCY,
+    "ecs": 10,
+}
+
+# Services whose requests go through the shared rate limiter.
+RATE_LIMITED_SERVICES = {"s3", "dynamodb"}
+
+
+def parse_pool_connections(spec: str, defaults: Dict[str, int]) -> Dict[str, int]:
+    """
+    Parse "s3=128,dynamodb=32" into per-service pool sizes on top of defaults.
+    Raises ValueError for unknown services or sizes below 1.
+    """
+    sizes = dict(defaults)
+    for part in filter(None, (p.strip() for p in spec.split(","))):
+        name, _, count = part.partition("=")
+        name = name.strip()
+        if name not in sizes:
+            raise ValueError(f"Unknown service {name!r}; expected one of {sorted(sizes)}")
+        if not count.strip().isdigit() or int(count) < 1:
+            raise ValueError(f"Pool size for {name!r} must be a positive integer, got {count!r}")
+        sizes[name] = int(count)
+    return sizes
+
+
+class AWSClients:
+    """One boto3 client per service, the DynamoDB resource and its tables."""
+
+    def __init__(self, region: Optional[str], pool_connections: Dict[str, int], session=None):
+        self.region = region
+        self.pool_connections = pool_connections
+        if session is None:
+            # boto3's default session, as boto3.client() would use.
+            if boto3.DEFAULT_SESSION is None:
+                boto3.setup_default_session()
+            session = boto3.DEFAULT_SESSION
+        self._session = session
+        self._clients: Dict[str, object] = {}
+        self._tables: Dict[str, object] = {}
+        # boto3 sessions are not thread-safe; everything is created under the lock.
+        self._lock = threading.Lock()
+        self._dynamodb = None
+
+    @classmethod
+    def from_env(cls) -> "AWSClients":
+        clients = cls(
+            os.getenv("AWS_REGION"),
+            parse_pool_connections(API_POOL_CONNECTIONS, DEFAULT_POOL_CONNECTIONS),
+        )
+        # The clients every /inference request needs, so the first one does
+        # not pay for them.
+        clients.client("s3")
+        for var in ("DDB_INFERENCES_TABLE", "DDB_IMAGES_TABLE", "DDB_PATCHES_TABLE", "DDB_RUNS_TABLE"):
+            if os.getenv(var):
+                clients.table(os.environ[var])
+        return clients
+
+    def _config(self, service: str) -> Config:
+        size = self.pool_connections.get(service, 10)
+        return s3_client_config(size) if service == "s3" else Config(max_pool_connections=size)
+
+    def client(self, service: str):
+        client = self._clients.get(service)
+        if client is None:
+            with self._lock:
+                client = self._clients.get(service)
+                if client is None:
+                    client = self._session.client(service, region_name=self.region, config=self._config(service))
+                    if service in RATE_LIMITED_SERVICES:
+                        limit_client(client)
+                    self._clients[service] = client
+        return client
+
+    @property
+    def dynamodb(self):
+        if self._dynamodb is None:
+            with self._lock:
+                if self._dynamodb is None:
+                    ddb = self._session.resource(
+                        "dynamodb", region_name=self.region, config=self._config("dynamodb"),
+                    )
+                    limit_client(ddb.meta.client)
+                    self._dynamodb = ddb
+        return self._dynamodb
+
+    def table(self, name: str):
+        table = self._tables.get(name)
+        if table is None:
+            ddb = self.dynamodb
+            with self._lock:
+                table = self._tables.setdefault(name, ddb.Table(name))
+        return table
+
+    def close(self) -> None:
+        """Close every client's connection pool."""
+        with self._lock:
+            clients = list(self._clients.values())
+            if self._dynamodb is not None:
+                clients.append(self._dynamodb.meta.client)
+            self._clients, self._tables, self._dynamodb = {}, {}, None
+        for client in clients:
+            client.close()
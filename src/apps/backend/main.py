@@ -1,22 +1,158 @@
 from fastapi import FastAPI, UploadFile, File, HTTPException, Header, BackgroundTasks
 from fastapi.middleware.cors import CORSMiddleware
 from pydantic import BaseModel
+import asyncio
 import subprocess
-import boto3
 import json
 import os, time
 import uuid
-from typing import Optional, List
+from concurrent.futures import Future, ThreadPoolExecutor
+from contextlib import asynccontextmanager
+from dataclasses import dataclass
+from functools import lru_cache
+from typing import BinaryIO, Dict, Optional, List, Tuple, Union
 from PIL import Image
-from io import BytesIO
 import base64
 import requests
-from src.apps.data_pipeline.process import process_inference_image
-
-app = FastAPI(title="ArtGuard API", version="1.0.0")
+import numpy as np
+from src.apps.data_pipeline.encoding import get_patch_encoder
+from src.apps.data_pipeline.process import (
+    PATCH_FORMAT,
+    decode_image,
+    extract_patches,
+    plan_patch_uploads,
+)
+from src.apps.data_pipeline.procpool import DecodePool
+from src.apps.data_pipeline.dedup import content_hash_fileobj, make_content_index
+from src.apps.data_pipeline.runs import create_run, get_run, set_shard_task, shard_name
+from src.apps.backend.batching import MicroBatcher
+from src.apps.backend.clients import AWSClients
+from src.apps.backend.model import MODEL_PATH, combine_patch_scores, load_model
+from src.apps.backend.ragcache import make_rag_cache, rag_cache_key
+from src.apps.backend.registry import MODEL_REGISTRY, ModelRegistry
+from src.apps.backend.offload import API_DECODE_PROCESSES, run_cpu, run_io
+from src.apps.backend.persist import (
+    InferencePersistJob,
+    PersistError,
+    persist_inference,
+    persist_inference_in_background,
+    persist_inferences,
+    persist_inferences_in_background,
+)
+from src.apps.backend.uploads import (
+    BATCH_MAX_UPLOAD_MB,
+    MAX_UPLOAD_MB,
+    RAW_UPLOAD_WORKERS,
+    UploadLimitMiddleware,
+    open_spool_reader,
+    spool_size,
+    upload_raw_stream,
+)
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Clients are created once per process and shared by every request.
+    app.state.aws = AWSClients.from_env()
+    # The model is loaded once, here, rather than by the first request.
+    model_batcher()
+    pool = decode_pool()
+    if pool is not None:
+        pool.warm_up()
+    yield
+    registry = getattr(app.state, "model_registry", None)
+    if registry is not None:
+        registry.close()
+        app.state.model_registry = None
+    batcher = getattr(app.state, "model_batcher", None)
+    if batcher is not None:
+        batcher.close()
+        app.state.model_batcher = None
+    app.state.aws.close()
+    app.state.aws = None
+    get_content_index.cache_clear()
+    get_rag_cache.cache_clear()
+    if pool is not None:
+        pool.close()
+        app.state.decode_pool = None
+
+app = FastAPI(title="ArtGuard API", version="1.0.0", lifespan=lifespan)
+app.add_middleware(UploadLimitMiddleware, max_bytes=MAX_UPLOAD_MB * 1024 * 1024, paths={"/inference"})
+app.add_middleware(
+    UploadLimitMiddleware, max_bytes=BATCH_MAX_UPLOAD_MB * 1024 * 1024, paths={"/inference/batch"},
+)
 
 ENVIRONMENT = "dev"
 
+# "sync" persists every /inference upload before responding; "background"
+# responds as soon as the image is scored and persists afterwards.
+INFERENCE_PERSIST_MODE = os.getenv("INFERENCE_PERSIST_MODE", "sync")
+
+# Most files one /inference/batch request may carry.
+INFERENCE_BATCH_MAX_FILES = int(os.getenv("INFERENCE_BATCH_MAX_FILES", "32"))
+
+raw_upload_pool = ThreadPoolExecutor(max_workers=RAW_UPLOAD_WORKERS)
+
+
+def aws_clients() -> AWSClients:
+    """
+    The app's AWS clients (see clients.py). The lifespan hook creates them;
+    without it (e.g. an app driven directly over ASGI) the first call does.
+    """
+    clients = getattr(app.state, "aws", None)
+    if clients is None:
+        clients = app.state.aws = AWSClients.from_env()
+    return clients
+
+
+def decode_pool() -> Optional[DecodePool]:
+    """
+    The decode worker processes when API_DECODE_PROCESSES > 0 (see offload.py),
+    else None and images are decoded on the CPU threads.
+    """
+    if API_DECODE_PROCESSES <= 0:
+        return None
+    pool = getattr(app.state, "decode_pool", None)
+    if pool is None:
+        pool = app.state.decode_pool = DecodePool(API_DECODE_PROCESSES)
+    return pool
+
+def model_batcher() -> Optional[MicroBatcher]:
+    """
+    The micro-batcher in front of the served model (see batching.py): the one
+    at MODEL_PATH if set, else the registry's. None while there is no model
+    and scores are placeholders.
+    """
+    if not MODEL_PATH:
+        registry = model_registry()
+        return registry.batcher if registry is not None else None
+    batcher = getattr(app.state, "model_batcher", None)
+    if batcher is None:
+        batcher = app.state.model_batcher = MicroBatcher(load_model(MODEL_PATH))
+    return batcher
+
+def serving_model_version() -> Optional[str]:
+    """The name of the model new requests are scored with; None for placeholder scores."""
+    batcher = model_batcher()
+    return batcher.model.name if batcher is not None else None
+
+def model_registry() -> Optional[ModelRegistry]:
+    """
+    The registry that serves the best config of the training runs and swaps
+    in new ones (see registry.py), unless MODEL_PATH pins a model or
+    MODEL_REGISTRY=0.
+    """
+    runs_table, configs_table = os.getenv("DDB_RUNS_TABLE"), os.getenv("DDB_CONFIGS_TABLE")
+    if MODEL_PATH or not MODEL_REGISTRY or not runs_table or not configs_table:
+        return None
+    registry = getattr(app.state, "model_registry", None)
+    if registry is None:
+        aws = aws_clients()
+        registry = app.state.model_registry = ModelRegistry(
+            aws.table(runs_table), aws.table(configs_table), aws.client("s3"),
+        )
+        registry.start()
+    return registry
+
 @app.get("/health")
 async def health_check():
     """Health check endpoint"""
@@ -34,65 +170,136 @@ async def root():
         }
     }
 
+# Upper bound on the number of driver tasks one /process_data call may launch.
+PROCESS_DATA_MAX_SHARDS = int(os.getenv("PROCESS_DATA_MAX_SHARDS", "32"))
+
+class ProcessDataRequest(BaseModel):
+    num_shards: int = 1
+    # Relaunch the unfinished shards of this run instead of starting a new one.
+    resume_run_id: Optional[str] = None
+
 class ProcessDataResponse(BaseModel):
     run_id: str
     task_arn: str
+    num_shards: int = 1
+    task_arns: List[str] = []
 
 @app.post("/process_data", response_model=ProcessDataResponse)
-async def process_data():
+def process_data(body: Optional[ProcessDataRequest] = None):
     cluster = os.getenv("ECS_CLUSTER", "artguard-cluster")
     task_def = os.getenv("ECS_PROCESS_TASK_DEF_ARN")
     subnets = os.getenv("ECS_PRIVATE_SUBNETS", "")
     security_groups = os.getenv("ECS_TASK_SECURITY_GROUPS", "")
     container_name = os.getenv("ECS_PROCESS_CONTAINER_NAME", "backend")
+    num_shards = body.num_shards if body is not None else 1
+    resume_run_id = body.resume_run_id if body is not None else None
 
     if not task_def:
         raise HTTPException(status_code=500, detail="ECS_PROCESS_TASK_DEF_ARN not configured")
     if not subnets or not security_groups:
         raise HTTPException(status_code=500, detail="ECS_PRIVATE_SUBNETS / ECS_TASK_SECURITY_GROUPS not configured")
+    if not 1 <= num_shards <= PROCESS_DATA_MAX_SHARDS:
+        raise HTTPException(status_code=400, detail=f"num_shards must be between 1 and {PROCESS_DATA_MAX_SHARDS}")
+
+    runs_table = aws_clients().table(os.getenv("DDB_RUNS_TABLE"))
+    if resume_run_id:
+        # The drivers skip what the run's progress manifest records as done.
+        run = get_run(runs_table, resume_run_id)
+        if run is None:
+            raise HTTPException(status_code=404, detail="Run not found")
+        run_id = resume_run_id
+        num_shards = int(run.get("num_shards", 1))
+        shards = run.get("shards") or {}
+        shard_indexes = [i for i in range(num_shards) if shards.get(shard_name(i), {}).get("status") != "completed"]
+        if not shard_indexes:
+            raise HTTPException(status_code=409, detail="Run already completed")
+        run_arg = ["--resume_run_id", run_id]
+    else:
+        run_id = str(uuid.uuid4())
+        create_run(runs_table, run_id, num_shards)
+        shard_indexes = list(range(num_shards))
+        run_arg = ["--run_id", run_id]
+
+    # One task per shard; each takes the unprocessed keys that hash to its index.
+    ecs = aws_clients().client("ecs")
+    task_arns: List[str] = []
+    failures: List[dict] = []
+    for shard_index in shard_indexes:
+        command = [
+            "python", "-m",
+            "src.apps.data_pipeline.driver",
+            *run_arg,
+            "--shard_index", str(shard_index),
+            "--num_shards", str(num_shards),
+        ]
+        resp = ecs.run_task(
+            cluster=cluster,
+            taskDefinition=task_def,
+            launchType="FARGATE",
+            networkConfiguration={
+                "awsvpcConfiguration": {
+                    "subnets": [s.strip() for s in subnets.split(",") if s.strip()],
+                    "securityGroups": [sg.strip() for sg in security_groups.split(",") if sg.strip()],
+                    "assignPublicIp": "DISABLED",
+                }
+            },
+            overrides={
+                "containerOverrides": [
+                    {
+                        "name": container_name,
+                        "command": command,
+                        "environment": [
+                            {"name": "RUN_ID", "value": run_id},
+                        ],
+                    }
+                ]
+            },
+        )
 
-    run_id = str(uuid.uuid4())
-    command = [
-        "python", "-m",
-        "src.apps.data_pipeline.driver",
-        "--run_id", run_id,
-    ]
+        tasks = resp.get("tasks") or []
+        task_arn = tasks[0]["taskArn"] if tasks else None
+        failures.extend(resp.get("failures") or [])
+        set_shard_task(runs_table, run_id, shard_index, task_arn)
+        if task_arn:
+            task_arns.append(task_arn)
 
-    ecs = boto3.client("ecs", region_name=os.getenv("AWS_REGION"))
-    resp = ecs.run_task(
-        cluster=cluster,
-        taskDefinition=task_def,
-        launchType="FARGATE",
-        networkConfiguration={
-            "awsvpcConfiguration": {
-                "subnets": [s.strip() for s in subnets.split(",") if s.strip()],
-                "securityGroups": [sg.strip() for sg in security_groups.split(",") if sg.strip()],
-                "assignPublicIp": "DISABLED",
-            }
-        },
-        overrides={
-            "containerOverrides": [
-                {
-                    "name": container_name,
-                    "command": command,
-                    "environment": [
-                        {"name": "RUN_ID", "value": run_id},
-                    ],
-                }
-            ]
-        },
-    )
+    if not task_arns:
+        raise HTTPException(status_code=500, detail={"ecs_failures": failures} if failures else "No ECS task started")
 
-    failures = resp.get("failures") or []
-    if failures:
-        raise HTTPException(status_code=500, detail={"ecs_failures": failures})
+    return ProcessDataResponse(run_id=run_id, task_arn=task_arns[0], num_shards=num_shards, task_arns=task_arns)
 
-    tasks = resp.get("tasks") or []
-    if not tasks:
-        raise HTTPException(status_code=500, detail="No ECS task started")
+class ProcessDataStatusResponse(BaseModel):
+    run_id: str
+    status: str
+    num_shards: int
+    shards_finished: int
+    images_total: int
+    patches_total: int
+    errors_total: int
+    shards: Dict[str, dict]
+
+@app.get("/process_data/{run_id}", response_model=ProcessDataStatusResponse)
+def process_data_status(run_id: str):
+    """Run-level status of a processing run, with each shard's status and counts."""
+    runs_table = aws_clients().table(os.getenv("DDB_RUNS_TABLE"))
+    run = get_run(runs_table, run_id)
+    if run is None:
+        raise HTTPException(status_code=404, detail="Run not found")
+    return ProcessDataStatusResponse(
+        run_id=run_id,
+        status=run.get("status", "running"),
+        num_shards=int(run.get("num_shards", 1)),
+        shards_finished=int(run.get("shards_finished", 0)),
+        images_total=int(run.get("images_total", 0)),
+        patches_total=int(run.get("patches_total", 0)),
+        errors_total=int(run.get("errors_total", 0)),
+        shards=json.loads(json.dumps(run.get("shards") or {}, default=float)),
+    )
 
-    task_arn = tasks[0]["taskArn"]
-    return ProcessDataResponse(run_id=run_id, task_arn=task_arn)
+@lru_cache(maxsize=1)
+def get_content_index():
+    """Shared content index for /inference dedup, or None when dedup is off."""
+    return make_content_index(aws_clients().dynamodb)
 
 # This class tells FastAPI the minimum information to receive from an inference request.
 class InferenceResponse(BaseModel):
@@ -101,101 +308,300 @@ class InferenceResponse(BaseModel):
     explanation: Optional[str] = None
 
 @app.post("/inference", response_model=InferenceResponse)
-async def infer(file: UploadFile = File(...)):
-    content = await file.read()
-    if not content:
+async def infer(background_tasks: BackgroundTasks, file: UploadFile = File(...)):
+    content_index = await run_io(get_content_index)
+    prepared = await _prepare_upload(file, content_index)
+    if isinstance(prepared, InferenceResponse):
+        return prepared
+
+    [(score, explanation, model_version)] = await _score([prepared])
+    job = await _persist_job(prepared, score, explanation, model_version)
+
+    # The ImageRecord, InferenceRecord (with the score) and the patches are
+    # written by the persistence stage, either before responding ("sync") or
+    # after the response is sent ("background").
+    persist_kwargs = _persist_kwargs(content_index)
+    if INFERENCE_PERSIST_MODE == "background":
+        background_tasks.add_task(persist_inference_in_background, job, **persist_kwargs)
+    else:
+        await run_io(persist_inference, job, **persist_kwargs)
+
+    return InferenceResponse(inference_id=job.inference_id, score=score, explanation=explanation)
+
+class BatchInferenceResult(BaseModel):
+    filename: str
+    status_code: int = 200
+    inference_id: Optional[str] = None
+    score: Optional[float] = None
+    explanation: Optional[str] = None
+    error: Optional[str] = None
+
+class BatchInferenceResponse(BaseModel):
+    results: List[BatchInferenceResult]
+
+@app.post("/inference/batch", response_model=BatchInferenceResponse)
+async def infer_batch(background_tasks: BackgroundTasks, files: List[UploadFile] = File(...)):
+    """
+    /inference for up to INFERENCE_BATCH_MAX_FILES images at once. They are
+    hashed and decoded in parallel, scored together and persisted with
+    batched writes. Results are in upload order; an image that fails gets its
+    own status_code and error while the others go through.
+    """
+    if len(files) > INFERENCE_BATCH_MAX_FILES:
+        raise HTTPException(status_code=400, detail=f"At most {INFERENCE_BATCH_MAX_FILES} files per batch")
+
+    content_index = await run_io(get_content_index)
+    outcomes = await asyncio.gather(
+        *(_prepare_upload(file, content_index) for file in files), return_exceptions=True,
+    )
+    results: List[Optional[BatchInferenceResult]] = [None] * len(files)
+    prepared: List[Tuple[int, _PreparedUpload]] = []
+    for i, (file, outcome) in enumerate(zip(files, outcomes)):
+        filename = file.filename or ""
+        if isinstance(outcome, HTTPException):
+            results[i] = BatchInferenceResult(filename=filename, status_code=outcome.status_code, error=outcome.detail)
+        elif isinstance(outcome, Exception):
+            print(f"Batch inference failed for {filename}: {outcome}")
+            results[i] = BatchInferenceResult(filename=filename, status_code=500, error="Internal error")
+        elif isinstance(outcome, InferenceResponse):
+            results[i] = BatchInferenceResult(
+                filename=filename, inference_id=outcome.inference_id,
+                score=outcome.score, explanation=outcome.explanation,
+            )
+        else:
+            prepared.append((i, outcome))
+
+    if prepared:
+        scores = await _score([p for _, p in prepared])
+        jobs = await asyncio.gather(*(
+            _persist_job(p, *scored) for (_, p), scored in zip(prepared, scores)
+        ))
+        persist_kwargs = _persist_kwargs(content_index)
+        failed: Dict[str, PersistError] = {}
+        if INFERENCE_PERSIST_MODE == "background":
+            background_tasks.add_task(persist_inferences_in_background, list(jobs), **persist_kwargs)
+        else:
+            failed = await run_io(persist_inferences, list(jobs), **persist_kwargs)
+        for (i, p), job in zip(prepared, jobs):
+            exc = failed.get(job.inference_id)
+            if exc is not None:
+                print(f"Persist failed for inference {job.inference_id} at {exc.step}: {exc.cause}")
+                results[i] = BatchInferenceResult(
+                    filename=job.filename, status_code=500, error=f"Could not store the result ({exc.step})",
+                )
+            else:
+                results[i] = BatchInferenceResult(
+                    filename=job.filename, inference_id=job.inference_id,
+                    score=job.score, explanation=job.explanation,
+                )
+
+    return BatchInferenceResponse(results=results)
+
+# An upload between validation and scoring: decoded, with its raw bytes
+# streaming to S3.
+@dataclass
+class _PreparedUpload:
+    spool: BinaryIO
+    digest: str
+    inference_id: str
+    image_id: str
+    created_at: int
+    filename: str
+    content_type: str
+    raw_bucket: str
+    raw_key: str
+    raw_future: Future
+    processed_bucket: str
+    size: Tuple[int, int]
+    patches_info: List[dict]
+    uploads: list
+    # (N, 256, 256, 3) uint8 patches for the model, in patches_info order.
+    pixels: np.ndarray
+
+async def _prepare_upload(file: UploadFile, content_index) -> Union[InferenceResponse, _PreparedUpload]:
+    """
+    Validate, deduplicate and decode one upload. Returns the stored result if
+    these bytes were already scored; raises HTTPException if the upload is
+    rejected.
+    """
+    # Starlette has already spooled the upload (to disk above 1 MB); it is read
+    # from there in chunks and never held as one bytes object.
+    spool = file.file
+    size = spool_size(spool)
+    if size == 0:
         raise HTTPException(status_code=400, detail="Empty upload")
-    
+    if size > MAX_UPLOAD_MB * 1024 * 1024:
+        raise HTTPException(status_code=413, detail=f"Upload exceeds {MAX_UPLOAD_MB} MB limit")
+
+    # Identical bytes that were already scored get the stored result back.
+    # Everything that blocks runs on the offload pools (see offload.py).
+    digest = await run_cpu(content_hash_fileobj, open_spool_reader(spool))
+    if content_index is not None:
+        cached = await run_io(content_index.get_inference, digest)
+        # A score from another model than the one served now is rescored.
+        if (
+            cached is not None and cached.get("inference_id")
+            and cached.get("model_version") == serving_model_version()
+        ):
+            return InferenceResponse(
+                inference_id=cached["inference_id"],
+                score=cached["score"],
+                explanation=cached.get("explanation"),
+            )
+
     # TODO: Initialize the S3 buckets.
-    region = os.getenv("AWS_REGION")
     raw_bucket = os.getenv("S3_IMAGES_RAW_BUCKET")
     processed_bucket = os.getenv("S3_IMAGES_PROCESSED_BUCKET")
 
     raw_prefix = os.getenv("S3_RAW_PREFIX", "inference")
     processed_prefix = os.getenv("S3_PROCESSED_PREFIX", "inference")
 
-    inference_table_name = os.getenv("DDB_INFERENCES_TABLE")
-    img_table_name = os.getenv("DDB_IMAGES_TABLE")
-    patch_table_name = os.getenv("DDB_PATCHES_TABLE")
-
-    # Read the image.
+    # Only the header is parsed here, so non-images are rejected before
+    # anything is uploaded.
     try:
-        img = Image.open(BytesIO(content)).convert("RGB")
+        await run_cpu(Image.open, open_spool_reader(spool))
     except Exception:
         raise HTTPException(status_code=400, detail="The uploaded file is not an image.")
-    w, h = img.size
-
-    s3 = boto3.client("s3", region_name=region)
-    ddb = boto3.resource("dynamodb", region_name=region)
-    inference_table = ddb.Table(inference_table_name)
-    img_table = ddb.Table(img_table_name)
-    patch_table = ddb.Table(patch_table_name)
 
-    inference_id = str(uuid.uuid4())
+    s3 = aws_clients().client("s3")
     image_id = str(uuid.uuid4())
-    created_at = int(time.time() * 1000)
     filename = file.filename or f"{image_id}.jpg"
-
-    # TODO: Upload the user uploaded image to S3 bucket
+    content_type = file.content_type or "application/octet-stream"
     raw_key = f"{raw_prefix}/{image_id}/{filename}"
-    s3.put_object(
-        Bucket=raw_bucket,
-        Key=raw_key,
-        Body=content,
-        ContentType=file.content_type or "application/octet-stream",
+
+    # The raw upload streams to S3 (multipart when large) while the image is
+    # decoded from a second reader over the same spooled file.
+    raw_future = raw_upload_pool.submit(
+        upload_raw_stream, s3, raw_bucket, raw_key, open_spool_reader(spool), content_type,
     )
-    raw_s3_uri = f"s3://{raw_bucket}/{raw_key}"
-
-    # TODO: Write the image's metadata to DynamoDB
-    img_table.put_item(Item={
-        "image_id": image_id,
-        "created_at": created_at,
-        "image_name": filename,
-        "image_path": raw_s3_uri,
-        "image_width": w,
-        "image_height": h,
-    })
-
-    # TODO: Write the inference's metadata to DynamoDB
-    inference_table.put_item(Item={
-        "inference_id": inference_id,
-        "user_id": "anonymous", 
-        "created_at": created_at,
-        "image_name": filename,
-        "image_path": raw_s3_uri,
-        "score": 0.0,
-        "explanation": None,
-    })
-   
-    patches_info = process_inference_image(
-        img=img,
+
+    # Read the image. Patches are extracted in memory; nothing below needs S3
+    # or DynamoDB until the persistence stage.
+    try:
+        (w, h), patches_info, uploads, pixels = await run_cpu(
+            _decode_patches, spool, decode_pool(), image_id, processed_bucket, processed_prefix,
+        )
+    except Exception:
+        await run_io(_discard_raw_upload, raw_future, s3, raw_bucket, raw_key)
+        raise HTTPException(status_code=400, detail="The uploaded file is not an image.")
+
+    return _PreparedUpload(
+        spool=spool,
+        digest=digest,
+        inference_id=str(uuid.uuid4()),
+        image_id=image_id,
+        created_at=int(time.time() * 1000),
+        filename=filename,
+        content_type=content_type,
+        raw_bucket=raw_bucket,
+        raw_key=raw_key,
+        raw_future=raw_future,
+        processed_bucket=processed_bucket,
+        size=(w, h),
+        patches_info=patches_info,
+        uploads=uploads,
+        pixels=pixels,
+    )
+
+async def _score(prepared: List[_PreparedUpload]) -> List[Tuple[float, Optional[str], Optional[str]]]:
+    """
+    (score, explanation, model version) for each prepared upload. Their
+    patches go to the micro-batcher together, and share forward passes with
+    other requests'.
+    """
+    batcher = model_batcher()
+    if batcher is None:
+        return [(1.0, "This is a sample response.", None) for _ in prepared]
+    futures = [asyncio.wrap_future(batcher.submit(p.pixels)) for p in prepared]
+    results = await asyncio.gather(*futures)
+    return [
+        (*combine_patch_scores(scores, p.patches_info), model_version)
+        for p, (scores, model_version) in zip(prepared, results)
+    ]
+
+async def _persist_job(
+    prepared: _PreparedUpload, score: float, explanation: Optional[str], model_version: Optional[str],
+) -> InferencePersistJob:
+    """Everything the persistence stage needs for a scored upload."""
+    # The spooled file is closed once the response is sent, so the streamed raw
+    # upload must be finished first. If it failed, the bytes are kept on the job
+    # and the persistence stage retries the upload.
+    try:
+        await asyncio.wrap_future(prepared.raw_future)
+        raw_uploaded = True
+    except Exception as exc:
+        print(f"Streamed raw upload failed for {prepared.raw_key}, deferring to persistence stage: {exc}")
+        raw_uploaded = False
+
+    w, h = prepared.size
+    return InferencePersistJob(
+        inference_id=prepared.inference_id,
+        image_id=prepared.image_id,
+        created_at=prepared.created_at,
+        filename=prepared.filename,
+        content=None if raw_uploaded else await run_cpu(open_spool_reader(prepared.spool).read),
+        content_type=prepared.content_type,
+        image_width=w,
+        image_height=h,
+        score=score,
+        explanation=explanation,
+        raw_bucket=prepared.raw_bucket,
+        raw_key=prepared.raw_key,
+        processed_bucket=prepared.processed_bucket,
+        patches=prepared.patches_info,
+        uploads=prepared.uploads,
+        content_hash=prepared.digest,
+        raw_uploaded=raw_uploaded,
+        model_version=model_version,
+    )
+
+def _persist_kwargs(content_index) -> Dict:
+    aws = aws_clients()
+    return dict(
+        s3_client=aws.client("s3"),
+        img_table=aws.table(os.getenv("DDB_IMAGES_TABLE")),
+        inference_table=aws.table(os.getenv("DDB_INFERENCES_TABLE")),
+        patch_table=aws.table(os.getenv("DDB_PATCHES_TABLE")),
+        content_index=content_index,
+    )
+
+def _decode_patches(
+    spool, pool: Optional[DecodePool], image_id: str, processed_bucket: str, processed_prefix: str,
+):
+    """
+    Decode the upload and extract its patches, in pool's worker processes if
+    given. Returns ((width, height), patch metadata, uploads) for the
+    persistence stage and the patches for the model; raises if the upload is
+    not an image.
+    """
+    if pool is not None:
+        decoded = pool.decode(open_spool_reader(spool).read())
+        if decoded is None:
+            raise ValueError("not an image")
+        size, batch, meta = (decoded.width, decoded.height), decoded.encoded, decoded.meta
+        # The workers hand back encoded patches; the model needs the pixels.
+        decode = get_patch_encoder(PATCH_FORMAT).decode
+        pixels = np.stack([decode(p) for p in batch])
+    else:
+        img, size = decode_image(open_spool_reader(spool))
+        batch, meta = extract_patches(img, source_size=size)
+        pixels = batch
+    patches_info, uploads = plan_patch_uploads(
+        batch=batch,
+        meta=meta,
         image_id=image_id,
         processed_bucket=processed_bucket,
         processed_prefix=processed_prefix,
-        s3_client=s3,
     )
+    return size, patches_info, uploads, pixels
 
-    # TODO: Write the patches' metadata to DynamoDB
-    for p in patches_info:
-        patch_table.put_item(Item={
-            "patch_id": p["patch_id"],
-            "image_id": image_id,               
-            "patch_type": p["patch_type"],      
-            "patch_path": p["patch_path"],
-            "patch_x": int(p["patch_x"]),
-            "patch_y": int(p["patch_y"]),
-            "patch_width": int(p["patch_width"]),
-            "patch_height": int(p["patch_height"]),
-            "created_at": created_at,
-        })
-
-    # TODO: Load the model from Modal volume with hyperparameter configs from DynamoDB
-    # TODO: Make prediction
-    # TODO: Update InferenceRecord in DynamoDB
-    score = 1.0
-    explanation = "This is a sample response."
-
-    return InferenceResponse(inference_id=inference_id, score=score, explanation=explanation)
+def _discard_raw_upload(raw_future, s3_client, bucket: str, key: str) -> None:
+    """Wait for a streamed raw upload and delete it again (best effort)."""
+    try:
+        raw_future.result()
+        s3_client.delete_object(Bucket=bucket, Key=key)
+    except Exception as exc:
+        print(f"Could not discard raw upload {key}: {exc}")
 
 class RAGQueryRequest(BaseModel):
     query: str
@@ -204,6 +610,11 @@ class RAGQueryResponse(BaseModel):
     answer: str
     sources: List[dict]
 
+@lru_cache(maxsize=1)
+def get_rag_cache():
+    """Shared /rag-query response cache (see ragcache.py), or None when it is off."""
+    return make_rag_cache(aws_clients().dynamodb)
+
 @app.post("/rag-query", response_model=RAGQueryResponse)
 async def rag_query(body: RAGQueryRequest):
     """Test endpoint to query the Bedrock Knowledge Base."""
@@ -213,27 +624,45 @@ async def rag_query(body: RAGQueryRequest):
     if not knowledge_base_id:
         raise HTTPException(status_code=500, detail="KNOWLEDGE_BASE_ID not configured")
 
-    bedrock = boto3.client("bedrock-agent-runtime", region_name=region)
-
-    resp = bedrock.retrieve_and_generate(
-        input={"text": body.query},
-        retrieveAndGenerateConfiguration={
-            "type": "KNOWLEDGE_BASE",
-            "knowledgeBaseConfiguration": {
-                "knowledgeBaseId": knowledge_base_id,
-                "modelArn": f"arn:aws:bedrock:{region}::foundation-model/anthropic.claude-sonnet-4-5-20250929-v1:0",
+    model_arn = f"arn:aws:bedrock:{region}::foundation-model/anthropic.claude-sonnet-4-5-20250929-v1:0"
+
+    async def ask() -> Dict:
+        bedrock = aws_clients().client("bedrock-agent-runtime")
+        resp = await run_io(
+            bedrock.retrieve_and_generate,
+            input={"text": body.query},
+            retrieveAndGenerateConfiguration={
+                "type": "KNOWLEDGE_BASE",
+                "knowledgeBaseConfiguration": {
+                    "knowledgeBaseId": knowledge_base_id,
+                    "modelArn": model_arn,
+                },
             },
-        },
-    )
-
-    answer = resp.get("output", {}).get("text", "")
-    citations = resp.get("citations", [])
-    sources = []
-    for citation in citations:
-        for ref in citation.get("retrievedReferences", []):
-            loc = ref.get("location", {})
-            s3_uri = loc.get("s3Location", {}).get("uri", "")
-            snippet = ref.get("content", {}).get("text", "")[:200]
-            sources.append({"s3_uri": s3_uri, "snippet": snippet})
-
-    return RAGQueryResponse(answer=answer, sources=sources)
+        )
+
+        answer = resp.get("output", {}).get("text", "")
+        citations = resp.get("citations", [])
+        sources = []
+        for citation in citations:
+            for ref in citation.get("retrievedReferences", []):
+                loc = ref.get("location", {})
+                s3_uri = loc.get("s3Location", {}).get("uri", "")
+                snippet = ref.get("content", {}).get("text", "")[:200]
+                sources.append({"s3_uri": s3_uri, "snippet": snippet})
+        return {"answer": answer, "sources": sources}
+
+    # Repeated questions are answered from the cache; identical ones already
+    # being answered wait for that call. The cache is looked up on the event
+    # loop, so concurrent first requests cannot each create one.
+    cache = get_rag_cache()
+    if cache is None:
+        result = await ask()
+    else:
+        result = await cache.get_or_compute(rag_cache_key(body.query, knowledge_base_id, model_arn), ask)
+    return RAGQueryResponse(**result)
+
+@app.get("/rag-query/cache")
+async def rag_cache_stats():
+    """Hit, miss and eviction counters of this worker's /rag-query cache."""
+    cache = get_rag_cache()
+    return {"enabled": cache is not None, **(cache.to_dict() if cache is not None else {})}
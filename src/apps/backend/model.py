@@ -0,0 +1,118 @@
+"""
+The patch scoring model the API serves on CPU.
+
+A model maps a (N, 256, 256, 3) uint8 patch batch (see process.extract_patches)
+to N scores in [0, 1], the likelihood that each patch is AI-generated, and
+combine_patch_scores turns an image's patch scores into its score.
+
+NumpyPatchModel needs nothing beyond numpy: an MLP over average-pooled
+patches, stored as an .npz file with
+    pool         pooling factor per side (256 / pool must be whole)
+    mean, std    optional per-feature normalization of the pooled pixels
+    w0, b0, ...  dense layers, ReLU between them; the last has one output
+load_model() reads MODEL_PATH once at startup; the micro-batcher in
+batching.py feeds it patches from concurrent requests.
+"""
+from __future__ import annotations
+
+import os
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+
+MODEL_PATH = os.getenv("MODEL_PATH", "")
+# How patch scores combine into the image score: "mean" or "max".
+MODEL_SCORE_AGGREGATION = os.getenv("MODEL_SCORE_AGGREGATION", "mean")
+
+
+class NumpyPatchModel:
+    """MLP over average-pooled patches (see the module docstring)."""
+
+    def __init__(
+        self,
+        layers: List[Tuple[np.ndarray, np.ndarray]],
+        pool: int = 8,
+        mean: Optional[np.ndarray] = None,
+        std: Optional[np.ndarray] = None,
+        name: str = "numpy-mlp",
+    ):
+        if not layers or layers[-1][0].shape[1] != 1:
+            raise ValueError("The last layer must have a single output")
+        self.layers = [(np.asarray(w, np.float32), np.asarray(b, np.float32)) for w, b in layers]
+        self.pool = pool
+        self.mean = None if mean is None else np.asarray(mean, np.float32)
+        self.std = None if std is None else np.asarray(std, np.float32)
+        self.name = name
+
+    @classmethod
+    def load(cls, path: str) -> "NumpyPatchModel":
+        with np.load(path) as f:
+            layers = []
+            while f"w{len(layers)}" in f:
+                i = len(layers)
+                layers.append((f[f"w{i}"], f[f"b{i}"]))
+            return cls(
+                layers,
+                pool=int(f["pool"]) if "pool" in f else 8,
+                mean=f["mean"] if "mean" in f else None,
+                std=f["std"] if "std" in f else None,
+                name=os.path.basename(path),
+            )
+
+    def save(self, path: str) -> None:
+        arrays: Dict[str, np.ndarray] = {"pool": np.asarray(self.pool)}
+        for i, (w, b) in enumerate(self.layers):
+            arrays[f"w{i}"], arrays[f"b{i}"] = w, b
+        if self.mean is not None:
+            arrays["mean"] = self.mean
+        if self.std is not None:
+            arrays["std"] = self.std
+        np.savez(path, **arrays)
+
+    def predict(self, patches: np.ndarray) -> np.ndarray:
+        """Scores in [0, 1] for a (N, H, W, 3) uint8 batch, as float32 (N,)."""
+        n, h, w, c = patches.shape
+        p = self.pool
+        x = patches.reshape(n, h // p, p, w // p, p, c).mean(axis=(2, 4), dtype=np.float32)
+        x = x.reshape(n, -1) / np.float32(255.0)
+        if self.mean is not None:
+            x -= self.mean
+        if self.std is not None:
+            x /= self.std
+        for i, (weights, bias) in enumerate(self.layers):
+            x = x @ weights + bias
+            if i < len(self.layers) - 1:
+                np.maximum(x, 0, out=x)
+        return 1.0 / (1.0 + np.exp(-x[:, 0]))
+
+
+def load_model(path: str) -> NumpyPatchModel:
+    """Load the model file at path. Raises ValueError for unknown formats."""
+    if path.endswith(".npz"):
+        return NumpyPatchModel.load(path)
+    raise ValueError(f"Unsupported model file {path!r}; expected an .npz NumpyPatchModel")
+
+
+def combine_patch_scores(
+    scores: np.ndarray,
+    patches: List[Dict],
+    aggregation: str = MODEL_SCORE_AGGREGATION,
+) -> Tuple[float, str]:
+    """
+    The image score from its patch scores, in the order of patches (the patch
+    metadata from plan_patch_uploads), and a short explanation naming the
+    highest-scoring patch.
+    """
+    if aggregation == "max":
+        score = float(np.max(scores))
+    elif aggregation == "mean":
+        score = float(np.mean(scores))
+    else:
+        raise ValueError(f"Unknown score aggregation {aggregation!r}")
+    top = int(np.argmax(scores))
+    p = patches[top]
+    explanation = (
+        f"{aggregation} of {len(scores)} patch scores; highest {float(scores[top]):.3f} "
+        f"for the {p['patch_type']} patch at ({p['patch_x']}, {p['patch_y']})"
+    )
+    return score, explanation
@@ -0,0 +1,46 @@
+"""
+Executors that keep blocking work off the API's event loop.
+
+Every request on a uvicorn worker shares one event loop, so a boto3 call or a
+PIL decode made directly in an async handler stalls all the others. Handlers
+hand such work to one of two pools instead and await it:
+
+    run_io   S3, DynamoDB and Bedrock calls, which mostly wait on the network;
+             API_IO_WORKERS threads (API_CONCURRENCY by default)
+    run_cpu  hashing, decoding and patch extraction; API_CPU_WORKERS threads
+             (one per core by default)
+
+Keeping them apart means requests waiting on AWS never hold up decodes, and a
+burst of decodes cannot use up the threads that network waits need.
+API_DECODE_PROCESSES > 0 moves decoding and patch encoding further, into
+worker processes (see data_pipeline/procpool.py), for when the GIL-bound
+parts of the decode limit throughput.
+"""
+from __future__ import annotations
+
+import asyncio
+import functools
+import os
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, TypeVar
+
+from src.apps.backend.clients import API_CONCURRENCY
+
+API_IO_WORKERS = int(os.getenv("API_IO_WORKERS", str(API_CONCURRENCY)))
+API_CPU_WORKERS = int(os.getenv("API_CPU_WORKERS", str(os.cpu_count() or 1)))
+API_DECODE_PROCESSES = int(os.getenv("API_DECODE_PROCESSES", "0"))
+
+T = TypeVar("T")
+
+io_pool = ThreadPoolExecutor(max_workers=API_IO_WORKERS, thread_name_prefix="api-io")
+cpu_pool = ThreadPoolExecutor(max_workers=API_CPU_WORKERS, thread_name_prefix="api-cpu")
+
+
+async def run_io(fn: Callable[..., T], *args, **kwargs) -> T:
+    """fn(*args, **kwargs) on the network I/O threads."""
+    return await asyncio.get_running_loop().run_in_executor(io_pool, functools.partial(fn, *args, **kwargs))
+
+
+async def run_cpu(fn: Callable[..., T], *args, **kwargs) -> T:
+    """fn(*args, **kwargs) on the CPU threads."""
+    return await asyncio.get_running_loop().run_in_executor(cpu_pool, functools.partial(fn, *args, **kwargs))
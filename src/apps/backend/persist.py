@@ -0,0 +1,455 @@
+"""
+Persistence stage for /inference.
+
+The score only needs the in-memory patches, so the endpoint can answer first
+and hand everything that touches S3 and DynamoDB to persist_inference(): the
+raw upload, the ImageRecord, the InferenceRecord, the patch uploads and the
+PatchRecords. Each step is idempotent and retried with backoff.
+persist_inferences() does the same for the images of one /inference/batch
+request, step by step for all of them, with batched DynamoDB writes, and
+reports which of them could not be stored.
+
+When a step still fails in background mode, the job is written to
+PERSIST_FAILURE_URI (s3://bucket/prefix or file:///dir) with whatever has not
+been stored yet: the raw bytes if the raw upload failed, the encoded patches
+if they were not all uploaded. PERSIST_FAILURE_DIR on the task's own disk is
+only the fallback for when that cannot be reached; on Fargate it does not
+outlive the task. Replay the recorded jobs with
+
+    python -m src.apps.backend.persist [--failure_uri s3://bucket/prefix]
+
+which persists each one again and deletes it once it is stored.
+"""
+from __future__ import annotations
+
+import argparse
+import json
+import os
+import random
+import time
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field, fields
+from decimal import Decimal
+from typing import Callable, Dict, List, Optional, Tuple, TypeVar
+
+import boto3
+import numpy as np
+
+from src.apps.data_pipeline.dedup import make_content_index
+from src.apps.data_pipeline.encoding import get_patch_encoder
+from src.apps.data_pipeline.metadata import BATCH_WRITE_MAX_ITEMS, batch_put, patch_record_item
+from src.apps.data_pipeline.process import PATCH_UPLOAD_WORKERS, upload_patches
+from src.apps.data_pipeline.storage import LocalStorage, S3Storage, Storage
+
+T = TypeVar("T")
+
+PERSIST_ATTEMPTS = int(os.getenv("INFERENCE_PERSIST_ATTEMPTS", "4"))
+PERSIST_BASE_DELAY_S = float(os.getenv("INFERENCE_PERSIST_BASE_DELAY_S", "0.2"))
+PERSIST_FAILURE_URI = os.getenv("INFERENCE_PERSIST_FAILURE_URI", "")
+PERSIST_FAILURE_DIR = os.getenv("INFERENCE_PERSIST_FAILURE_DIR", "/tmp/artguard/persist_failures")
+# Threads persist_inferences spreads a batch's patch uploads, batch writes and
+# content index updates over.
+BATCH_PERSIST_WORKERS = int(os.getenv("INFERENCE_BATCH_PERSIST_WORKERS", str(4 * PATCH_UPLOAD_WORKERS)))
+
+
+# Everything persist_inference needs, captured before the response is sent.
+@dataclass
+class InferencePersistJob:
+    inference_id: str
+    image_id: str
+    created_at: int
+    filename: str
+    content: Optional[bytes]
+    content_type: str
+    image_width: int
+    image_height: int
+    score: float
+    explanation: Optional[str]
+    raw_bucket: str
+    raw_key: str
+    processed_bucket: str
+    patches: List[Dict] = field(default_factory=list)
+    uploads: List[Tuple[str, np.ndarray, str]] = field(default_factory=list)
+    content_hash: Optional[str] = None
+    # Set when the handler already streamed the raw upload to S3; content is
+    # then not kept around.
+    raw_uploaded: bool = False
+    # The model that produced score; None for placeholder scores.
+    model_version: Optional[str] = None
+
+    @property
+    def raw_s3_uri(self) -> str:
+        return f"s3://{self.raw_bucket}/{self.raw_key}"
+
+
+class PersistError(Exception):
+    """Raised when a persistence step still fails after all retries."""
+
+    def __init__(self, step: str, cause: Exception):
+        super().__init__(f"{step} failed: {cause}")
+        self.step = step
+        self.cause = cause
+
+
+def with_retries(
+    fn: Callable[[], T],
+    attempts: int = PERSIST_ATTEMPTS,
+    base_delay_s: float = PERSIST_BASE_DELAY_S,
+) -> T:
+    """
+    Call fn until it succeeds, sleeping with jittered exponential backoff between
+    attempts. Re-raises the last error once attempts are exhausted.
+    """
+    for attempt in range(attempts):
+        try:
+            return fn()
+        except Exception:
+            if attempt == attempts - 1:
+                raise
+            time.sleep(base_delay_s * (2 ** attempt) * random.uniform(0.5, 1.5))
+    raise RuntimeError("unreachable")
+
+
+def persist_inference(
+    job: InferencePersistJob,
+    s3_client,
+    img_table,
+    inference_table,
+    patch_table,
+    upload_workers: int = PATCH_UPLOAD_WORKERS,
+    attempts: int = PERSIST_ATTEMPTS,
+    content_index=None,
+) -> None:
+    """
+    Write the upload, its patches and their metadata to S3 and DynamoDB.
+    The InferenceRecord is written with persist_status "pending" and updated
+    to "persisted" once every other write has succeeded. Finally the score is
+    recorded in content_index (see data_pipeline/dedup.py), if given.
+    Raises PersistError naming the first step that could not be completed.
+    """
+    steps: List[Tuple[str, Callable[[], object]]] = []
+    if not job.raw_uploaded:
+        steps.append(("raw_upload", lambda: s3_client.put_object(
+            Bucket=job.raw_bucket,
+            Key=job.raw_key,
+            Body=job.content,
+            ContentType=job.content_type,
+        )))
+    steps += [
+        ("image_record", lambda: img_table.put_item(Item=_image_item(job))),
+        ("inference_record", lambda: inference_table.put_item(Item=_inference_item(job, "pending"))),
+        ("patch_upload", lambda: upload_patches(
+            s3_client, job.processed_bucket, job.uploads, max_workers=upload_workers,
+        )),
+        ("patch_records", lambda: _write_patch_records(patch_table, job)),
+        ("inference_status", lambda: inference_table.update_item(
+            Key={"inference_id": job.inference_id},
+            UpdateExpression="SET persist_status = :s",
+            ExpressionAttributeValues={":s": "persisted"},
+        )),
+    ]
+    if content_index is not None and job.content_hash:
+        steps.append(("content_index", lambda: content_index.record_inference(
+            job.content_hash, job.image_id, job.inference_id, job.score, job.explanation, job.model_version,
+        )))
+
+    for step, fn in steps:
+        try:
+            with_retries(fn, attempts=attempts)
+        except Exception as exc:
+            raise PersistError(step, exc) from exc
+
+
+def persist_inference_in_background(job: InferencePersistJob, **kwargs) -> None:
+    """
+    BackgroundTasks entry point: like persist_inference, but failures are
+    recorded for replay (see record_persist_failure) instead of being raised.
+    """
+    try:
+        persist_inference(job, **kwargs)
+    except PersistError as exc:
+        print(f"Persist failed for inference {job.inference_id} at {exc.step}: {exc.cause}")
+        record_persist_failure(job, exc, s3_client=kwargs.get("s3_client"))
+
+
+def persist_inferences(
+    jobs: List[InferencePersistJob],
+    s3_client,
+    img_table,
+    inference_table,
+    patch_table,
+    workers: int = BATCH_PERSIST_WORKERS,
+    attempts: int = PERSIST_ATTEMPTS,
+    content_index=None,
+) -> Dict[str, PersistError]:
+    """
+    persist_inference for the images of one /inference/batch request, with
+    each step done for all of them at once on up to workers threads: the
+    records go out in batch_write_item requests and the patches share one
+    upload pool. The InferenceRecords are written again with persist_status
+    "persisted" once everything else is stored. When a step still fails for
+    the batch, it is retried job by job so one bad image does not fail the
+    others; the jobs that fail then skip the remaining steps. Returns the
+    PersistError of each job that could not be stored, by inference_id.
+    """
+    steps: List[Tuple[str, Callable[[List[InferencePersistJob]], object]]] = [
+        ("raw_upload", lambda batch: [s3_client.put_object(
+            Bucket=job.raw_bucket,
+            Key=job.raw_key,
+            Body=job.content,
+            ContentType=job.content_type,
+        ) for job in batch if not job.raw_uploaded]),
+        ("image_record", lambda batch: _batch_put_concurrently(
+            img_table, [_image_item(job) for job in batch], workers,
+        )),
+        ("inference_record", lambda batch: _batch_put_concurrently(
+            inference_table, [_inference_item(job, "pending") for job in batch], workers,
+        )),
+        ("patch_upload", lambda batch: _upload_all_patches(s3_client, batch, workers)),
+        ("patch_records", lambda batch: _batch_put_concurrently(patch_table, [
+            patch_record_item(job.image_id, p, job.created_at) for job in batch for p in job.patches
+        ], workers)),
+        ("inference_status", lambda batch: _batch_put_concurrently(
+            inference_table, [_inference_item(job, "persisted") for job in batch], workers,
+        )),
+    ]
+    if content_index is not None:
+        steps.append(("content_index", lambda batch: _concurrently(lambda job: content_index.record_inference(
+            job.content_hash, job.image_id, job.inference_id, job.score, job.explanation, job.model_version,
+        ), [job for job in batch if job.content_hash], workers)))
+
+    failed: Dict[str, PersistError] = {}
+    for step, fn in steps:
+        pending = [job for job in jobs if job.inference_id not in failed]
+        if not pending:
+            break
+        try:
+            with_retries(lambda: fn(pending), attempts=attempts)
+        except Exception as exc:
+            if len(pending) == 1:
+                failed[pending[0].inference_id] = PersistError(step, exc)
+                continue
+
+            def one(job: InferencePersistJob) -> None:
+                try:
+                    with_retries(lambda: fn([job]), attempts=attempts)
+                except Exception as exc:
+                    failed[job.inference_id] = PersistError(step, exc)
+
+            _concurrently(one, pending, workers)
+    return failed
+
+
+def persist_inferences_in_background(jobs: List[InferencePersistJob], **kwargs) -> None:
+    """BackgroundTasks entry point for persist_inferences; failed jobs are recorded for replay."""
+    failed = persist_inferences(jobs, **kwargs)
+    for job in jobs:
+        exc = failed.get(job.inference_id)
+        if exc is not None:
+            print(f"Persist failed for inference {job.inference_id} at {exc.step}: {exc.cause}")
+            record_persist_failure(job, exc, s3_client=kwargs.get("s3_client"))
+
+
+def record_persist_failure(
+    job: InferencePersistJob,
+    exc: PersistError,
+    s3_client=None,
+    failure_uri: str = PERSIST_FAILURE_URI,
+    failure_dir: str = PERSIST_FAILURE_DIR,
+) -> str:
+    """
+    Write the failed job to failure_uri, or to failure_dir if that is not set
+    or cannot be written, as {inference_id}/job.json plus the raw upload
+    ("raw") if it never reached S3 and the encoded patches ("patches.bin") if
+    they were not all uploaded. job.json is written last, so replay only sees
+    complete jobs. Returns its URI.
+    """
+    locations = [failure_uri] if failure_uri else []
+    locations.append(failure_dir)
+    for i, location in enumerate(locations):
+        try:
+            return _write_failure(job, exc, *_failure_location(location, s3_client))
+        except Exception as write_exc:
+            if i == len(locations) - 1:
+                raise
+            print(f"Could not record the persist failure of {job.inference_id} in {location}: {write_exc}")
+    raise RuntimeError("unreachable")
+
+
+def replay_persist_failures(
+    s3_client,
+    img_table,
+    inference_table,
+    patch_table,
+    failure_uri: str = PERSIST_FAILURE_URI or PERSIST_FAILURE_DIR,
+    attempts: int = PERSIST_ATTEMPTS,
+    content_index=None,
+) -> Tuple[int, int]:
+    """
+    persist_inference for every job record_persist_failure wrote to
+    failure_uri, deleting each one once it is stored. Returns how many were
+    stored and how many still failed (those are kept).
+    """
+    storage, bucket, prefix = _failure_location(failure_uri, s3_client)
+    manifests = [
+        obj["Key"] for obj in storage.iter_objects(bucket, f"{prefix}/" if prefix else "")
+        if obj["Key"].endswith("/job.json")
+    ]
+    stored = failed = 0
+    for key in manifests:
+        base = key[:-len("/job.json")]
+        try:
+            job = _read_failure(storage, bucket, base)
+            persist_inference(
+                job, s3_client, img_table, inference_table, patch_table,
+                attempts=attempts, content_index=content_index,
+            )
+        except Exception as exc:
+            print(f"Replay failed for {storage.uri(bucket, key)}: {exc}")
+            failed += 1
+            continue
+        # The manifest goes last, so an interrupted delete leaves a job that replays again.
+        storage.delete(bucket, [f"{base}/raw", f"{base}/patches.bin"])
+        storage.delete(bucket, [key])
+        stored += 1
+    return stored, failed
+
+
+def _failure_location(uri: str, s3_client) -> Tuple[Storage, str, str]:
+    """(storage, bucket, key prefix) for an s3://bucket/prefix URI or a local directory."""
+    if uri.startswith("s3://"):
+        bucket, _, prefix = uri[len("s3://"):].partition("/")
+        return S3Storage(s3_client), bucket, prefix.strip("/")
+    path = os.path.abspath(uri[len("file://"):] if uri.startswith("file://") else uri)
+    return LocalStorage(os.path.dirname(path)), os.path.basename(path), ""
+
+
+def _write_failure(job: InferencePersistJob, exc: PersistError, storage: Storage, bucket: str, prefix: str) -> str:
+    base = f"{prefix}/{job.inference_id}" if prefix else job.inference_id
+    entry = {f.name: getattr(job, f.name) for f in fields(job) if f.name not in ("content", "uploads")}
+    entry.update({
+        "failed_at": int(time.time() * 1000),
+        "step": exc.step,
+        "error": str(exc.cause),
+        # Steps before the failed one succeeded; replay only redoes what is missing.
+        "raw_uploaded": job.raw_uploaded or exc.step != "raw_upload",
+        "uploads": [],
+    })
+    if not entry["raw_uploaded"]:
+        storage.put(bucket, f"{base}/raw", bytes(job.content), content_type=job.content_type)
+    if exc.step in _STEPS_BEFORE_PATCH_UPLOAD:
+        blobs: List[bytes] = []
+        offset = 0
+        for key, patch, patch_format in job.uploads:
+            data = patch if isinstance(patch, bytes) else get_patch_encoder(patch_format).encode(patch)
+            entry["uploads"].append({"key": key, "patch_format": patch_format, "offset": offset, "length": len(data)})
+            blobs.append(data)
+            offset += len(data)
+        storage.put(bucket, f"{base}/patches.bin", b"".join(blobs))
+    storage.put(bucket, f"{base}/job.json", json.dumps(entry).encode("utf-8"), content_type="application/json")
+    return storage.uri(bucket, f"{base}/job.json")
+
+
+# A failure at one of these steps means the patches may not all be uploaded.
+_STEPS_BEFORE_PATCH_UPLOAD = {"raw_upload", "image_record", "inference_record", "patch_upload"}
+
+
+def _read_failure(storage: Storage, bucket: str, base: str) -> InferencePersistJob:
+    entry = json.loads(bytes(storage.get(bucket, f"{base}/job.json")))
+    job = InferencePersistJob(**{
+        f.name: entry[f.name] for f in fields(InferencePersistJob)
+        if f.name in entry and f.name not in ("content", "uploads")
+    }, content=None)
+    if not job.raw_uploaded:
+        job.content = bytes(storage.get(bucket, f"{base}/raw"))
+    if entry["uploads"]:
+        blob = bytes(storage.get(bucket, f"{base}/patches.bin"))
+        job.uploads = [
+            (u["key"], blob[u["offset"]:u["offset"] + u["length"]], u["patch_format"]) for u in entry["uploads"]
+        ]
+    return job
+
+
+def _image_item(job: InferencePersistJob) -> Dict:
+    return {
+        "image_id": job.image_id,
+        "created_at": job.created_at,
+        "image_name": job.filename,
+        "image_path": job.raw_s3_uri,
+        "image_width": job.image_width,
+        "image_height": job.image_height,
+    }
+
+
+def _inference_item(job: InferencePersistJob, persist_status: str) -> Dict:
+    item = {
+        "inference_id": job.inference_id,
+        "user_id": "anonymous",
+        "created_at": job.created_at,
+        "image_name": job.filename,
+        "image_path": job.raw_s3_uri,
+        "score": _to_dynamo_number(job.score),
+        "explanation": job.explanation,
+        "persist_status": persist_status,
+    }
+    if job.model_version is not None:
+        item["model_version"] = job.model_version
+    return item
+
+
+def _concurrently(fn: Callable[[T], object], args: List[T], workers: int) -> None:
+    """fn(arg) for every arg on up to workers threads; raises the first error."""
+    if workers <= 1 or len(args) <= 1:
+        for arg in args:
+            fn(arg)
+        return
+    with ThreadPoolExecutor(max_workers=min(workers, len(args))) as pool:
+        list(pool.map(fn, args))
+
+
+def _batch_put_concurrently(table, items: List[Dict], workers: int) -> None:
+    chunks = [items[i:i + BATCH_WRITE_MAX_ITEMS] for i in range(0, len(items), BATCH_WRITE_MAX_ITEMS)]
+    _concurrently(lambda chunk: batch_put(table, chunk), chunks, workers)
+
+
+def _upload_all_patches(s3_client, jobs: List[InferencePersistJob], workers: int) -> None:
+    for bucket in {job.processed_bucket for job in jobs}:
+        uploads = [u for job in jobs if job.processed_bucket == bucket for u in job.uploads]
+        upload_patches(s3_client, bucket, uploads, max_workers=workers)
+
+
+def _write_patch_records(patch_table, job: InferencePersistJob) -> None:
+    batch_put(patch_table, [patch_record_item(job.image_id, p, job.created_at) for p in job.patches])
+
+
+def _to_dynamo_number(value: float):
+    """DynamoDB rejects Python floats; store scores as Decimal."""
+    return Decimal(str(value))
+
+
+def main() -> None:
+    p = argparse.ArgumentParser(description="Replay /inference jobs whose persistence failed")
+    p.add_argument("--failure_uri", default=PERSIST_FAILURE_URI or PERSIST_FAILURE_DIR,
+                   help="where the jobs were recorded: s3://bucket/prefix or a local directory")
+    p.add_argument("--attempts", type=int, default=PERSIST_ATTEMPTS)
+    args = p.parse_args()
+
+    region = os.getenv("AWS_REGION")
+    s3 = boto3.client("s3", region_name=region)
+    ddb = boto3.resource("dynamodb", region_name=region)
+    stored, failed = replay_persist_failures(
+        s3,
+        ddb.Table(os.getenv("DDB_IMAGES_TABLE")),
+        ddb.Table(os.getenv("DDB_INFERENCES_TABLE")),
+        ddb.Table(os.getenv("DDB_PATCHES_TABLE")),
+        failure_uri=args.failure_uri,
+        attempts=args.attempts,
+        content_index=make_content_index(ddb),
+    )
+    print(f"Replayed {stored} failed persists from {args.failure_uri}; {failed} still failing")
+    if failed:
+        raise SystemExit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,194 @@
+"""
+Response cache for /rag-query.
+
+A retrieve_and_generate call takes seconds and is billed per call, while users
+keep asking the same few questions in slightly different words. Responses are
+cached under the normalized query (case, accents, punctuation and whitespace
+folded, see normalize_query) together with the knowledge base and model they
+came from.
+
+Each worker keeps up to RAG_CACHE_MAX_ENTRIES responses for RAG_CACHE_TTL_S
+seconds, evicting the least recently used first. With DDB_RAG_CACHE_TABLE set,
+responses are also written to that DynamoDB table (expires_at doubles as its
+TTL attribute), so a question one worker answered is a hit for every other
+worker. Identical queries that arrive while one is being answered wait for that
+answer instead of calling Bedrock again. Errors are never cached.
+RAG_CACHE=0 turns the cache off.
+"""
+from __future__ import annotations
+
+import asyncio
+import hashlib
+import json
+import os
+import re
+import time
+import unicodedata
+from collections import OrderedDict
+from typing import Awaitable, Callable, Dict, Optional, Tuple
+
+from src.apps.backend.offload import run_io
+
+RAG_CACHE = os.getenv("RAG_CACHE", "1") == "1"
+RAG_CACHE_TTL_S = float(os.getenv("RAG_CACHE_TTL_S", "21600"))
+RAG_CACHE_MAX_ENTRIES = int(os.getenv("RAG_CACHE_MAX_ENTRIES", "1024"))
+
+_PUNCTUATION = re.compile(r"[^\w\s]+")
+_WHITESPACE = re.compile(r"\s+")
+
+
+def normalize_query(query: str) -> str:
+    """The query with case, accents, punctuation and runs of whitespace folded."""
+    text = unicodedata.normalize("NFKD", query.casefold())
+    text = "".join(c for c in text if not unicodedata.combining(c))
+    return _WHITESPACE.sub(" ", _PUNCTUATION.sub(" ", text)).strip()
+
+
+def rag_cache_key(query: str, knowledge_base_id: str, model_arn: str) -> str:
+    payload = json.dumps([normalize_query(query), knowledge_base_id, model_arn])
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+class DynamoRagStore:
+    """Shared responses in a DynamoDB table with hash key cache_key."""
+
+    def __init__(self, table):
+        self.table = table
+
+    def get(self, key: str) -> Optional[Tuple[Dict, float]]:
+        item = self.table.get_item(Key={"cache_key": key}).get("Item")
+        if item is None:
+            return None
+        return json.loads(item["response"]), float(item["expires_at"])
+
+    def put(self, key: str, response: Dict, expires_at: float) -> None:
+        self.table.put_item(Item={
+            "cache_key": key,
+            "response": json.dumps(response),
+            "expires_at": int(expires_at),
+        })
+
+
+class RagResponseCache:
+    """
+    TTL + LRU cache of /rag-query responses with in-flight collapsing and an
+    optional shared store (see the module docstring). Used from the event loop.
+    """
+
+    def __init__(
+        self,
+        ttl_s: float = RAG_CACHE_TTL_S,
+        max_entries: int = RAG_CACHE_MAX_ENTRIES,
+        store: Optional[DynamoRagStore] = None,
+        clock: Callable[[], float] = time.time,
+    ):
+        self.ttl_s = ttl_s
+        self.max_entries = max_entries
+        self.store = store
+        self.clock = clock
+        self.hits = 0
+        self.shared_hits = 0
+        self.misses = 0
+        self.collapsed = 0
+        self.evictions = 0
+        self.store_errors = 0
+        self._entries: "OrderedDict[str, Tuple[float, Dict]]" = OrderedDict()
+        self._inflight: Dict[str, asyncio.Future] = {}
+
+    async def get_or_compute(self, key: str, compute: Callable[[], Awaitable[Dict]]) -> Dict:
+        """The cached response for key, or compute()'s, which is then cached."""
+        response = self._get_local(key)
+        if response is not None:
+            self.hits += 1
+            return response
+        inflight = self._inflight.get(key)
+        if inflight is not None:
+            self.collapsed += 1
+            return await asyncio.shield(inflight)
+
+        future = asyncio.get_running_loop().create_future()
+        # Nobody may be waiting; an error must not be reported as never retrieved.
+        future.add_done_callback(lambda f: f.cancelled() or f.exception())
+        self._inflight[key] = future
+        try:
+            shared = await self._get_shared(key)
+            if shared is not None:
+                self.shared_hits += 1
+                response, expires_at = shared
+            else:
+                self.misses += 1
+                response = await compute()
+                expires_at = self.clock() + self.ttl_s
+                await self._put_shared(key, response, expires_at)
+            self._put_local(key, response, expires_at)
+            future.set_result(response)
+            return response
+        except asyncio.CancelledError:
+            future.cancel()
+            raise
+        except Exception as exc:
+            future.set_exception(exc)
+            raise
+        finally:
+            del self._inflight[key]
+
+    def _get_local(self, key: str) -> Optional[Dict]:
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        expires_at, response = entry
+        if expires_at <= self.clock():
+            del self._entries[key]
+            return None
+        self._entries.move_to_end(key)
+        return response
+
+    def _put_local(self, key: str, response: Dict, expires_at: float) -> None:
+        self._entries[key] = (expires_at, response)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+
+    async def _get_shared(self, key: str) -> Optional[Tuple[Dict, float]]:
+        if self.store is None:
+            return None
+        try:
+            shared = await run_io(self.store.get, key)
+        except Exception as exc:
+            self.store_errors += 1
+            print(f"RAG cache store read failed: {exc}")
+            return None
+        # DynamoDB deletes expired items only eventually.
+        if shared is None or shared[1] <= self.clock():
+            return None
+        return shared
+
+    async def _put_shared(self, key: str, response: Dict, expires_at: float) -> None:
+        if self.store is None:
+            return
+        try:
+            await run_io(self.store.put, key, response, expires_at)
+        except Exception as exc:
+            self.store_errors += 1
+            print(f"RAG cache store write failed: {exc}")
+
+    def to_dict(self) -> Dict:
+        return {
+            "entries": len(self._entries),
+            "hits": self.hits,
+            "shared_hits": self.shared_hits,
+            "misses": self.misses,
+            "collapsed": self.collapsed,
+            "evictions": self.evictions,
+            "store_errors": self.store_errors,
+        }
+
+
+def make_rag_cache(ddb_resource=None) -> Optional[RagResponseCache]:
+    """The /rag-query cache configured by the environment, or None if it is off."""
+    if not RAG_CACHE:
+        return None
+    table_name = os.getenv("DDB_RAG_CACHE_TABLE")
+    store = DynamoRagStore(ddb_resource.Table(table_name)) if table_name and ddb_resource is not None else None
+    return RagResponseCache(store=store)
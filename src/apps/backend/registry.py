@@ -0,0 +1,180 @@
+"""
+The model the API serves, resolved from the training runs and swapped live.
+
+The active version is the best_config_id of MODEL_RUN_ID's RunRecord or, if
+that is not set, of the newest completed run that has one; its ConfigRecord's
+modal_volume_path names the weights (see model.py for the format). They are
+read where the Modal volume is mounted (MODEL_VOLUME_DIR) or, if not there,
+fetched once from MODEL_MIRROR_URI (s3://bucket/prefix or file:///dir, a copy
+of the volume) into MODEL_CACHE_DIR.
+
+ModelRegistry loads the active version at startup and checks again every
+MODEL_REFRESH_S seconds on a background thread. A new version is loaded on
+that thread while requests keep being scored by the current one, then put in
+the MicroBatcher with swap_model(), so there is no restart and no pause. The
+last MODEL_CACHE_VERSIONS models stay in memory, so rolling back to one of
+them is immediate. A version that cannot be resolved or loaded leaves the
+current model in place.
+"""
+from __future__ import annotations
+
+import os
+import threading
+import uuid
+from collections import OrderedDict
+from typing import Dict, Optional, Tuple
+
+from boto3.dynamodb.conditions import Attr, Key
+
+from src.apps.backend.batching import MicroBatcher
+from src.apps.backend.model import NumpyPatchModel, load_model
+from src.apps.data_pipeline.storage import read_uri
+
+MODEL_REGISTRY = os.getenv("MODEL_REGISTRY", "1") == "1"
+MODEL_RUN_ID = os.getenv("MODEL_RUN_ID", "")
+MODEL_VOLUME_DIR = os.getenv("MODEL_VOLUME_DIR", "")
+MODEL_MIRROR_URI = os.getenv("MODEL_MIRROR_URI", "")
+MODEL_CACHE_DIR = os.getenv("MODEL_CACHE_DIR", "/tmp/artguard/models")
+MODEL_CACHE_VERSIONS = int(os.getenv("MODEL_CACHE_VERSIONS", "3"))
+MODEL_REFRESH_S = float(os.getenv("MODEL_REFRESH_S", "60"))
+
+
+class ModelRegistry:
+    """Resolves, loads and hot-swaps the served model (see the module docstring)."""
+
+    def __init__(
+        self,
+        runs_table,
+        configs_table,
+        s3_client=None,
+        run_id: str = MODEL_RUN_ID,
+        volume_dir: str = MODEL_VOLUME_DIR,
+        mirror_uri: str = MODEL_MIRROR_URI,
+        cache_dir: str = MODEL_CACHE_DIR,
+        cache_versions: int = MODEL_CACHE_VERSIONS,
+        refresh_s: float = MODEL_REFRESH_S,
+    ):
+        self.runs_table = runs_table
+        self.configs_table = configs_table
+        self.s3_client = s3_client
+        self.run_id = run_id
+        self.volume_dir = volume_dir
+        self.mirror_uri = mirror_uri.rstrip("/")
+        self.cache_dir = cache_dir
+        self.cache_versions = cache_versions
+        self.refresh_s = refresh_s
+        # None until the first version is loaded; scores are placeholders until then.
+        self.batcher: Optional[MicroBatcher] = None
+        self.active_version: Optional[str] = None
+        self.swaps = 0
+        self.loads = 0
+        self._models: "OrderedDict[str, NumpyPatchModel]" = OrderedDict()
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    def resolve(self) -> Optional[Tuple[str, str]]:
+        """(config_id, modal_volume_path) of the active version, or None if there is none yet."""
+        if self.run_id:
+            run = self.runs_table.get_item(Key={"run_id": self.run_id}).get("Item")
+        else:
+            run = self._newest_trained_run()
+        if not run or not run.get("best_config_id"):
+            return None
+        config_id = run["best_config_id"]
+        config = self.configs_table.get_item(Key={"config_id": config_id}).get("Item") or {}
+        path = config.get("modal_volume_path")
+        if not path:
+            raise ValueError(f"ConfigRecord {config_id} has no modal_volume_path")
+        return config_id, path
+
+    def _newest_trained_run(self) -> Optional[Dict]:
+        # Processing runs share the table; only training runs have a best_config_id.
+        kwargs = dict(
+            IndexName="StatusIndex",
+            KeyConditionExpression=Key("status").eq("completed"),
+            FilterExpression=Attr("best_config_id").exists(),
+            ScanIndexForward=False,
+        )
+        while True:
+            resp = self.runs_table.query(**kwargs)
+            if resp.get("Items"):
+                return resp["Items"][0]
+            if "LastEvaluatedKey" not in resp:
+                return None
+            kwargs["ExclusiveStartKey"] = resp["LastEvaluatedKey"]
+
+    def model(self, config_id: str, path: str) -> NumpyPatchModel:
+        """The model of a version, from memory if it is one of the last cache_versions used."""
+        model = self._models.get(config_id)
+        if model is None:
+            model = load_model(self._local_path(config_id, path))
+            model.name = config_id
+            self.loads += 1
+        self._models[config_id] = model
+        self._models.move_to_end(config_id)
+        while len(self._models) > self.cache_versions:
+            self._models.popitem(last=False)
+        return model
+
+    def _local_path(self, config_id: str, path: str) -> str:
+        """A local file with the weights at path in the Modal volume."""
+        relative = path.lstrip("/")
+        local = os.path.join(self.volume_dir, relative) if self.volume_dir else path
+        if os.path.exists(local):
+            return local
+        if not self.mirror_uri:
+            raise FileNotFoundError(f"{local} does not exist and MODEL_MIRROR_URI is not set")
+        cached = os.path.join(self.cache_dir, config_id, os.path.basename(relative))
+        if not os.path.exists(cached):
+            data = read_uri(self.s3_client, f"{self.mirror_uri}/{relative}")
+            os.makedirs(os.path.dirname(cached), exist_ok=True)
+            # Written next to the target and renamed, so no partial file is loaded.
+            tmp = f"{cached}.{uuid.uuid4().hex}.tmp"
+            with open(tmp, "wb") as f:
+                f.write(data)
+            os.replace(tmp, cached)
+        return cached
+
+    def refresh(self) -> bool:
+        """Serve the active version if it is not already served. Returns whether it swapped."""
+        try:
+            resolved = self.resolve()
+            if resolved is None or resolved[0] == self.active_version:
+                return False
+            model = self.model(*resolved)
+        except Exception as exc:
+            print(f"Model refresh failed, keeping {self.active_version}: {exc}")
+            return False
+        if self.batcher is None:
+            self.batcher = MicroBatcher(model)
+        else:
+            self.batcher.swap_model(model)
+        print(f"Serving model {model.name} (was {self.active_version})")
+        self.active_version = model.name
+        self.swaps += 1
+        return True
+
+    def start(self) -> None:
+        """Load the active version now and check for new ones in the background."""
+        self.refresh()
+        self._thread = threading.Thread(target=self._run, name="model-registry", daemon=True)
+        self._thread.start()
+
+    def _run(self) -> None:
+        while not self._stop.wait(self.refresh_s):
+            self.refresh()
+
+    def close(self) -> None:
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+        if self.batcher is not None:
+            self.batcher.close()
+
+    def to_dict(self) -> Dict:
+        return {
+            "active_version": self.active_version,
+            "cached_versions": list(self._models),
+            "loads": self.loads,
+            "swaps": self.swaps,
+        }
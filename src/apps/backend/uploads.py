@@ -0,0 +1,166 @@
+"""
+Upload handling for /inference.
+
+Starlette already spools multipart files to a SpooledTemporaryFile (in memory up
+to 1 MB, on disk beyond), so the handler never needs the whole upload as one
+bytes object. This module caps the request size before and while the body is
+parsed, and gives independent readers over the spooled file so the raw S3
+upload (multipart for large files) can stream it while the decode reads it.
+"""
+from __future__ import annotations
+
+import io
+import os
+from typing import BinaryIO, Iterable
+
+from boto3.s3.transfer import TransferConfig
+from fastapi import HTTPException
+from starlette.responses import JSONResponse
+
+MAX_UPLOAD_MB = int(os.getenv("INFERENCE_MAX_UPLOAD_MB", "200"))
+# Limit for a whole /inference/batch request; each file is also held to MAX_UPLOAD_MB.
+BATCH_MAX_UPLOAD_MB = int(os.getenv("INFERENCE_BATCH_MAX_UPLOAD_MB", "1000"))
+
+# Raw uploads are streamed to S3 on this many threads while the handler decodes.
+RAW_UPLOAD_WORKERS = int(os.getenv("INFERENCE_RAW_UPLOAD_WORKERS", "4"))
+
+# Raw uploads above the threshold go to S3 as a multipart upload. At most
+# max_in_memory_upload_chunks parts (32 MB) are buffered per upload, however
+# large the file.
+RAW_UPLOAD_TRANSFER_CONFIG = TransferConfig(
+    multipart_threshold=8 * 1024 * 1024,
+    multipart_chunksize=8 * 1024 * 1024,
+    max_concurrency=4,
+)
+RAW_UPLOAD_TRANSFER_CONFIG.max_in_memory_upload_chunks = 4
+
+
+class UploadTooLarge(HTTPException):
+    """Raised from inside body parsing; FastAPI passes HTTPExceptions through."""
+
+    def __init__(self, max_bytes: int):
+        super().__init__(status_code=413, detail=f"Upload exceeds {max_bytes // (1024 * 1024)} MB limit")
+
+
+class UploadLimitMiddleware:
+    """
+    Reject requests to the given paths whose body is larger than max_bytes:
+    up front when Content-Length says so, otherwise as soon as the streamed
+    body crosses the limit, before the rest of it is spooled.
+    """
+
+    def __init__(self, app, max_bytes: int, paths: Iterable[str]):
+        self.app = app
+        self.max_bytes = max_bytes
+        self.paths = set(paths)
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or scope["path"] not in self.paths:
+            await self.app(scope, receive, send)
+            return
+
+        declared = dict(scope.get("headers") or []).get(b"content-length")
+        if declared is not None and declared.isdigit() and int(declared) > self.max_bytes:
+            await self._reject(scope, receive, send)
+            return
+
+        received = 0
+
+        async def limited_receive():
+            nonlocal received
+            message = await receive()
+            if message["type"] == "http.request":
+                received += len(message.get("body", b""))
+                if received > self.max_bytes:
+                    raise UploadTooLarge(self.max_bytes)
+            return message
+
+        await self.app(scope, limited_receive, send)
+
+    async def _reject(self, scope, receive, send):
+        exc = UploadTooLarge(self.max_bytes)
+        response = JSONResponse({"detail": exc.detail}, status_code=exc.status_code)
+        await response(scope, receive, send)
+
+
+class _PositionalReader(io.RawIOBase):
+    """
+    Read-only view of a file descriptor with its own position (os.pread), so
+    several threads can read the same spooled file without sharing a cursor.
+    """
+
+    def __init__(self, fd: int, size: int):
+        self._fd = fd
+        self._size = size
+        self._pos = 0
+
+    def readable(self) -> bool:
+        return True
+
+    def seekable(self) -> bool:
+        return True
+
+    def readinto(self, b) -> int:
+        n = os.preadv(self._fd, [b], self._pos)
+        self._pos += n
+        return n
+
+    def seek(self, offset: int, whence: int = io.SEEK_SET) -> int:
+        if whence == io.SEEK_SET:
+            self._pos = offset
+        elif whence == io.SEEK_CUR:
+            self._pos += offset
+        else:
+            self._pos = self._size + offset
+        return self._pos
+
+    def tell(self) -> int:
+        return self._pos
+
+
+def spool_size(spool: BinaryIO) -> int:
+    pos = spool.tell()
+    spool.seek(0, io.SEEK_END)
+    size = spool.tell()
+    spool.seek(pos)
+    return size
+
+
+def open_spool_reader(spool: BinaryIO) -> BinaryIO:
+    """
+    An independent, seekable reader over a spooled upload, read in place from
+    its file descriptor. fileno() rolls a spool still held in memory (under
+    Starlette's 1 MB threshold) over to disk first; in-memory files with no
+    descriptor at all are copied.
+    """
+    try:
+        fd = spool.fileno()
+    except (AttributeError, io.UnsupportedOperation):
+        pos = spool.tell()
+        spool.seek(0)
+        data = spool.read()
+        spool.seek(pos)
+        return io.BytesIO(data)
+    spool.flush()
+    return io.BufferedReader(_PositionalReader(fd, spool_size(spool)), buffer_size=1024 * 1024)
+
+
+def upload_raw_stream(
+    s3_client,
+    bucket: str,
+    key: str,
+    reader: BinaryIO,
+    content_type: str,
+) -> str:
+    """
+    Stream a raw upload to S3, as a multipart upload above the transfer
+    threshold. Returns its s3:// URI.
+    """
+    s3_client.upload_fileobj(
+        reader,
+        bucket,
+        key,
+        ExtraArgs={"ContentType": content_type},
+        Config=RAW_UPLOAD_TRANSFER_CONFIG,
+    )
+    return f"s3://{bucket}/{key}"
@@ -0,0 +1,181 @@
+"""
+Archiving raw images from training/unprocessed/ to training/processed/.
+
+An archive is a copy followed by a delete of the source. Copies go through
+copy_to(): a single CopyObject request for ordinary images, and a managed
+multipart copy (UploadPartCopy in parallel parts) for objects of at least
+ARCHIVE_MULTIPART_COPY_MB, since CopyObject rejects sources over 5 GB.
+
+Archiver lets the driver's archive stage copy concurrently from its workers
+while the deletes are gathered and sent as DeleteObjects requests of up to
+1000 keys. A source is only deleted after its copy has succeeded, and copying
+again is harmless. If the task stops in between, the source is still under
+training/unprocessed/ and the next run (or --resume_run_id) archives it again.
+On storage where a move is an atomic rename (storage.LocalStorage), each
+object is simply renamed.
+"""
+from __future__ import annotations
+
+import os
+import threading
+from typing import Callable, Dict, List, Optional
+
+from boto3.s3.transfer import TransferConfig
+from botocore.exceptions import ClientError
+
+# CopyObject accepts sources of up to 5 GB; larger ones must be copied in parts.
+MAX_SINGLE_COPY_BYTES = 5 * 1024 ** 3
+ARCHIVE_MULTIPART_COPY_MB = int(os.getenv("ARCHIVE_MULTIPART_COPY_MB", "1024"))
+ARCHIVE_COPY_PART_MB = int(os.getenv("ARCHIVE_COPY_PART_MB", "256"))
+ARCHIVE_COPY_CONCURRENCY = int(os.getenv("ARCHIVE_COPY_CONCURRENCY", "8"))
+DELETE_OBJECTS_MAX_KEYS = 1000
+
+
+def processed_key(key: str) -> str:
+    return key.replace("training/unprocessed/", "training/processed/", 1)
+
+
+def multipart_copy(
+    s3_client,
+    bucket: str,
+    key: str,
+    dest_key: str,
+    part_mb: int = ARCHIVE_COPY_PART_MB,
+    concurrency: int = ARCHIVE_COPY_CONCURRENCY,
+) -> None:
+    """Copy an object of any size in parts, keeping its content type and metadata."""
+    head = s3_client.head_object(Bucket=bucket, Key=key)
+    extra = {"Metadata": head.get("Metadata") or {}}
+    if head.get("ContentType"):
+        extra["ContentType"] = head["ContentType"]
+    s3_client.copy(
+        {"Bucket": bucket, "Key": key},
+        bucket,
+        dest_key,
+        ExtraArgs=extra,
+        Config=TransferConfig(
+            multipart_threshold=part_mb * 1024 * 1024,
+            multipart_chunksize=part_mb * 1024 * 1024,
+            max_concurrency=concurrency,
+        ),
+    )
+
+
+def copy_to(
+    s3_client,
+    bucket: str,
+    key: str,
+    dest_key: str,
+    size: Optional[int] = None,
+    multipart_mb: int = ARCHIVE_MULTIPART_COPY_MB,
+) -> None:
+    """
+    Copy key to dest_key within bucket. size (from the listing) picks the
+    method up front; without it, a source CopyObject rejects as too large is
+    copied in parts instead.
+    """
+    if size is not None and size >= min(multipart_mb * 1024 * 1024, MAX_SINGLE_COPY_BYTES):
+        multipart_copy(s3_client, bucket, key, dest_key)
+        return
+    try:
+        s3_client.copy_object(Bucket=bucket, CopySource={"Bucket": bucket, "Key": key}, Key=dest_key)
+    except ClientError as exc:
+        if size is not None or exc.response["Error"]["Code"] != "InvalidRequest":
+            raise
+        multipart_copy(s3_client, bucket, key, dest_key)
+
+
+def delete_keys(s3_client, bucket: str, keys: List[str]) -> Dict[str, str]:
+    """
+    Delete keys with DeleteObjects, 1000 per request. Returns the keys that
+    could not be deleted, with the error message.
+    """
+    failed: Dict[str, str] = {}
+    for start in range(0, len(keys), DELETE_OBJECTS_MAX_KEYS):
+        chunk = keys[start:start + DELETE_OBJECTS_MAX_KEYS]
+        resp = s3_client.delete_objects(
+            Bucket=bucket,
+            Delete={"Objects": [{"Key": k} for k in chunk], "Quiet": True},
+        )
+        for err in resp.get("Errors") or []:
+            failed[err["Key"]] = f"{err.get('Code')}: {err.get('Message')}"
+    return failed
+
+
+class Archiver:
+    """
+    Moves objects to training/processed/ in a storage.Storage: archive()
+    copies right away in the calling thread, and queues the source for a
+    batched delete. on_moved(key) runs once the source is deleted,
+    on_failed(key, exc) if it could not be. Call close() to send the last
+    deletes.
+    """
+
+    def __init__(
+        self,
+        storage,
+        bucket: str,
+        batch_size: int = DELETE_OBJECTS_MAX_KEYS,
+        on_moved: Optional[Callable[[str], None]] = None,
+        on_failed: Optional[Callable[[str, Exception], None]] = None,
+    ):
+        self.storage = storage
+        self.bucket = bucket
+        self.batch_size = min(batch_size, DELETE_OBJECTS_MAX_KEYS)
+        self.on_moved = on_moved
+        self.on_failed = on_failed
+        self.copied = 0
+        self.deleted = 0
+        self.delete_requests = 0
+
+        self._lock = threading.Lock()
+        self._pending: List[str] = []
+
+    def archive(self, key: str, size: Optional[int] = None) -> None:
+        """Copy key to training/processed/ and queue it for deletion. Raises if the copy fails."""
+        if self.storage.renames:
+            self.storage.move(self.bucket, key, processed_key(key), size=size)
+            with self._lock:
+                self.copied += 1
+                self.deleted += 1
+            if self.on_moved is not None:
+                self.on_moved(key)
+            return
+        self.storage.copy(self.bucket, key, processed_key(key), size=size)
+        with self._lock:
+            self.copied += 1
+            self._pending.append(key)
+            batch = self._take_locked(full_only=True)
+        self._delete(batch)
+
+    def flush(self) -> None:
+        with self._lock:
+            batch = self._take_locked(full_only=False)
+        self._delete(batch)
+
+    def close(self) -> None:
+        self.flush()
+
+    def _take_locked(self, full_only: bool) -> List[str]:
+        if not self._pending or (full_only and len(self._pending) < self.batch_size):
+            return []
+        batch, self._pending = self._pending[:self.batch_size], self._pending[self.batch_size:]
+        return batch
+
+    def _delete(self, keys: List[str]) -> None:
+        if not keys:
+            return
+        errors: Dict[str, Exception] = {}
+        try:
+            errors = {k: RuntimeError(msg) for k, msg in self.storage.delete(self.bucket, keys).items()}
+        except Exception as exc:
+            errors = {k: exc for k in keys}
+        with self._lock:
+            self.delete_requests += 1
+            self.deleted += len(keys) - len(errors)
+        for key in keys:
+            if key in errors:
+                if self.on_failed is not None:
+                    self.on_failed(key, errors[key])
+            elif self.on_moved is not None:
+                self.on_moved(key)
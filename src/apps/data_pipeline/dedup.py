@@ -0,0 +1,214 @@
+"""
+Content-addressed dedup for ingested and inferred images.
+
+Raw upload bytes are keyed by their SHA-256, in one namespace per domain:
+
+    <sha>             ingest: the first image_id whose training patches were
+                      written for those bytes (record_image)
+    inference#<sha>   /inference: the image_id, inference_id, score,
+                      explanation and model version of the last persisted
+                      inference of those bytes (record_inference)
+
+The driver looks up get_image and /inference get_inference before doing any
+work, so bytes first seen on /inference are still ingested for training, and
+/inference only reuses a score from the model it is serving now. Entries
+written before the namespaces (no source, but an inference_id) may be either
+and count as a miss for ingest.
+
+The index lives in the DynamoDB table named by DDB_CONTENT_INDEX_TABLE. Without
+it, CONTENT_INDEX_PATH selects a local JSON-file stand-in, and with neither set
+dedup is off.
+"""
+from __future__ import annotations
+
+import hashlib
+import json
+import os
+import threading
+import time
+from decimal import Decimal
+from typing import BinaryIO, Dict, Optional
+
+from botocore.exceptions import ClientError
+
+
+def content_hash(data: bytes) -> str:
+    """SHA-256 hex digest of raw upload bytes."""
+    return hashlib.sha256(data).hexdigest()
+
+
+def content_hash_fileobj(fileobj: BinaryIO, chunk_size: int = 1024 * 1024) -> str:
+    """content_hash for a file-like object, read in chunks from its current position."""
+    h = hashlib.sha256()
+    for chunk in iter(lambda: fileobj.read(chunk_size), b""):
+        h.update(chunk)
+    return h.hexdigest()
+
+
+def _from_dynamo(item: Optional[Dict]) -> Optional[Dict]:
+    if item is None:
+        return None
+    return {k: float(v) if isinstance(v, Decimal) else v for k, v in item.items()}
+
+
+INGEST_SOURCE = "ingest"
+INFERENCE_PREFIX = "inference#"
+
+
+def _inference_key(digest: str) -> str:
+    return f"{INFERENCE_PREFIX}{digest}"
+
+
+def _ingested(item: Optional[Dict]) -> Optional[Dict]:
+    """item if record_image wrote it, else None (see the module docstring)."""
+    if item is None:
+        return None
+    if item.get("source") == INGEST_SOURCE or ("source" not in item and not item.get("inference_id")):
+        return item
+    return None
+
+
+class DynamoContentIndex:
+    """Content index backed by a DynamoDB table with hash key content_hash."""
+
+    def __init__(self, table):
+        self.table = table
+
+    def _get(self, key: str) -> Optional[Dict]:
+        resp = self.table.get_item(Key={"content_hash": key}, ConsistentRead=True)
+        return _from_dynamo(resp.get("Item"))
+
+    def get_image(self, digest: str) -> Optional[Dict]:
+        """The ingest entry of these bytes, or None."""
+        return _ingested(self._get(digest))
+
+    def get_inference(self, digest: str) -> Optional[Dict]:
+        """The inference entry of these bytes, or None."""
+        return self._get(_inference_key(digest))
+
+    def record_image(self, digest: str, image_id: str) -> None:
+        """Remember image_id for these bytes unless another image got there first."""
+        try:
+            self.table.put_item(
+                Item={
+                    "content_hash": digest,
+                    "source": INGEST_SOURCE,
+                    "image_id": image_id,
+                    "created_at": int(time.time() * 1000),
+                },
+                # A pre-namespace entry that counts as a miss is taken over.
+                ConditionExpression=(
+                    "attribute_not_exists(content_hash) "
+                    "OR (attribute_not_exists(#src) AND attribute_exists(inference_id))"
+                ),
+                ExpressionAttributeNames={"#src": "source"},
+            )
+        except ClientError as exc:
+            if exc.response["Error"]["Code"] != "ConditionalCheckFailedException":
+                raise
+
+    def record_inference(
+        self,
+        digest: str,
+        image_id: str,
+        inference_id: str,
+        score: float,
+        explanation: Optional[str],
+        model_version: Optional[str] = None,
+    ) -> None:
+        self.table.update_item(
+            Key={"content_hash": _inference_key(digest)},
+            UpdateExpression=(
+                "SET image_id = :img, "
+                "created_at = if_not_exists(created_at, :now), "
+                "inference_id = :inf, score = :score, explanation = :exp, model_version = :ver"
+            ),
+            ExpressionAttributeValues={
+                ":img": image_id,
+                ":now": int(time.time() * 1000),
+                ":inf": inference_id,
+                ":score": Decimal(str(score)),
+                ":exp": explanation,
+                ":ver": model_version,
+            },
+        )
+
+
+class LocalContentIndex:
+    """
+    In-process stand-in for DynamoContentIndex, optionally persisted to a JSON
+    file so it survives restarts of a single worker.
+    """
+
+    def __init__(self, path: Optional[str] = None):
+        self.path = path
+        self._lock = threading.Lock()
+        self._items: Dict[str, Dict] = {}
+        if path and os.path.exists(path):
+            with open(path) as f:
+                self._items = json.load(f)
+
+    def _get(self, key: str) -> Optional[Dict]:
+        with self._lock:
+            item = self._items.get(key)
+            return dict(item) if item is not None else None
+
+    def get_image(self, digest: str) -> Optional[Dict]:
+        return _ingested(self._get(digest))
+
+    def get_inference(self, digest: str) -> Optional[Dict]:
+        return self._get(_inference_key(digest))
+
+    def record_image(self, digest: str, image_id: str) -> None:
+        with self._lock:
+            if _ingested(self._items.get(digest)) is not None:
+                return
+            self._items[digest] = {
+                "content_hash": digest,
+                "source": INGEST_SOURCE,
+                "image_id": image_id,
+                "created_at": int(time.time() * 1000),
+            }
+            self._save()
+
+    def record_inference(
+        self,
+        digest: str,
+        image_id: str,
+        inference_id: str,
+        score: float,
+        explanation: Optional[str],
+        model_version: Optional[str] = None,
+    ) -> None:
+        key = _inference_key(digest)
+        with self._lock:
+            item = self._items.setdefault(key, {
+                "content_hash": key,
+                "created_at": int(time.time() * 1000),
+            })
+            item.update(
+                image_id=image_id, inference_id=inference_id, score=float(score), explanation=explanation,
+                model_version=model_version,
+            )
+            self._save()
+
+    def _save(self) -> None:
+        if not self.path:
+            return
+        tmp = f"{self.path}.tmp"
+        with open(tmp, "w") as f:
+            json.dump(self._items, f)
+        os.replace(tmp, self.path)
+
+
+def make_content_index(ddb_resource=None):
+    """
+    The content index configured by the environment, or None if dedup is off.
+    """
+    table_name = os.getenv("DDB_CONTENT_INDEX_TABLE")
+    if table_name and ddb_resource is not None:
+        return DynamoContentIndex(ddb_resource.Table(table_name))
+    local_path = os.getenv("CONTENT_INDEX_PATH")
+    if local_path:
+        return LocalContentIndex(local_path)
+    return None
@@ -7,22 +7,91 @@ uploads patches to s3://{PROCESSED_BUCKET}/training/{image_id}/,
 writes metadata to DynamoDB, and moves the original to
 s3://{RAW_BUCKET}/training/processed/.
 
+Images go through a staged pipeline (see pipeline.py) so downloads, decoding,
+patch uploads, DynamoDB writes and archiving overlap:
+
+    list -> download -> decode -> upload -> metadata -> archive
+
+Each stage has its own worker count (--stage_workers), the queues between them
+are bounded (--queue_size) and the bytes held by in-flight images are capped
+(--inflight_mb). --decode_processes moves decoding and patch encoding into a
+pool of worker processes (see procpool.py). --sequential processes one image
+at a time instead.
+
+A run can be split across several tasks with --num_shards; each one takes the
+keys that hash to its --shard_index and reports into the run's RunRecord (see
+runs.py).
+
+--storage local:<root> reads and writes the objects under a local directory,
+{root}/{bucket}/{key}, instead of S3 (see storage.py): raw images are read
+through mmap and archived with a rename. DynamoDB is still used for metadata.
+
+While it runs, each task writes per-stage and per-AWS-service latency
+histograms and its counters (images, patches, bytes, errors, retries) to its
+shard entry every --metrics_flush_s seconds (see metrics.py). --metrics_json
+writes the final summary and metrics as JSON, "-" prints them as one line.
+
+All S3 and DynamoDB requests share one adaptive rate limiter per service
+(see ratelimit.py): when the services throttle, the workers slow down to the
+rate they accept and retry, instead of failing the images.
+
+Pipeline runs record how far each key got in a progress manifest (see
+manifest.py). --resume_run_id continues a run whose task died: keys whose
+patches were already uploaded go straight to the DynamoDB writes, keys whose
+records were written are only archived. Image and patch ids are derived from
+the run and the key, so keys processed again in the same run overwrite their
+earlier patches and records, while a later upload under the same name gets
+an id of its own.
+
 Usage (called via ECS container override from /process_data endpoint):
-    python -m src.apps.data_pipeline.driver --run_id <uuid>
+    python -m src.apps.data_pipeline.driver --run_id <uuid> [--shard_index i --num_shards n]
+    python -m src.apps.data_pipeline.driver --resume_run_id <uuid> [--shard_index i --num_shards n]
 """
 from __future__ import annotations
 
 import argparse
+import json
 import os
+import threading
 import time
 import uuid
-from typing import List, Optional
+from dataclasses import dataclass, field
+from typing import Callable, Dict, Iterable, Iterator, List, Optional
 
 import boto3
-from PIL import Image
-from io import BytesIO
-
-from src.apps.data_pipeline.process import process_image_to_patches
+from botocore.config import Config
+
+from src.apps.data_pipeline.archive import Archiver, processed_key
+from src.apps.data_pipeline.dedup import content_hash, make_content_index
+from src.apps.data_pipeline.encoding import PATCH_ENCODERS
+from src.apps.data_pipeline.listing import DRIVER_LIST_WORKERS, iter_objects, iter_objects_partitioned
+from src.apps.data_pipeline.manifest import RunManifest, load_manifest, stage_reached
+from src.apps.data_pipeline.metadata import BatchWriter, batch_put, patch_record_item, upsert_image_record
+from src.apps.data_pipeline.metrics import DRIVER_METRICS_FLUSH_S, MetricsReporter, RunMetrics, instrument_client
+from src.apps.data_pipeline.pipeline import HELD, ByteBudget, Pipeline, Stage, parse_stage_workers
+from src.apps.data_pipeline.procpool import DRIVER_DECODE_PROCESSES, DecodePool
+from src.apps.data_pipeline.process import (
+    PATCH_FORMAT,
+    PATCH_UPLOAD_WORKERS,
+    S3_MAX_POOL_CONNECTIONS,
+    decode_image,
+    extract_patches,
+    plan_patch_uploads,
+    process_image_to_patches,
+    s3_client_config,
+    shard_patches,
+    upload_patches,
+)
+from src.apps.data_pipeline.ratelimit import limit_client
+from src.apps.data_pipeline.runs import (
+    finish_shard,
+    shard_for_key,
+    shard_name,
+    start_shard,
+    update_shard_metrics,
+)
+from src.apps.data_pipeline.shards import PATCH_SHARD_MAX_MB, ShardWriter, make_shard_writer
+from src.apps.data_pipeline.storage import DRIVER_STORAGE, S3Storage, as_storage, make_storage
 
 IMAGE_EXTENSIONS = {".jpg", ".jpeg", ".png", ".bmp", ".tiff", ".webp"}
 
@@ -33,6 +102,19 @@ RAW_PREFIX = "training/unprocessed/"
 RAW_DONE_PREFIX = "training/processed/"
 PROCESSED_PREFIX = "training"
 
+# Pipeline defaults; DRIVER_STAGE_WORKERS overrides them as "stage=N,...".
+DEFAULT_STAGE_WORKERS: Dict[str, int] = {
+    "download": 8,
+    "decode": max(1, os.cpu_count() or 1),
+    "upload": 4,
+    "metadata": 4,
+    "archive": 8,
+}
+DRIVER_STAGE_WORKERS = os.getenv("DRIVER_STAGE_WORKERS", "")
+DRIVER_QUEUE_SIZE = int(os.getenv("DRIVER_QUEUE_SIZE", "8"))
+DRIVER_INFLIGHT_MB = int(os.getenv("DRIVER_INFLIGHT_MB", "1024"))
+DRIVER_METRICS_JSON = os.getenv("DRIVER_METRICS_JSON", "")
+
 
 def now_ms() -> int:
     return int(time.time() * 1000)
@@ -40,20 +122,79 @@ def now_ms() -> int:
 
 def parse_args() -> argparse.Namespace:
     p = argparse.ArgumentParser(description="ArtGuard data processing driver")
-    p.add_argument("--run_id", required=True)
-    return p.parse_args()
+    p.add_argument("--run_id")
+    p.add_argument("--resume_run_id",
+                   help="Continue this run, skipping the work its progress manifest records as done")
+    p.add_argument("--shard_index", type=int, default=0,
+                   help="Which share of the unprocessed keys this task handles (0-based)")
+    p.add_argument("--num_shards", type=int, default=1,
+                   help="Number of tasks the run is split across; keys are assigned by hash")
+    p.add_argument("--upload_workers", type=int, default=PATCH_UPLOAD_WORKERS,
+                   help="Concurrent patch uploads per image")
+    p.add_argument("--patch_format", default=PATCH_FORMAT, choices=sorted(PATCH_ENCODERS),
+                   help="Storage format for patch files")
+    p.add_argument("--shard_max_mb", type=int, default=PATCH_SHARD_MAX_MB,
+                   help="Pack patches into shards of at most this size (0 = one object per patch)")
+    p.add_argument("--stage_workers", default=DRIVER_STAGE_WORKERS,
+                   help="Per-stage worker counts, e.g. download=16,decode=2 "
+                        f"(stages: {', '.join(DEFAULT_STAGE_WORKERS)})")
+    p.add_argument("--queue_size", type=int, default=DRIVER_QUEUE_SIZE,
+                   help="Capacity of the queue in front of each stage")
+    p.add_argument("--inflight_mb", type=int, default=DRIVER_INFLIGHT_MB,
+                   help="Cap on raw and decoded image bytes held in the pipeline")
+    p.add_argument("--decode_processes", type=int, default=DRIVER_DECODE_PROCESSES,
+                   help="Decode and encode patches in this many worker processes (0 = threads)")
+    p.add_argument("--list_workers", type=int, default=DRIVER_LIST_WORKERS,
+                   help="List the unprocessed prefix in 16 key ranges (by leading hex character) "
+                        "on this many threads (0 = one sequential listing)")
+    p.add_argument("--storage", default=DRIVER_STORAGE,
+                   help="Where the buckets live: 's3', or 'local:<root>' for directories <root>/<bucket>")
+    p.add_argument("--metrics_flush_s", type=float, default=DRIVER_METRICS_FLUSH_S,
+                   help="Write live metrics to the run record this often (0 = only at the end)")
+    p.add_argument("--metrics_json", default=DRIVER_METRICS_JSON,
+                   help="Write the final summary and metrics to this JSON file ('-' = print)")
+    p.add_argument("--sequential", action="store_true",
+                   help="Process one image at a time instead of pipelining")
+    args = p.parse_args()
+    if args.resume_run_id:
+        if args.run_id and args.run_id != args.resume_run_id:
+            p.error("--run_id and --resume_run_id name different runs")
+        if args.sequential:
+            p.error("--resume_run_id needs the pipeline; drop --sequential")
+        args.run_id = args.resume_run_id
+    elif not args.run_id:
+        p.error("one of --run_id or --resume_run_id is required")
+    if args.num_shards < 1 or not 0 <= args.shard_index < args.num_shards:
+        p.error("--shard_index must be in [0, --num_shards)")
+    try:
+        make_storage(args.storage, None)
+    except ValueError as exc:
+        p.error(str(exc))
+    return args
+
+
+def iter_unprocessed_objects(s3_client, bucket: str, prefix: str, list_workers: int = 0) -> Iterator[Dict]:
+    """
+    Image objects under prefix, as {"Key", "Size"} dicts, yielded as the
+    listing pages arrive. With list_workers, S3 key ranges are listed in
+    parallel (see listing.iter_objects_partitioned) and objects come in arrival
+    order. s3_client may also be a storage.Storage.
+    """
+    storage = as_storage(s3_client)
+    if not isinstance(storage, S3Storage):
+        return storage.iter_objects(bucket, prefix, extensions=IMAGE_EXTENSIONS)
+    if list_workers > 0:
+        return iter_objects_partitioned(storage.s3_client, bucket, prefix, list_workers, extensions=IMAGE_EXTENSIONS)
+    return iter_objects(storage.s3_client, bucket, prefix, extensions=IMAGE_EXTENSIONS)
+
+
+def list_unprocessed_objects(s3_client, bucket: str, prefix: str) -> List[Dict]:
+    """Image objects under prefix, as {"Key", "Size"} dicts."""
+    return list(iter_unprocessed_objects(s3_client, bucket, prefix))
 
 
 def list_unprocessed_keys(s3_client, bucket: str, prefix: str) -> List[str]:
-    keys: List[str] = []
-    paginator = s3_client.get_paginator("list_objects_v2")
-    for page in paginator.paginate(Bucket=bucket, Prefix=prefix):
-        for obj in page.get("Contents", []):
-            key = obj["Key"]
-            ext = os.path.splitext(key)[1].lower()
-            if ext in IMAGE_EXTENSIONS:
-                keys.append(key)
-    return keys
+    return [obj["Key"] for obj in list_unprocessed_objects(s3_client, bucket, prefix)]
 
 
 def extract_image_id(key: str) -> Optional[str]:
@@ -69,43 +210,130 @@ def extract_image_id(key: str) -> Optional[str]:
     return None
 
 
-def image_record_exists(img_table, image_id: str) -> bool:
-    """Check if an ImageRecord already exists in DynamoDB."""
-    resp = img_table.get_item(Key={"image_id": image_id}, ProjectionExpression="image_id")
-    return "Item" in resp
+def image_id_for_key(key: str, run_id: str) -> str:
+    """
+    image_id of the image at key: the one in the key path, or for flat-structure
+    uploads one derived from the run and the key. A resumed run gives the key
+    the same id again; a later upload under the same name (the key is free
+    once the image moved to processed/) gets a new one in its own run.
+    """
+    return extract_image_id(key) or str(uuid.uuid5(uuid.NAMESPACE_URL, f"artguard-image:{run_id}:{key}"))
 
 
 def download(s3_client, bucket: str, key: str) -> bytes:
-    resp = s3_client.get_object(Bucket=bucket, Key=key)
-    return resp["Body"].read()
+    """The object's bytes; from LocalStorage, a read-only mmap of the file."""
+    return as_storage(s3_client).get(bucket, key)
 
 
 def write_patch_records(
     patch_table, image_id: str, patches: List[dict], created_at: int
 ) -> None:
-    for p in patches:
-        patch_table.put_item(Item={
-            "patch_id": p["patch_id"],
-            "image_id": image_id,
-            "patch_type": p["patch_type"],
-            "patch_path": p["patch_path"],
-            "patch_x": int(p["patch_x"]),
-            "patch_y": int(p["patch_y"]),
-            "patch_width": int(p["patch_width"]),
-            "patch_height": int(p["patch_height"]),
-            "created_at": int(created_at),
-        })
-
-
-def move_to_processed(s3_client, bucket: str, key: str) -> None:
-    """Move from training/unprocessed/ to training/processed/ in the raw bucket."""
-    dest_key = key.replace("training/unprocessed/", "training/processed/", 1)
-    s3_client.copy_object(
-        Bucket=bucket,
-        CopySource={"Bucket": bucket, "Key": key},
-        Key=dest_key,
+    batch_put(patch_table, [patch_record_item(image_id, p, created_at) for p in patches])
+
+
+def move_to_processed(s3_client, bucket: str, key: str, size: Optional[int] = None) -> None:
+    """
+    Move from training/unprocessed/ to training/processed/ in the raw bucket.
+    The pipeline batches the deletes instead (see archive.Archiver).
+    """
+    as_storage(s3_client).move(bucket, key, processed_key(key), size=size)
+
+
+def record_duplicate(
+    img_table,
+    raw_bucket: str,
+    key: str,
+    run_id: str,
+    original_image_id: str,
+) -> None:
+    """
+    Point the ImageRecord of an image whose bytes were already processed at the
+    original image's patches via duplicate_of.
+    """
+    image_id = image_id_for_key(key, run_id)
+    if image_id == original_image_id:
+        return
+    img_table.update_item(
+        Key={"image_id": image_id},
+        UpdateExpression=(
+            "SET run_id = :r, duplicate_of = :d, "
+            "image_name = if_not_exists(image_name, :n), "
+            "image_path = if_not_exists(image_path, :p), "
+            "created_at = if_not_exists(created_at, :c)"
+        ),
+        ExpressionAttributeValues={
+            ":r": run_id,
+            ":d": original_image_id,
+            ":n": os.path.basename(key),
+            ":p": f"s3://{raw_bucket}/{key}",
+            ":c": now_ms(),
+        },
     )
-    s3_client.delete_object(Bucket=bucket, Key=key)
+
+
+def link_duplicate(
+    s3_client,
+    img_table,
+    raw_bucket: str,
+    key: str,
+    run_id: str,
+    original_image_id: str,
+) -> None:
+    """
+    Handle an image whose bytes were already processed: record it as a
+    duplicate (see record_duplicate) and archive it, without decoding or
+    writing any patches.
+    """
+    record_duplicate(img_table, raw_bucket, key, run_id, original_image_id)
+    move_to_processed(s3_client, raw_bucket, key)
+
+
+def write_image_record(
+    img_table,
+    raw_bucket: str,
+    key: str,
+    image_id: str,
+    run_id: str,
+    created_at: int,
+    width: int,
+    height: int,
+) -> None:
+    """
+    Create the ImageRecord, or set run_id on an existing one (the upload script
+    may have already written it with label/sublabel metadata from the CSV).
+    """
+    upsert_image_record(img_table, image_id, {
+        "created_at": created_at,
+        "image_name": os.path.basename(key),
+        "image_path": f"s3://{raw_bucket}/{key}",
+        "image_width": width,
+        "image_height": height,
+    }, run_id=run_id)
+
+
+def write_image_metadata(
+    img_table,
+    patch_table,
+    raw_bucket: str,
+    key: str,
+    image_id: str,
+    run_id: str,
+    created_at: int,
+    width: int,
+    height: int,
+    patches: List[dict],
+    content_index=None,
+    digest: Optional[str] = None,
+) -> None:
+    """
+    Write the ImageRecord and PatchRecords for one processed image, and record
+    its bytes in content_index if given.
+    """
+    write_image_record(img_table, raw_bucket, key, image_id, run_id, created_at, width, height)
+    write_patch_records(patch_table, image_id=image_id, patches=patches, created_at=created_at)
+
+    if content_index is not None and digest:
+        content_index.record_image(digest, image_id)
 
 
 def process_single_image(
@@ -116,27 +344,43 @@ def process_single_image(
     processed_bucket: str,
     key: str,
     run_id: str,
+    upload_workers: int = PATCH_UPLOAD_WORKERS,
+    patch_format: str = PATCH_FORMAT,
+    shard_writer: Optional[ShardWriter] = None,
+    content_index=None,
+    on_committed: Optional[Callable[[int], None]] = None,
+    on_failed: Optional[Callable[[Exception], None]] = None,
 ) -> int:
-    """Process one image from S3. Returns the number of patches created."""
+    """
+    Process one image from S3. Returns the number of patches created.
+    With a shard_writer, the DynamoDB writes and the move to training/processed/
+    are deferred until the shards holding this image's patches are uploaded;
+    on_committed then gets the number of patches, or on_failed the error.
+    Without one they happen before returning, and errors are raised.
+    With a content_index, bytes seen before are linked to the existing patches
+    instead of being processed again.
+    """
     img_bytes = download(s3_client, raw_bucket, key)
 
+    digest = content_hash(img_bytes)
+    if content_index is not None:
+        hit = content_index.get_image(digest)
+        if hit is not None:
+            link_duplicate(s3_client, img_table, raw_bucket, key, run_id, hit["image_id"])
+            print(f"  DUPLICATE of image {hit['image_id']}, linked")
+            return 0
+
     try:
-        img = Image.open(BytesIO(img_bytes)).convert("RGB")
+        img, (w, h) = decode_image(img_bytes)
     except Exception as exc:
         print(f"  SKIP (not a valid image): {exc}")
         return 0
 
-    w, h = img.size
     created_at = now_ms()
-    filename = os.path.basename(key)
 
     # Use existing image_id from key path (training/unprocessed/{image_id}/{filename})
-    # or generate a new one for flat-structure uploads
-    existing_id = extract_image_id(key)
-    if existing_id:
-        image_id = existing_id
-    else:
-        image_id = str(uuid.uuid4())
+    # or derive one for flat-structure uploads
+    image_id = image_id_for_key(key, run_id)
 
     patches = process_image_to_patches(
         img=img,
@@ -144,95 +388,603 @@ def process_single_image(
         processed_bucket=processed_bucket,
         processed_prefix=PROCESSED_PREFIX,
         s3_client=s3_client,
+        max_workers=upload_workers,
+        source_size=(w, h),
+        patch_format=patch_format,
+        shard_writer=shard_writer,
     )
 
-    # Only create ImageRecord if one doesn't already exist (the upload script
-    # may have already written it with label/sublabel metadata from the CSV).
-    if not image_record_exists(img_table, image_id):
-        img_table.put_item(Item={
-            "image_id": image_id,
-            "created_at": created_at,
-            "image_name": filename,
-            "image_path": f"s3://{raw_bucket}/{key}",
-            "image_width": w,
-            "image_height": h,
-            "run_id": run_id,
-        })
-    else:
-        # Update existing record with run_id
-        img_table.update_item(
-            Key={"image_id": image_id},
-            UpdateExpression="SET run_id = :r",
-            ExpressionAttributeValues={":r": run_id},
+    def commit() -> None:
+        write_image_metadata(
+            img_table, patch_table, raw_bucket, key, image_id, run_id, created_at, w, h, patches,
+            content_index=content_index, digest=digest,
         )
-
-    write_patch_records(patch_table, image_id=image_id, patches=patches, created_at=created_at)
-
-    # Move original from training/unprocessed/ to training/processed/ in the raw bucket
-    move_to_processed(s3_client, raw_bucket, key)
+        # Move original from training/unprocessed/ to training/processed/ in the raw bucket
+        move_to_processed(s3_client, raw_bucket, key)
+
+    if shard_writer is not None:
+        def commit_deferred() -> None:
+            commit()
+            if on_committed is not None:
+                on_committed(len(patches))
+
+        shard_writer.defer(
+            commit_deferred,
+            on_failed or (lambda exc: print(f"  ERROR committing {key}: {exc}")),
+            shard_uris={p["shard_uri"] for p in patches},
+        )
+    else:
+        commit()
 
     return len(patches)
 
 
-def main() -> None:
-    args = parse_args()
-    run_id = args.run_id
+# One image on its way through the pipeline. charged is what it currently
+# holds of the pipeline's ByteBudget; resumed is the key's manifest entry from
+# an earlier attempt at the run; started is when it was listed.
+@dataclass
+class ImageWork:
+    key: str
+    size: int
+    image_id: str = ""
+    data: Optional[bytes] = None
+    digest: Optional[str] = None
+    duplicate_of: Optional[str] = None
+    width: int = 0
+    height: int = 0
+    created_at: int = 0
+    patches: List[dict] = field(default_factory=list)
+    uploads: Optional[list] = None
+    charged: int = 0
+    resumed: Optional[Dict] = None
+    started: float = 0.0
+
+
+class DriverPipeline:
+    """
+    The driver's stages over a shared set of clients:
+
+        download  fetch the raw bytes (charging them to the byte budget), hash
+                  them and look them up in the content index
+        decode    decode and extract patches, in decode_pool's worker processes
+                  (which also encode them) if given; with a shard writer, the
+                  patches are encoded straight into the current shard
+        upload    upload the patch files; with a shard writer, hold the image
+                  until its shard is uploaded
+        metadata  ImageRecord upsert, PatchRecords (batched across images,
+                  holding the image until its batch is written) and content
+                  index entry, or the duplicate_of link for a duplicate
+        archive   copy the original to training/processed/; the sources are
+                  deleted in batches of up to 1000 (see archive.Archiver)
+
+    Each stage records its key's progress in manifest, if given. Items resumed
+    from checkpoint (key -> manifest entry of an earlier attempt) skip the
+    stages their entry shows as done. Stage timings, counters and the time
+    each image takes end to end go into metrics.
+    """
 
-    region = os.getenv("AWS_REGION")
-    raw_bucket = os.getenv("S3_IMAGES_RAW_BUCKET")
-    processed_bucket = os.getenv("S3_IMAGES_PROCESSED_BUCKET")
-    img_table_name = os.getenv("DDB_IMAGES_TABLE")
-    patch_table_name = os.getenv("DDB_PATCHES_TABLE")
-    runs_table_name = os.getenv("DDB_RUNS_TABLE")
+    def __init__(
+        self,
+        storage,
+        img_table,
+        patch_table,
+        raw_bucket: str,
+        processed_bucket: str,
+        run_id: str,
+        stage_workers: Dict[str, int],
+        queue_size: int = DRIVER_QUEUE_SIZE,
+        inflight_bytes: int = DRIVER_INFLIGHT_MB * 1024 * 1024,
+        upload_workers: int = PATCH_UPLOAD_WORKERS,
+        patch_format: str = PATCH_FORMAT,
+        shard_writer: Optional[ShardWriter] = None,
+        content_index=None,
+        decode_pool: Optional[DecodePool] = None,
+        manifest: Optional[RunManifest] = None,
+        checkpoint: Optional[Dict[str, Dict]] = None,
+        metrics: Optional[RunMetrics] = None,
+    ):
+        self.storage = as_storage(storage)
+        self.img_table = img_table
+        self.patch_table = patch_table
+        self.raw_bucket = raw_bucket
+        self.processed_bucket = processed_bucket
+        self.run_id = run_id
+        self.upload_workers = upload_workers
+        self.patch_format = patch_format
+        self.shard_writer = shard_writer
+        self.content_index = content_index
+        self.decode_pool = decode_pool
+        self.manifest = manifest
+        self.checkpoint = checkpoint or {}
+        self.metrics = metrics or RunMetrics()
+        self.budget = ByteBudget(inflight_bytes)
+        self.patch_writer = BatchWriter(patch_table)
+        self.archiver = Archiver(self.storage, raw_bucket, on_moved=self._moved, on_failed=self._archive_failed)
+
+        self.total = 0
+        self.done = 0
+        self.patches = 0
+        self.errors = 0
+        self.resumed = 0
+        self.first_image_s: Optional[float] = None
+        self._t0 = 0.0
+        self._lock = threading.Lock()
+        # digest -> image_id of the first image with those bytes in this run,
+        # so copies in flight together are still caught before the index has
+        # been written.
+        self._claimed: Dict[str, str] = {}
+
+        self.pipeline = Pipeline(
+            [
+                Stage("download", self.download, stage_workers["download"]),
+                Stage("decode", self.decode, stage_workers["decode"]),
+                Stage("upload", self.upload, stage_workers["upload"],
+                      on_close=shard_writer.close if shard_writer is not None else None),
+                Stage("metadata", self.write_metadata, stage_workers["metadata"],
+                      on_close=self.patch_writer.close),
+                Stage("archive", self.archive, stage_workers["archive"], on_close=self.archiver.close),
+            ],
+            queue_size=queue_size,
+            on_error=self._on_error,
+            on_finish=self._on_finish,
+            metrics=self.metrics,
+        )
+        self.metrics.gauge("inflight_mb", lambda: self.budget.in_flight / (1024 * 1024))
+        self.metrics.gauge("queued", self.pipeline.queue_depths)
+        self.metrics.gauge("patch_record_retries", lambda: self.patch_writer.retries)
+
+    def run(self, objects: Iterable[Dict]) -> None:
+        """Process objects, which may be a listing still in progress."""
+        self._t0 = time.perf_counter()
+        self.pipeline.run(self._work(o) for o in objects)
+
+    def _work(self, obj: Dict) -> ImageWork:
+        self.total += 1
+        item = ImageWork(key=obj["Key"], size=int(obj.get("Size") or 0), started=time.perf_counter())
+        entry = self.checkpoint.get(item.key)
+        # A key recorded as moved that is listed again is a new upload.
+        if entry and not stage_reached(entry, "moved"):
+            item.resumed = entry
+            self.resumed += 1
+            self.metrics.incr("resumed")
+        return item
+
+    def _record(self, item: ImageWork, stage: str, **data) -> None:
+        if self.manifest is not None:
+            self.manifest.record(item.key, stage, image_id=item.image_id, **data)
+
+    def _record_patched(self, item: ImageWork) -> None:
+        self._record(
+            item, "patched", digest=item.digest, width=item.width, height=item.height,
+            created_at=item.created_at, patches=item.patches,
+        )
 
-    s3 = boto3.client("s3", region_name=region)
-    ddb = boto3.resource("dynamodb", region_name=region)
-    img_table = ddb.Table(img_table_name)
-    patch_table = ddb.Table(patch_table_name)
-    runs_table = ddb.Table(runs_table_name)
+    def _charge(self, item: ImageWork, nbytes: int) -> None:
+        self.budget.adjust(item.charged, nbytes)
+        item.charged = nbytes
+
+    def download(self, item: ImageWork) -> ImageWork:
+        entry = item.resumed
+        if entry is not None:
+            item.image_id = entry.get("image_id") or image_id_for_key(item.key, self.run_id)
+            if entry.get("duplicate_of"):
+                item.digest, item.duplicate_of = entry.get("digest"), entry["duplicate_of"]
+                return item
+            if stage_reached(entry, "patched"):
+                # Patches already in S3: reuse them, no download or decode.
+                item.digest = entry.get("digest")
+                item.width, item.height = int(entry["width"]), int(entry["height"])
+                item.created_at = int(entry["created_at"])
+                item.patches = entry["patches"]
+                if item.digest:
+                    with self._lock:
+                        self._claimed.setdefault(item.digest, item.image_id)
+                return item
+
+        self.budget.acquire(item.size)
+        item.charged = item.size
+        item.data = download(self.storage, self.raw_bucket, item.key)
+        self._charge(item, len(item.data))
+
+        item.digest = content_hash(item.data)
+        item.image_id = item.image_id or image_id_for_key(item.key, self.run_id)
+        if self.content_index is not None:
+            hit = self.content_index.get_image(item.digest)
+            with self._lock:
+                first = self._claimed.setdefault(item.digest, item.image_id)
+            if hit is not None:
+                item.duplicate_of = hit["image_id"]
+            elif first != item.image_id:
+                item.duplicate_of = first
+            if item.duplicate_of is not None:
+                item.data = None
+                self._charge(item, 0)
+        self._record(item, "downloaded", digest=item.digest, duplicate_of=item.duplicate_of)
+        return item
+
+    def _patched(self, item: ImageWork) -> bool:
+        return item.duplicate_of is not None or stage_reached(item.resumed, "patched")
+
+    def decode(self, item: ImageWork) -> Optional[ImageWork]:
+        if self._patched(item):
+            return item
+        if self.decode_pool is not None:
+            decoded = self.decode_pool.decode(item.data, self.patch_format)
+            if decoded is None:
+                self.metrics.incr("skipped")
+                print(f"  SKIP {item.key} (not a valid image)")
+                return None
+            item.width, item.height = decoded.width, decoded.height
+            batch, meta, nbytes = decoded.encoded, decoded.meta, decoded.nbytes
+        else:
+            try:
+                img, (item.width, item.height) = decode_image(item.data)
+            except Exception as exc:
+                self.metrics.incr("skipped")
+                print(f"  SKIP {item.key} (not a valid image): {exc}")
+                return None
+            batch, meta = extract_patches(img, source_size=(item.width, item.height))
+            nbytes = batch.nbytes
+            del img
+        item.data = None
+        item.created_at = now_ms()
+
+        if self.shard_writer is not None:
+            item.patches = shard_patches(
+                batch, meta, self.shard_writer, patch_format=self.patch_format, image_id=item.image_id,
+            )
+            self._charge(item, 0)
+        else:
+            item.patches, item.uploads = plan_patch_uploads(
+                batch=batch,
+                meta=meta,
+                image_id=item.image_id,
+                processed_bucket=self.processed_bucket,
+                processed_prefix=PROCESSED_PREFIX,
+                patch_format=self.patch_format,
+                storage=self.storage,
+            )
+            self._charge(item, nbytes)
+        return item
+
+    def upload(self, item: ImageWork):
+        if self._patched(item):
+            return item
+        if self.shard_writer is not None:
+            def shard_uploaded() -> None:
+                self._record_patched(item)
+                self.pipeline.put("metadata", item)
+
+            def shard_failed(exc: Exception) -> None:
+                self._on_error("upload", item, exc)
+                self._on_finish(item)
+
+            self.shard_writer.defer(shard_uploaded, shard_failed, shard_uris={p["shard_uri"] for p in item.patches})
+            return HELD
+        upload_patches(self.storage, self.processed_bucket, item.uploads, max_workers=self.upload_workers)
+        item.uploads = None
+        self._charge(item, 0)
+        self._record_patched(item)
+        return item
+
+    def write_metadata(self, item: ImageWork):
+        if stage_reached(item.resumed, "records_written"):
+            return item
+        if item.duplicate_of is not None:
+            record_duplicate(self.img_table, self.raw_bucket, item.key, self.run_id, item.duplicate_of)
+            self._record(item, "records_written")
+            return item
+
+        write_image_record(
+            self.img_table, self.raw_bucket, item.key, item.image_id, self.run_id,
+            item.created_at, item.width, item.height,
+        )
 
-    # Record run as started
-    runs_table.put_item(Item={
-        "run_id": run_id,
-        "created_at": now_ms(),
-        "status": "running",
-    })
+        def records_written() -> None:
+            if self.content_index is not None and item.digest:
+                self.content_index.record_image(item.digest, item.image_id)
+            self._record(item, "records_written")
+            self.pipeline.put("archive", item)
 
-    keys = list_unprocessed_keys(s3, raw_bucket, RAW_PREFIX)
-    total = len(keys)
-    print(f"Found {total} images in s3://{raw_bucket}/{RAW_PREFIX}")
+        def records_failed(exc: Exception) -> None:
+            self._on_error("metadata", item, exc)
+            self._on_finish(item)
 
+        self.patch_writer.put(
+            [patch_record_item(item.image_id, p, item.created_at) for p in item.patches],
+            records_written, records_failed,
+        )
+        return HELD
+
+    def archive(self, item: ImageWork) -> ImageWork:
+        self.archiver.archive(item.key, size=item.size or None)
+        with self._lock:
+            self.done += 1
+            self.patches += len(item.patches)
+            done = self.done
+            if self.first_image_s is None:
+                self.first_image_s = time.perf_counter() - self._t0
+        self.metrics.observe("image", time.perf_counter() - item.started)
+        self.metrics.incr("images")
+        self.metrics.incr("patches", len(item.patches))
+        if item.duplicate_of is not None:
+            self.metrics.incr("duplicates")
+            print(f"[{done}/{self.total}] {item.key}: DUPLICATE of image {item.duplicate_of}, linked")
+        else:
+            print(f"[{done}/{self.total}] {item.key}: {len(item.patches)} patches")
+        return item
+
+    def _moved(self, key: str) -> None:
+        if self.manifest is not None:
+            self.manifest.record(key, "moved")
+
+    def _archive_failed(self, key: str, exc: Exception) -> None:
+        with self._lock:
+            self.errors += 1
+        self.metrics.incr("errors")
+        print(f"  ERROR deleting {key} after archiving: {exc}")
+
+    def _on_error(self, stage: str, item: Optional[ImageWork], exc: Exception) -> None:
+        with self._lock:
+            self.errors += 1
+        self.metrics.incr("errors")
+        self.metrics.incr(f"errors.{stage}")
+        where = item.key if item is not None else "(stage close)"
+        print(f"  ERROR in {stage} for {where}: {exc}")
+
+    def _on_finish(self, item: ImageWork) -> None:
+        item.data = None
+        item.uploads = None
+        self._charge(item, 0)
+
+    def summary(self) -> Dict:
+        """Throughput and per-stage timings for the run record and log."""
+        wall = self.pipeline.wall_s
+        return {
+            "wall_s": wall,
+            "images_per_s": self.done / wall if wall > 0 else 0.0,
+            "first_image_s": self.first_image_s,
+            "resumed": self.resumed,
+            "patch_record_batches": self.patch_writer.batches,
+            "archive_delete_requests": self.archiver.delete_requests,
+            "budget_wait_s": self.budget.wait_s,
+            "peak_inflight_mb": self.budget.peak / (1024 * 1024),
+            "stages": {
+                name: {"workers": st.workers, "items": st.items, "errors": st.errors, "busy_s": st.busy_s}
+                for name, st in self.pipeline.stats.items()
+            },
+        }
+
+
+def print_summary(summary: Dict) -> None:
+    print(f"\nPipeline: {summary['wall_s']:.2f} s, {summary['images_per_s']:.2f} images/s, "
+          f"peak in flight {summary['peak_inflight_mb']:.1f} MB, "
+          f"budget wait {summary['budget_wait_s']:.2f} s")
+    if summary.get("first_image_s") is not None:
+        print(f"First image archived after {summary['first_image_s']:.2f} s")
+    print(f"{'stage':>10} {'workers':>8} {'items':>6} {'errors':>7} {'busy s':>8} {'busy/worker':>12}")
+    for name, st in summary["stages"].items():
+        share = st["busy_s"] / (st["workers"] * summary["wall_s"]) if summary["wall_s"] > 0 else 0.0
+        print(f"{name:>10} {st['workers']:>8} {st['items']:>6} {st['errors']:>7} "
+              f"{st['busy_s']:>8.2f} {share:>11.0%}")
+
+
+def run_sequential(args, storage, img_table, patch_table, raw_bucket, processed_bucket,
+                   keys: List[str], shard_writer, content_index, metrics: RunMetrics) -> Dict:
+    """The one-image-at-a-time loop. Returns the summary counts."""
+    total = len(keys)
     total_patches = 0
     errors = 0
+    t0 = time.perf_counter()
+
+    # With a shard writer, an image's patches count once its records are
+    # committed, which may be while a later image is processed or on close.
+    def committed(n: int) -> None:
+        nonlocal total_patches
+        total_patches += n
+        metrics.incr("patches", n)
+
+    def commit_failed(key: str, exc: Exception) -> None:
+        nonlocal errors
+        errors += 1
+        metrics.incr("errors")
+        print(f"  ERROR committing {key}: {exc}")
 
     for i, key in enumerate(keys, 1):
         print(f"[{i}/{total}] Processing {key}")
+        started = time.perf_counter()
         try:
             n = process_single_image(
-                s3_client=s3,
+                s3_client=storage,
                 img_table=img_table,
                 patch_table=patch_table,
                 raw_bucket=raw_bucket,
                 processed_bucket=processed_bucket,
                 key=key,
-                run_id=run_id,
+                run_id=args.run_id,
+                upload_workers=args.upload_workers,
+                patch_format=args.patch_format,
+                shard_writer=shard_writer,
+                content_index=content_index,
+                on_committed=committed,
+                on_failed=lambda exc, key=key: commit_failed(key, exc),
             )
-            total_patches += n
+            if shard_writer is None:
+                committed(n)
+            metrics.observe("image", time.perf_counter() - started)
+            metrics.incr("images")
             print(f"  -> {n} patches created")
         except Exception as exc:
             errors += 1
+            metrics.incr("errors")
             print(f"  ERROR: {exc}")
 
-    # Update run record with final status
+    if shard_writer is not None:
+        shard_writer.close()
+
+    wall = time.perf_counter() - t0
+    return {
+        "patches": total_patches,
+        "errors": errors,
+        "wall_s": wall,
+        "images_per_s": total / wall if wall > 0 else 0.0,
+    }
+
+
+def main() -> None:
+    args = parse_args()
+    run_id = args.run_id
+    stage_workers = parse_stage_workers(args.stage_workers, DEFAULT_STAGE_WORKERS)
+    # Each decode thread waits on one worker process at a time.
+    stage_workers["decode"] = max(stage_workers["decode"], args.decode_processes)
+
+    region = os.getenv("AWS_REGION")
+    raw_bucket = os.getenv("S3_IMAGES_RAW_BUCKET")
+    processed_bucket = os.getenv("S3_IMAGES_PROCESSED_BUCKET")
+    img_table_name = os.getenv("DDB_IMAGES_TABLE")
+    patch_table_name = os.getenv("DDB_PATCHES_TABLE")
+    runs_table_name = os.getenv("DDB_RUNS_TABLE")
+
+    # Enough connections for every stage that talks to S3 at once.
+    s3_connections = (
+        stage_workers["download"]
+        + stage_workers["upload"] * args.upload_workers
+        + stage_workers["archive"]
+    )
+    s3 = boto3.client(
+        "s3",
+        region_name=region,
+        config=s3_client_config(max(S3_MAX_POOL_CONNECTIONS, s3_connections)),
+    )
+    ddb = boto3.resource(
+        "dynamodb",
+        region_name=region,
+        config=Config(max_pool_connections=max(10, stage_workers["download"] + stage_workers["metadata"])),
+    )
+    img_table = ddb.Table(img_table_name)
+    patch_table = ddb.Table(patch_table_name)
+    runs_table = ddb.Table(runs_table_name)
+    content_index = make_content_index(ddb)
+
+    metrics = RunMetrics()
+    instrument_client(s3, metrics)
+    instrument_client(ddb.meta.client, metrics)
+    for client in (s3, ddb.meta.client):
+        limiter = limit_client(client)
+        if limiter is not None:
+            metrics.gauge(f"aws_rate.{limiter.name}", limiter.to_dict)
+
+    # Record this shard as started (and the run, if /process_data did not)
+    start_shard(runs_table, run_id, args.shard_index, args.num_shards)
+    reporter = MetricsReporter(
+        metrics,
+        lambda snapshot: update_shard_metrics(runs_table, run_id, args.shard_index, snapshot),
+        interval_s=args.metrics_flush_s,
+    ).start()
+    try:
+        total, total_patches, errors, summary = process_shard(
+            args, make_storage(args.storage, s3), img_table, patch_table, raw_bucket, processed_bucket,
+            stage_workers, content_index, metrics,
+        )
+    except Exception:
+        reporter.close()
+        finish_shard(runs_table, run_id, args.shard_index, "failed")
+        raise
+    final_metrics = reporter.close()
+    if args.metrics_json:
+        write_metrics_json(args.metrics_json, run_id, args.shard_index, summary, final_metrics)
+
+    # Update run record with this shard's final status, counts and summary
     status = "completed" if errors == 0 else "completed_with_errors"
-    runs_table.update_item(
-        Key={"run_id": run_id},
-        UpdateExpression="SET #s = :s",
-        ExpressionAttributeNames={"#s": "status"},
-        ExpressionAttributeValues={":s": status},
+    run_status = finish_shard(
+        runs_table, run_id, args.shard_index, status,
+        images=total, patches=total_patches, errors=errors, summary=summary,
     )
 
-    print(f"\nDone. Images: {total}, Patches: {total_patches}, Errors: {errors}")
+    print(f"\nDone. Images: {total}, Patches: {total_patches}, Errors: {errors} (run status: {run_status})")
+
+
+def write_metrics_json(path: str, run_id: str, shard_index: int, summary: Dict, metrics: Dict) -> None:
+    """The run's summary and final metrics snapshot as JSON, to path or, for "-", stdout."""
+    doc = {"run_id": run_id, "shard_index": shard_index, "summary": summary, "metrics": metrics}
+    if path == "-":
+        print("METRICS " + json.dumps(doc, sort_keys=True))
+        return
+    with open(path, "w") as f:
+        json.dump(doc, f, indent=2, sort_keys=True)
+    print(f"Wrote metrics to {path}")
+
+
+def process_shard(args, storage, img_table, patch_table, raw_bucket: str, processed_bucket: str,
+                  stage_workers: Dict[str, int], content_index, metrics: Optional[RunMetrics] = None):
+    """
+    Process this task's share of training/unprocessed/ in storage (a
+    storage.Storage or S3 client). Returns (images, patches, errors, summary).
+    """
+    storage = as_storage(storage)
+    run_id = args.run_id
+    metrics = metrics or RunMetrics()
+    # Images start through the pipeline as soon as the first listing page arrives.
+    objects = (
+        o for o in iter_unprocessed_objects(storage, raw_bucket, RAW_PREFIX, list_workers=args.list_workers)
+        if shard_for_key(o["Key"], args.num_shards) == args.shard_index
+    )
+    print(f"Listing {storage.uri(raw_bucket, RAW_PREFIX)} for shard {args.shard_index + 1}/{args.num_shards}")
+
+    checkpoint: Dict[str, Dict] = {}
+    if args.resume_run_id:
+        checkpoint = load_manifest(storage, processed_bucket, run_id)
+        print(f"Resuming run {run_id}: manifest has {len(checkpoint)} keys")
+
+    # Shards of one run write to their own prefix so their sequence numbers don't collide.
+    shard_prefix = f"{PROCESSED_PREFIX}/shards/{run_id}"
+    if args.num_shards > 1:
+        shard_prefix += f"/{shard_name(args.shard_index)}"
+    shard_writer = make_shard_writer(storage, processed_bucket, shard_prefix, max_shard_mb=args.shard_max_mb)
+
+    if args.sequential:
+        keys = [o["Key"] for o in objects]
+        total = len(keys)
+        summary = run_sequential(
+            args, storage, img_table, patch_table, raw_bucket, processed_bucket,
+            keys, shard_writer, content_index, metrics,
+        )
+        total_patches, errors = summary.pop("patches"), summary.pop("errors")
+        print(f"\nSequential: {summary['wall_s']:.2f} s, {summary['images_per_s']:.2f} images/s")
+    else:
+        decode_pool = DecodePool(args.decode_processes) if args.decode_processes > 0 else None
+        if decode_pool is not None:
+            decode_pool.warm_up()
+        manifest = RunManifest(storage, processed_bucket, run_id, args.shard_index)
+        driver = DriverPipeline(
+            storage, img_table, patch_table, raw_bucket, processed_bucket, run_id,
+            stage_workers=stage_workers,
+            queue_size=args.queue_size,
+            inflight_bytes=args.inflight_mb * 1024 * 1024,
+            upload_workers=args.upload_workers,
+            patch_format=args.patch_format,
+            shard_writer=shard_writer,
+            content_index=content_index,
+            decode_pool=decode_pool,
+            manifest=manifest,
+            checkpoint=checkpoint,
+            metrics=metrics,
+        )
+        try:
+            driver.run(objects)
+        finally:
+            if decode_pool is not None:
+                decode_pool.close()
+            manifest.close()
+        total, total_patches, errors = driver.total, driver.patches, driver.errors
+        summary = driver.summary()
+        print_summary(summary)
+    print(f"Found {total} images in {storage.uri(raw_bucket, RAW_PREFIX)} "
+          f"for shard {args.shard_index + 1}/{args.num_shards}")
+
+    if shard_writer is not None:
+        print(f"Wrote {shard_writer.shards_written} shards")
+    return total, total_patches, errors, summary
 
 
 if __name__ == "__main__":
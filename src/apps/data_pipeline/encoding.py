@@ -0,0 +1,108 @@
+from __future__ import annotations
+import struct
+from dataclasses import dataclass
+from io import BytesIO
+from typing import Callable, Dict
+
+import numpy as np
+from PIL import Image
+
+
+# Patch files are written in one of the formats below and the name is stored on
+# each PatchRecord as patch_format, so readers know how to decode the bytes.
+#   jpeg           quality 95 with an extra Huffman optimisation pass (original)
+#   jpeg_fast      quality 95, no optimisation pass
+#   webp_lossless  lossless WebP
+#   png            lossless PNG at a low compression level
+#   raw            uint8 pixels behind a 10-byte header, no codec at all
+@dataclass(frozen=True)
+class PatchEncoder:
+    name: str
+    extension: str
+    content_type: str
+    encode: Callable[[np.ndarray], bytes]
+    decode: Callable[[bytes], np.ndarray]
+
+
+# "AGP1" + height, width, channels as little-endian uint16.
+_RAW_MAGIC = b"AGP1"
+_RAW_HEADER = struct.Struct("<4sHHH")
+
+
+def _save(patch: np.ndarray, **kwargs) -> bytes:
+    buf = BytesIO()
+    Image.fromarray(patch).save(buf, **kwargs)
+    return buf.getvalue()
+
+
+def _load(data: bytes) -> np.ndarray:
+    return np.asarray(Image.open(BytesIO(data)).convert("RGB"))
+
+
+def encode_raw(patch: np.ndarray) -> bytes:
+    """
+    Encode a (H, W, C) uint8 patch as a small header followed by its pixels.
+    """
+    h, w, c = patch.shape
+    return _RAW_HEADER.pack(_RAW_MAGIC, h, w, c) + np.ascontiguousarray(patch, dtype=np.uint8).tobytes()
+
+
+def decode_raw(data: bytes) -> np.ndarray:
+    """
+    Decode bytes written by encode_raw back to a (H, W, C) uint8 array.
+    """
+    magic, h, w, c = _RAW_HEADER.unpack_from(data)
+    if magic != _RAW_MAGIC:
+        raise ValueError("Not a raw patch: bad header.")
+    return np.frombuffer(data, dtype=np.uint8, offset=_RAW_HEADER.size).reshape(h, w, c)
+
+
+PATCH_ENCODERS: Dict[str, PatchEncoder] = {
+    "jpeg": PatchEncoder(
+        name="jpeg",
+        extension="jpg",
+        content_type="image/jpeg",
+        encode=lambda p: _save(p, format="JPEG", quality=95, optimize=True),
+        decode=_load,
+    ),
+    "jpeg_fast": PatchEncoder(
+        name="jpeg_fast",
+        extension="jpg",
+        content_type="image/jpeg",
+        encode=lambda p: _save(p, format="JPEG", quality=95),
+        decode=_load,
+    ),
+    "webp_lossless": PatchEncoder(
+        name="webp_lossless",
+        extension="webp",
+        content_type="image/webp",
+        encode=lambda p: _save(p, format="WEBP", lossless=True, method=0),
+        decode=_load,
+    ),
+    "png": PatchEncoder(
+        name="png",
+        extension="png",
+        content_type="image/png",
+        encode=lambda p: _save(p, format="PNG", compress_level=1),
+        decode=_load,
+    ),
+    "raw": PatchEncoder(
+        name="raw",
+        extension="raw",
+        content_type="application/octet-stream",
+        encode=encode_raw,
+        decode=decode_raw,
+    ),
+}
+
+
+def get_patch_encoder(name: str) -> PatchEncoder:
+    """
+    Look up a patch encoder by the name stored in patch_format.
+    """
+    try:
+        return PATCH_ENCODERS[name]
+    except KeyError:
+        raise ValueError(
+            f"Unknown patch format {name!r}; expected one of {sorted(PATCH_ENCODERS)}"
+        ) from None
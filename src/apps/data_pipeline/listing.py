@@ -0,0 +1,134 @@
+"""
+Streaming S3 listings for the driver.
+
+iter_objects yields a prefix's objects page by page as ListObjectsV2 returns
+them, so processing starts with the first page instead of after the last.
+
+iter_objects_partitioned splits the prefix into key ranges at each leading hex
+character of the next path segment ({image_id}s are UUIDs) and lists the
+ranges in parallel threads, yielding objects as any range's pages arrive. The
+ranges are contiguous, so keys that do not start with a hex digit (flat
+uploads, other ids) still fall into exactly one of them.
+"""
+from __future__ import annotations
+
+import os
+import queue
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Iterable, Iterator, List, Optional
+
+HEX_PARTITIONS = "0123456789abcdef"
+
+# 0 lists the prefix in one sequential stream.
+DRIVER_LIST_WORKERS = int(os.getenv("DRIVER_LIST_WORKERS", "0"))
+
+_DONE = object()
+
+
+def _wanted(key: str, extensions: Optional[Iterable[str]]) -> bool:
+    return extensions is None or os.path.splitext(key)[1].lower() in extensions
+
+
+def iter_objects(
+    s3_client,
+    bucket: str,
+    prefix: str,
+    extensions: Optional[Iterable[str]] = None,
+    start_after: Optional[str] = None,
+    end_before: Optional[str] = None,
+    page_size: Optional[int] = None,
+) -> Iterator[Dict]:
+    """
+    Objects under prefix as {"Key", "Size"} dicts, in key order, one page at a
+    time. Only keys with one of extensions (lowercase, with the dot) if given,
+    and only keys in (start_after, end_before) if given.
+    """
+    params = {"Bucket": bucket, "Prefix": prefix}
+    if start_after:
+        params["StartAfter"] = start_after
+    config = {"PageSize": page_size} if page_size else {}
+    paginator = s3_client.get_paginator("list_objects_v2")
+    for page in paginator.paginate(**params, PaginationConfig=config):
+        for obj in page.get("Contents", []):
+            key = obj["Key"]
+            if end_before is not None and key >= end_before:
+                return
+            if _wanted(key, extensions):
+                yield {"Key": key, "Size": obj.get("Size", 0)}
+
+
+def partition_bounds(prefix: str, partitions: str = HEX_PARTITIONS) -> List[tuple]:
+    """
+    (start_after, end_before) key ranges that together cover prefix: one per
+    leading character in partitions, the first also taking everything that
+    sorts before it and each one everything up to the next.
+    """
+    starts = [prefix + c for c in partitions]
+    bounds = []
+    for i, start in enumerate(starts):
+        # StartAfter is exclusive; no image key equals a bare boundary.
+        lower = None if i == 0 else start
+        upper = starts[i + 1] if i + 1 < len(starts) else None
+        bounds.append((lower, upper))
+    return bounds
+
+
+def iter_objects_partitioned(
+    s3_client,
+    bucket: str,
+    prefix: str,
+    workers: int,
+    extensions: Optional[Iterable[str]] = None,
+    partitions: str = HEX_PARTITIONS,
+    page_size: Optional[int] = None,
+    buffer: int = 10000,
+) -> Iterator[Dict]:
+    """
+    Like iter_objects, but the key ranges from partition_bounds are listed by
+    workers threads at once and objects are yielded in arrival order. At most
+    buffer objects are held ahead of the consumer. A listing error is raised
+    from the generator.
+    """
+    q: queue.Queue = queue.Queue(maxsize=buffer)
+    stop = threading.Event()
+
+    def _put(entry) -> bool:
+        while not stop.is_set():
+            try:
+                q.put(entry, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def _list(bounds) -> None:
+        try:
+            for obj in iter_objects(s3_client, bucket, prefix, extensions,
+                                    start_after=bounds[0], end_before=bounds[1], page_size=page_size):
+                if not _put(obj):
+                    return
+        except Exception as exc:
+            _put(exc)
+
+    ranges = partition_bounds(prefix, partitions)
+    pool = ThreadPoolExecutor(max_workers=max(1, workers), thread_name_prefix="list")
+    futures = [pool.submit(_list, b) for b in ranges]
+
+    def _finish() -> None:
+        for f in futures:
+            f.result()
+        _put(_DONE)
+
+    threading.Thread(target=_finish, name="list-done", daemon=True).start()
+    try:
+        while True:
+            entry = q.get()
+            if entry is _DONE:
+                return
+            if isinstance(entry, Exception):
+                raise entry
+            yield entry
+    finally:
+        stop.set()
+        pool.shutdown(wait=False)
@@ -0,0 +1,122 @@
+"""
+Per-run progress manifest for resumable processing runs.
+
+Every key a driver task works on moves through these stages:
+
+    downloaded -> patched -> records_written -> moved
+
+RunManifest records each step as a JSON line and appends them to S3 as small
+segment objects under {MANIFEST_PREFIX}/{run_id}/{shard}/, written every
+MANIFEST_FLUSH_S seconds or MANIFEST_FLUSH_ENTRIES entries and when the task
+ends. Segments are never rewritten, so a task that dies loses at most the
+entries since its last flush. load_manifest merges the segments of a run back
+into one entry per key, which the driver uses with --resume_run_id to skip the
+stages a key already finished.
+
+Segments are written through a storage.Storage (or an S3 client), next to
+the run's patches.
+
+The "patched" entry carries the image's patch metadata, so a resumed key whose
+patches are already in S3 goes straight to the metadata stage and reuses them.
+"""
+from __future__ import annotations
+
+import json
+import os
+import threading
+import time
+from typing import Dict, List, Optional
+
+from src.apps.data_pipeline.runs import shard_name
+from src.apps.data_pipeline.storage import as_storage
+
+MANIFEST_PREFIX = "training/manifests"
+MANIFEST_FLUSH_S = float(os.getenv("MANIFEST_FLUSH_S", "10"))
+MANIFEST_FLUSH_ENTRIES = int(os.getenv("MANIFEST_FLUSH_ENTRIES", "500"))
+
+STAGES = ("downloaded", "patched", "records_written", "moved")
+
+
+def stage_reached(entry: Optional[Dict], stage: str) -> bool:
+    """Whether a manifest entry shows stage (or a later one) as done."""
+    if not entry or entry.get("stage") not in STAGES:
+        return False
+    return STAGES.index(entry["stage"]) >= STAGES.index(stage)
+
+
+class RunManifest:
+    def __init__(
+        self,
+        storage,
+        bucket: str,
+        run_id: str,
+        shard_index: int = 0,
+        flush_s: float = MANIFEST_FLUSH_S,
+        flush_entries: int = MANIFEST_FLUSH_ENTRIES,
+    ):
+        self.storage = as_storage(storage)
+        self.bucket = bucket
+        self.flush_s = flush_s
+        self.flush_entries = flush_entries
+        # Segments of later attempts sort after earlier ones.
+        self.prefix = f"{MANIFEST_PREFIX}/{run_id}/{shard_name(shard_index)}/{int(time.time() * 1000)}"
+
+        self._lock = threading.Lock()
+        self._pending: List[str] = []
+        self._seq = 0
+        self._last_flush = time.monotonic()
+
+    def record(self, key: str, stage: str, **data) -> None:
+        """Record that key finished stage, flushing if a flush is due."""
+        line = json.dumps({"key": key, "stage": stage, "t": int(time.time() * 1000), **data})
+        with self._lock:
+            self._pending.append(line)
+            due = (
+                len(self._pending) >= self.flush_entries
+                or time.monotonic() - self._last_flush >= self.flush_s
+            )
+            if due:
+                self._flush_locked()
+
+    def flush(self) -> None:
+        with self._lock:
+            self._flush_locked()
+
+    def close(self) -> None:
+        self.flush()
+
+    def _flush_locked(self) -> None:
+        self._last_flush = time.monotonic()
+        if not self._pending:
+            return
+        body = ("\n".join(self._pending) + "\n").encode("utf-8")
+        self.storage.put(self.bucket, f"{self.prefix}-{self._seq:06d}.jsonl", body,
+                         content_type="application/x-ndjson")
+        self._seq += 1
+        self._pending = []
+
+
+def load_manifest(storage, bucket: str, run_id: str) -> Dict[str, Dict]:
+    """
+    Merge every manifest segment of run_id (all shards, all attempts) into one
+    entry per key, later entries overriding earlier fields.
+    """
+    storage = as_storage(storage)
+    keys: List[str] = [obj["Key"] for obj in storage.iter_objects(bucket, f"{MANIFEST_PREFIX}/{run_id}/")]
+
+    # Order by attempt and sequence number, across shards.
+    keys.sort(key=lambda k: k.rsplit("/", 1)[-1])
+    entries: Dict[str, Dict] = {}
+    for segment in keys:
+        body = bytes(storage.get(bucket, segment)).decode("utf-8")
+        for line in body.splitlines():
+            if not line.strip():
+                continue
+            entry = json.loads(line)
+            merged = entries.setdefault(entry["key"], {})
+            # Never step back: a late "downloaded" from a retry of a key that
+            # was already patched does not hide the patches.
+            if stage_reached(merged, entry["stage"]) and merged.get("stage") != entry["stage"]:
+                continue
+            merged.update(entry)
+    return entries
@@ -0,0 +1,227 @@
+"""
+DynamoDB metadata writes shared by the driver and /inference.
+
+PatchRecords are written with batch_write_item, up to 25 items per request.
+Items DynamoDB hands back as UnprocessedItems (throttling, partition limits)
+are sent again with jittered exponential backoff. ImageRecords are written with
+a single update_item upsert that fills in fields only where they are missing,
+so records created beforehand (e.g. by the upload script, with labels) keep
+their values without a read first.
+
+batch_put writes a list of items and returns once they are all stored.
+BatchWriter buffers items from many images so requests go out full, and runs
+each image's follow-up work once its items have been written.
+"""
+from __future__ import annotations
+
+import os
+import random
+import threading
+import time
+from typing import Callable, Dict, List, Optional
+
+BATCH_WRITE_MAX_ITEMS = 25
+METADATA_WRITE_ATTEMPTS = int(os.getenv("METADATA_WRITE_ATTEMPTS", "8"))
+METADATA_BASE_DELAY_S = float(os.getenv("METADATA_BASE_DELAY_S", "0.05"))
+
+
+class BatchWriteError(Exception):
+    """Raised when items are still unprocessed after every attempt."""
+
+    def __init__(self, table_name: str, unprocessed: int):
+        super().__init__(f"{unprocessed} items for {table_name} still unprocessed after retries")
+        self.table_name = table_name
+        self.unprocessed = unprocessed
+
+
+def patch_record_item(image_id: str, patch: Dict, created_at: int) -> Dict:
+    """The PatchRecord item for one patch metadata dict (see process.py)."""
+    item = {
+        "patch_id": patch["patch_id"],
+        "image_id": image_id,
+        "patch_type": patch["patch_type"],
+        "patch_path": patch["patch_path"],
+        "patch_format": patch["patch_format"],
+        "patch_x": int(patch["patch_x"]),
+        "patch_y": int(patch["patch_y"]),
+        "patch_width": int(patch["patch_width"]),
+        "patch_height": int(patch["patch_height"]),
+        "created_at": int(created_at),
+    }
+    if patch.get("shard_uri"):
+        item["shard_uri"] = patch["shard_uri"]
+        item["offset"] = int(patch["offset"])
+        item["length"] = int(patch["length"])
+    return item
+
+
+def upsert_image_record(img_table, image_id: str, fields: Dict, run_id: Optional[str] = None) -> None:
+    """
+    Create or complete the ImageRecord of image_id in one request: each of
+    fields is set only if the record does not have it yet; run_id, if given,
+    is always set.
+    """
+    sets = [f"#f{i} = if_not_exists(#f{i}, :v{i})" for i in range(len(fields))]
+    names = {f"#f{i}": name for i, name in enumerate(fields)}
+    values = {f":v{i}": value for i, value in enumerate(fields.values())}
+    if run_id is not None:
+        sets.append("run_id = :run_id")
+        values[":run_id"] = run_id
+    img_table.update_item(
+        Key={"image_id": image_id},
+        UpdateExpression="SET " + ", ".join(sets),
+        ExpressionAttributeNames=names,
+        ExpressionAttributeValues=values,
+    )
+
+
+def _write_batch(
+    table,
+    items: List[Dict],
+    attempts: int = METADATA_WRITE_ATTEMPTS,
+    base_delay_s: float = METADATA_BASE_DELAY_S,
+) -> int:
+    """
+    One batch_write_item of at most 25 items, resending unprocessed ones.
+    Returns how many requests were resends.
+    """
+    requests = [{"PutRequest": {"Item": item}} for item in items]
+    for attempt in range(attempts):
+        resp = table.meta.client.batch_write_item(RequestItems={table.name: requests})
+        requests = (resp.get("UnprocessedItems") or {}).get(table.name) or []
+        if not requests:
+            return attempt
+        if attempt < attempts - 1:
+            time.sleep(base_delay_s * (2 ** attempt) * random.uniform(0.5, 1.5))
+    raise BatchWriteError(table.name, len(requests))
+
+
+def batch_put(
+    table,
+    items: List[Dict],
+    attempts: int = METADATA_WRITE_ATTEMPTS,
+    base_delay_s: float = METADATA_BASE_DELAY_S,
+) -> None:
+    """Put items into table, 25 per request. Raises BatchWriteError."""
+    for start in range(0, len(items), BATCH_WRITE_MAX_ITEMS):
+        _write_batch(table, items[start:start + BATCH_WRITE_MAX_ITEMS], attempts, base_delay_s)
+
+
+class BatchWriter:
+    """
+    Collects items for one table across callers and writes them in full
+    batches. put() takes the items of one unit of work (an image's
+    PatchRecords) with a callback to run once they are all written, or an
+    error callback if any of them could not be. Call close() to write what is
+    left over.
+    """
+
+    def __init__(
+        self,
+        table,
+        attempts: int = METADATA_WRITE_ATTEMPTS,
+        base_delay_s: float = METADATA_BASE_DELAY_S,
+    ):
+        self.table = table
+        self.attempts = attempts
+        self.base_delay_s = base_delay_s
+        self.batches = 0
+        self.retries = 0
+
+        self._lock = threading.Lock()
+        self._idle = threading.Condition(self._lock)
+        self._buf: List[Dict] = []
+        # Items are numbered in the order they were put; each waiter covers
+        # items [start, end) and is failed if any of them is dropped. Batches
+        # taken off the buffer but not written yet are kept as start -> end.
+        self._added = 0
+        self._taken = 0
+        self._writing: Dict[int, int] = {}
+        self._waiters: List[Dict] = []
+
+    def put(
+        self,
+        items: List[Dict],
+        on_written: Callable[[], None],
+        on_failed: Callable[[Exception], None],
+    ) -> None:
+        with self._lock:
+            start = self._added
+            self._buf.extend(items)
+            self._added += len(items)
+            self._waiters.append({"start": start, "end": self._added, "fn": on_written,
+                                  "on_failed": on_failed, "error": None})
+            batches = self._take_locked(full_only=True)
+            due = self._due_locked()
+        self._run(due)
+        self._write(batches)
+
+    def flush(self) -> None:
+        with self._lock:
+            batches = self._take_locked(full_only=False)
+            due = self._due_locked()
+        self._run(due)
+        self._write(batches)
+
+    def close(self) -> None:
+        """Write what is left over and wait for batches other threads took."""
+        self.flush()
+        with self._idle:
+            while self._writing:
+                self._idle.wait()
+
+    def _take_locked(self, full_only: bool) -> List[Dict]:
+        """Take batches off the buffer for writing: full ones only, or all of it."""
+        batches = []
+        while self._buf and (len(self._buf) >= BATCH_WRITE_MAX_ITEMS or not full_only):
+            batch = self._buf[:BATCH_WRITE_MAX_ITEMS]
+            self._buf = self._buf[BATCH_WRITE_MAX_ITEMS:]
+            start, end = self._taken, self._taken + len(batch)
+            self._writing[start] = end
+            self._taken = end
+            batches.append({"start": start, "end": end, "items": batch})
+        return batches
+
+    def _due_locked(self) -> List[Dict]:
+        # Batches can finish out of order: a waiter is due once none of the
+        # items before its end is still buffered or being written.
+        written = min(self._writing, default=self._taken)
+        due = [w for w in self._waiters if w["end"] <= written]
+        self._waiters = [w for w in self._waiters if w["end"] > written]
+        return due
+
+    def _write(self, batches: List[Dict]) -> None:
+        # Outside the lock: a batch write is a network call with backoff
+        # sleeps, and other threads keep filling the buffer meanwhile.
+        for batch in batches:
+            error: Optional[Exception] = None
+            retries = 0
+            try:
+                retries = _write_batch(self.table, batch["items"], self.attempts, self.base_delay_s)
+            except Exception as exc:
+                error = exc
+
+            with self._idle:
+                start, end = batch["start"], batch["end"]
+                del self._writing[start]
+                self.batches += 1
+                self.retries += retries
+                if error is not None:
+                    for w in self._waiters:
+                        if w["error"] is None and w["start"] < end and w["end"] > start:
+                            w["error"] = error
+                due = self._due_locked()
+                self._idle.notify_all()
+            self._run(due)
+
+    @staticmethod
+    def _run(due: List[Dict]) -> None:
+        # Outside the lock: callbacks may block handing work to the next stage.
+        for w in due:
+            if w["error"] is not None:
+                w["on_failed"](w["error"])
+                continue
+            try:
+                w["fn"]()
+            except Exception as exc:
+                w["on_failed"](exc)
@@ -0,0 +1,203 @@
+"""
+Live run metrics for the driver.
+
+RunMetrics collects counters (images, patches, bytes, errors, retries) and
+latency histograms: one per pipeline stage, one per AWS service (every request
+a client made, see instrument_client) and one for whole images, from listing to
+archive. Comparing the stage and service latencies shows whether a slow run is
+waiting on S3, on DynamoDB or on the CPU.
+
+MetricsReporter writes a snapshot to the shard's entry in the run record every
+DRIVER_METRICS_FLUSH_S seconds while the run is going, and once more at the end.
+The driver also writes the final snapshot with its summary as JSON
+(--metrics_json), for benchmarks to compare between commits.
+"""
+from __future__ import annotations
+
+import bisect
+import os
+import threading
+import time
+from collections import defaultdict
+from typing import Any, Callable, Dict, List, Optional
+
+DRIVER_METRICS_FLUSH_S = float(os.getenv("DRIVER_METRICS_FLUSH_S", "30"))
+
+# Upper bounds of the histogram buckets, in milliseconds; a last bucket takes
+# everything slower.
+LATENCY_BUCKETS_MS: List[float] = [
+    1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000, 10000, 30000, 60000,
+]
+
+
+class LatencyHistogram:
+    """Latency histogram over fixed buckets (LATENCY_BUCKETS_MS)."""
+
+    def __init__(self, bounds_ms: List[float] = LATENCY_BUCKETS_MS):
+        self.bounds_ms = list(bounds_ms)
+        self.counts = [0] * (len(self.bounds_ms) + 1)
+        self.count = 0
+        self.sum_s = 0.0
+        self.max_s = 0.0
+
+    def observe(self, seconds: float) -> None:
+        self.counts[bisect.bisect_left(self.bounds_ms, seconds * 1000.0)] += 1
+        self.count += 1
+        self.sum_s += seconds
+        self.max_s = max(self.max_s, seconds)
+
+    def percentile(self, p: float) -> float:
+        """
+        Estimate of the p-th percentile in seconds, interpolated within the
+        bucket that holds it.
+        """
+        if self.count == 0:
+            return 0.0
+        rank = p / 100.0 * self.count
+        seen = 0
+        for i, n in enumerate(self.counts):
+            if n and seen + n >= rank:
+                lower = self.bounds_ms[i - 1] / 1000.0 if i > 0 else 0.0
+                upper = self.bounds_ms[i] / 1000.0 if i < len(self.bounds_ms) else self.max_s
+                upper = min(upper, self.max_s)
+                return lower + (upper - lower) * max(0.0, rank - seen) / n
+            seen += n
+        return self.max_s
+
+    def to_dict(self) -> Dict:
+        buckets = {}
+        for i, n in enumerate(self.counts):
+            if n:
+                label = f"le_{self.bounds_ms[i]:g}ms" if i < len(self.bounds_ms) else "inf"
+                buckets[label] = n
+        return {
+            "count": self.count,
+            "mean_s": self.sum_s / self.count if self.count else 0.0,
+            "p50_s": self.percentile(50),
+            "p90_s": self.percentile(90),
+            "p99_s": self.percentile(99),
+            "max_s": self.max_s,
+            "buckets": buckets,
+        }
+
+
+class RunMetrics:
+    """Thread-safe counters and latency histograms for one driver task."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._t0 = time.perf_counter()
+        self.counters: Dict[str, int] = defaultdict(int)
+        self.latency: Dict[str, LatencyHistogram] = {}
+        self._gauges: Dict[str, Callable[[], Any]] = {}
+
+    def gauge(self, name: str, fn: Callable[[], Any]) -> None:
+        """Report fn() under gauges in every snapshot (e.g. bytes in flight)."""
+        self._gauges[name] = fn
+
+    def incr(self, name: str, n: int = 1) -> None:
+        with self._lock:
+            self.counters[name] += n
+
+    def observe(self, name: str, seconds: float) -> None:
+        with self._lock:
+            hist = self.latency.get(name)
+            if hist is None:
+                hist = self.latency[name] = LatencyHistogram()
+            hist.observe(seconds)
+
+    def snapshot(self) -> Dict:
+        """Counters, rates per second, gauges and latency summaries so far."""
+        with self._lock:
+            elapsed = time.perf_counter() - self._t0
+            counters = dict(sorted(self.counters.items()))
+            latency = {name: hist.to_dict() for name, hist in sorted(self.latency.items())}
+        gauges = {name: fn() for name, fn in sorted(self._gauges.items())}
+        rates = {
+            name: counters.get(name, 0) / elapsed if elapsed > 0 else 0.0
+            for name in ("images", "patches", "bytes_downloaded", "bytes_uploaded")
+        }
+        return {"elapsed_s": elapsed, "counters": counters, "per_s": rates, "gauges": gauges, "latency": latency}
+
+
+def instrument_client(client, metrics: RunMetrics) -> None:
+    """
+    Count a boto3 client's requests, retries, errors and payload bytes into
+    metrics, and time each request (including botocore's own retries) into
+    the "aws.<service>" histogram. For a resource, pass resource.meta.client.
+    """
+    service = client.meta.service_model.service_name
+    prefix = f"aws.{service}"
+
+    def _before_call(context, **kwargs):
+        context["metrics_t0"] = time.perf_counter()
+
+    def _client_params(params, **kwargs):
+        body = params.get("Body")
+        if isinstance(body, (bytes, bytearray, memoryview)):
+            metrics.incr("bytes_uploaded", len(body))
+
+    def _after_call(parsed, model, context, **kwargs):
+        t0 = context.get("metrics_t0")
+        if t0 is not None:
+            metrics.observe(prefix, time.perf_counter() - t0)
+        metrics.incr(f"{prefix}.{model.name}")
+        retries = (parsed.get("ResponseMetadata") or {}).get("RetryAttempts") or 0
+        if retries:
+            metrics.incr("aws_retries", retries)
+        if "Error" in parsed:
+            metrics.incr("aws_errors")
+        elif model.name == "GetObject":
+            metrics.incr("bytes_downloaded", int(parsed.get("ContentLength") or 0))
+
+    events = client.meta.events
+    events.register(f"before-call.{service}", _before_call)
+    events.register(f"provide-client-params.{service}", _client_params)
+    events.register(f"after-call.{service}", _after_call)
+
+
+class MetricsReporter:
+    """
+    Calls write(snapshot) from a background thread every interval_s seconds,
+    and once more on close(). A failed write is logged and retried at the next
+    interval; it never stops the run.
+    """
+
+    def __init__(
+        self,
+        metrics: RunMetrics,
+        write: Callable[[Dict], None],
+        interval_s: float = DRIVER_METRICS_FLUSH_S,
+    ):
+        self.metrics = metrics
+        self.write = write
+        self.interval_s = interval_s
+        self.flushes = 0
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    def start(self) -> "MetricsReporter":
+        if self.interval_s > 0:
+            self._thread = threading.Thread(target=self._loop, name="metrics", daemon=True)
+            self._thread.start()
+        return self
+
+    def flush(self) -> Dict:
+        snapshot = self.metrics.snapshot()
+        try:
+            self.write(snapshot)
+            self.flushes += 1
+        except Exception as exc:
+            print(f"  WARNING: could not write run metrics: {exc}")
+        return snapshot
+
+    def close(self) -> Dict:
+        """Stop the background flushes and write the final snapshot, which is returned."""
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+        return self.flush()
+
+    def _loop(self) -> None:
+        while not self._stop.wait(self.interval_s):
+            self.flush()
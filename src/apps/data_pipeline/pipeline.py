@@ -0,0 +1,231 @@
+"""
+Staged pipeline with bounded queues, used by the data-processing driver.
+
+Items flow from a source iterator through a list of stages. Each stage has its
+own pool of worker threads and reads from a bounded queue, so a slow stage
+backs work up into the stages before it instead of letting items pile up in
+memory. A stage function returns the item to pass on, None to drop it, or HELD
+when it has handed the item to something that will call Pipeline.put later
+(e.g. a shard upload callback).
+
+ByteBudget adds backpressure by size: the stage that loads data acquires its
+bytes before loading, and they are given back as the item shrinks or leaves the
+pipeline.
+"""
+from __future__ import annotations
+
+import queue
+import threading
+import time
+from dataclasses import dataclass, field
+from typing import Any, Callable, Dict, Iterable, List, Optional
+
+# Returned by a stage function that keeps the item and forwards it later.
+HELD = object()
+
+_STOP = object()
+
+
+class ByteBudget:
+    """
+    Caps the bytes held by in-flight items. acquire blocks while the budget is
+    spent, except when nothing is in flight, so a single item larger than the
+    whole budget still gets through.
+    """
+
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self.in_flight = 0
+        self.peak = 0
+        self.wait_s = 0.0
+        self._cond = threading.Condition()
+
+    def acquire(self, n: int) -> None:
+        with self._cond:
+            t0 = time.perf_counter()
+            while self.in_flight > 0 and self.in_flight + n > self.max_bytes:
+                self._cond.wait()
+            self.wait_s += time.perf_counter() - t0
+            self._add(n)
+
+    def adjust(self, old: int, new: int) -> None:
+        """Change an item's charge from old to new bytes without blocking."""
+        with self._cond:
+            self._add(new - old)
+            if new < old:
+                self._cond.notify_all()
+
+    def release(self, n: int) -> None:
+        self.adjust(n, 0)
+
+    def _add(self, n: int) -> None:
+        self.in_flight += n
+        self.peak = max(self.peak, self.in_flight)
+
+
+@dataclass
+class Stage:
+    name: str
+    fn: Callable[[Any], Any]
+    workers: int = 1
+    # Runs once after the last worker has stopped, before the next stage is
+    # told to stop; may still Pipeline.put items downstream.
+    on_close: Optional[Callable[[], None]] = None
+
+
+@dataclass
+class StageStats:
+    name: str
+    workers: int
+    items: int = 0
+    errors: int = 0
+    busy_s: float = 0.0
+    _lock: threading.Lock = field(default_factory=threading.Lock, repr=False)
+
+    def record(self, seconds: float, ok: bool) -> None:
+        with self._lock:
+            self.busy_s += seconds
+            if ok:
+                self.items += 1
+            else:
+                self.errors += 1
+
+
+class Pipeline:
+    def __init__(
+        self,
+        stages: List[Stage],
+        queue_size: int = 8,
+        on_error: Optional[Callable[[str, Any, Exception], None]] = None,
+        on_finish: Optional[Callable[[Any], None]] = None,
+        metrics=None,
+    ):
+        """
+        on_error(stage_name, item, exc) is called when a stage raises; the item
+        is then dropped. on_finish(item) is called whenever an item leaves the
+        pipeline, whether completed, dropped or failed. With metrics (a
+        metrics.RunMetrics), every stage call is timed into the "stage.<name>"
+        histogram.
+        """
+        self.stages = stages
+        self.on_error = on_error
+        self.on_finish = on_finish
+        self.metrics = metrics
+        self.stats: Dict[str, StageStats] = {"list": StageStats("list", 1)}
+        self.stats.update({s.name: StageStats(s.name, s.workers) for s in stages})
+        self._queues = [queue.Queue(maxsize=queue_size) for _ in stages]
+        self._index = {s.name: i for i, s in enumerate(stages)}
+        self.wall_s = 0.0
+
+    def put(self, stage_name: str, item: Any) -> None:
+        """Queue item for stage_name (blocking while that queue is full)."""
+        self._queues[self._index[stage_name]].put(item)
+
+    def run(self, source: Iterable[Any]) -> Dict[str, StageStats]:
+        """Push every item from source through the stages and wait for them."""
+        t0 = time.perf_counter()
+        threads: List[threading.Thread] = []
+        remaining = [s.workers for s in self.stages]
+        remaining_lock = threading.Lock()
+
+        def worker(i: int) -> None:
+            stage = self.stages[i]
+            stats = self.stats[stage.name]
+            q = self._queues[i]
+            while True:
+                item = q.get()
+                if item is _STOP:
+                    break
+                start = time.perf_counter()
+                try:
+                    out = stage.fn(item)
+                except Exception as exc:
+                    self._record(stats, time.perf_counter() - start, ok=False)
+                    if self.on_error is not None:
+                        self.on_error(stage.name, item, exc)
+                    self._finish(item)
+                    continue
+                self._record(stats, time.perf_counter() - start, ok=True)
+
+                if out is HELD:
+                    continue
+                if out is None or i == len(self.stages) - 1:
+                    self._finish(item if out is None else out)
+                else:
+                    self._queues[i + 1].put(out)
+
+            with remaining_lock:
+                remaining[i] -= 1
+                last = remaining[i] == 0
+            if last:
+                self._close_stage(i)
+
+        for i, stage in enumerate(self.stages):
+            for n in range(stage.workers):
+                t = threading.Thread(target=worker, args=(i,), name=f"{stage.name}-{n}", daemon=True)
+                t.start()
+                threads.append(t)
+
+        list_stats = self.stats["list"]
+        it = iter(source)
+        while True:
+            start = time.perf_counter()
+            try:
+                item = next(it)
+            except StopIteration:
+                list_stats.busy_s += time.perf_counter() - start
+                break
+            self._record(list_stats, time.perf_counter() - start, ok=True)
+            self._queues[0].put(item)
+        for _ in range(self.stages[0].workers):
+            self._queues[0].put(_STOP)
+
+        for t in threads:
+            t.join()
+        self.wall_s = time.perf_counter() - t0
+        return self.stats
+
+    def _record(self, stats: StageStats, seconds: float, ok: bool) -> None:
+        stats.record(seconds, ok)
+        if self.metrics is not None:
+            self.metrics.observe(f"stage.{stats.name}", seconds)
+
+    def queue_depths(self) -> Dict[str, int]:
+        """Items waiting in front of each stage right now."""
+        return {s.name: q.qsize() for s, q in zip(self.stages, self._queues)}
+
+    def _close_stage(self, i: int) -> None:
+        stage = self.stages[i]
+        if stage.on_close is not None:
+            start = time.perf_counter()
+            try:
+                stage.on_close()
+                self.stats[stage.name].busy_s += time.perf_counter() - start
+            except Exception as exc:
+                self.stats[stage.name].record(time.perf_counter() - start, ok=False)
+                if self.on_error is not None:
+                    self.on_error(stage.name, None, exc)
+        if i + 1 < len(self.stages):
+            for _ in range(self.stages[i + 1].workers):
+                self._queues[i + 1].put(_STOP)
+
+    def _finish(self, item: Any) -> None:
+        if self.on_finish is not None:
+            self.on_finish(item)
+
+
+def parse_stage_workers(spec: str, defaults: Dict[str, int]) -> Dict[str, int]:
+    """
+    Parse "download=16,decode=2" into per-stage worker counts on top of
+    defaults. Raises ValueError for unknown stages or counts below 1.
+    """
+    workers = dict(defaults)
+    for part in filter(None, (p.strip() for p in spec.split(","))):
+        name, _, count = part.partition("=")
+        name = name.strip()
+        if name not in workers:
+            raise ValueError(f"Unknown stage {name!r}; expected one of {sorted(workers)}")
+        if not count.strip().isdigit() or int(count) < 1:
+            raise ValueError(f"Worker count for {name!r} must be a positive integer, got {count!r}")
+        workers[name] = int(count)
+    return workers
@@ -1,12 +1,58 @@
 from __future__ import annotations
+import math
+import os
 import uuid
-from typing import Callable, Dict, List, Optional, Tuple
+from concurrent.futures import FIRST_EXCEPTION, ThreadPoolExecutor, wait
+from typing import Callable, Dict, List, Optional, Sequence, Tuple, Union
+from botocore.config import Config
 from PIL import Image
 from io import BytesIO
+import numpy as np
+
+from src.apps.data_pipeline.encoding import get_patch_encoder
+from src.apps.data_pipeline.storage import Storage, as_storage
 
 
 PATCH_SIZE = 256  
 
+# Storage format for patch files; see encoding.PATCH_ENCODERS for the options.
+PATCH_FORMAT = os.getenv("PATCH_FORMAT", "jpeg")
+
+# Patch uploads for one image go through a bounded thread pool that shares a
+# single S3 client. The client's connection pool should be at least as large as
+# the number of upload workers, otherwise workers queue for a connection.
+PATCH_UPLOAD_WORKERS = int(os.getenv("PATCH_UPLOAD_WORKERS", "8"))
+S3_MAX_POOL_CONNECTIONS = int(os.getenv("S3_MAX_POOL_CONNECTIONS", "32"))
+
+# Large uploads are decoded at a reduced power-of-two scale (JPEG draft mode, or
+# Image.reduce for other formats) as long as the smallest patch keeps at least
+# PATCH_SIZE source pixels per side. Patches then differ from a full-resolution
+# decode by a mean of under 1 level and a 99th percentile of at most 3 levels
+# per channel, with larger differences confined to patch borders.
+# Set REDUCED_DECODE=0 to always decode at full resolution.
+REDUCED_DECODE = os.getenv("REDUCED_DECODE", "1") == "1"
+MAX_DECODE_REDUCTION = 8
+
+# A patch as extracted (uint8 array) or already encoded in its patch_format.
+Patch = Union[np.ndarray, bytes]
+
+
+def patch_id_for(image_id: str, patch_type: str, x: int, y: int, width: int, height: int) -> str:
+    """
+    Deterministic patch_id for a patch of image_id, so processing an image
+    again (e.g. a resumed run) overwrites its patches and PatchRecords instead
+    of adding new ones.
+    """
+    name = f"artguard-patch:{image_id}/{patch_type}/{int(x)},{int(y)},{int(width)}x{int(height)}"
+    return str(uuid.uuid5(uuid.NAMESPACE_URL, name))
+
+
+def s3_client_config(max_pool_connections: int = S3_MAX_POOL_CONNECTIONS) -> Config:
+    """
+    botocore config for the S3 client shared by the patch upload workers.
+    """
+    return Config(max_pool_connections=max_pool_connections)
+
 def _choose_p(img: Image.Image) -> int:
     """
     The sub-images are created by dividing the whole image into 2^p by 2^p
@@ -15,7 +61,13 @@ def _choose_p(img: Image.Image) -> int:
     1024 pixels, and p = 1, if the smaller side is larger than 512 pixels 
     and smaller than 1024.
     """
-    w, h = img.size
+    return _choose_p_for_size(*img.size)
+
+
+def _choose_p_for_size(w: int, h: int) -> int:
+    """
+    _choose_p for an image that has not been decoded yet.
+    """
     m = min(w, h)
     if m > 1024:
         return 2
@@ -24,6 +76,41 @@ def _choose_p(img: Image.Image) -> int:
     return 1
 
 
+def plan_decode_reduction(w: int, h: int) -> int:
+    """
+    Largest power-of-two factor (up to MAX_DECODE_REDUCTION) an image of size
+    (w, h) can be decoded at while every grid cell from the _choose_p plan
+    still spans at least PATCH_SIZE pixels.
+    """
+    cell = min(w, h) // (2 ** _choose_p_for_size(w, h))
+    factor = 1
+    while factor * 2 <= MAX_DECODE_REDUCTION and cell // (factor * 2) >= PATCH_SIZE:
+        factor *= 2
+    return factor
+
+
+def decode_image(data, reduced: bool = REDUCED_DECODE) -> Tuple[Image.Image, Tuple[int, int]]:
+    """
+    Decode raw upload bytes (or a readable, seekable file object) to RGB, at the
+    reduced scale from plan_decode_reduction when reduced is set.
+    Returns the decoded image and the full-resolution (width, height), which is
+    what image records and patch coordinates refer to.
+    """
+    img = Image.open(data if hasattr(data, "read") else BytesIO(data))
+    w, h = img.size
+    factor = plan_decode_reduction(w, h) if reduced else 1
+
+    if factor > 1 and img.format == "JPEG":
+        # The DCT scales the image while decoding, so the full-resolution
+        # bitmap is never materialised.
+        img.draft("RGB", (math.ceil(w / factor), math.ceil(h / factor)))
+
+    img = img.convert("RGB")
+    if factor > 1 and img.size == (w, h):
+        img = img.reduce(factor)
+    return img, (w, h)
+
+
 def _center_crop_square(img: Image.Image) -> Tuple[Image.Image, int, int, int]:
     """
     For all images, regardless of the resolution, we also include the sub-image 
@@ -39,13 +126,82 @@ def _center_crop_square(img: Image.Image) -> Tuple[Image.Image, int, int, int]:
     return cropped, left, top, side
 
 
-def _encode_jpeg(img: Image.Image, quality: int = 95) -> bytes:
+def extract_patches(
+    img: Image.Image,
+    source_size: Optional[Tuple[int, int]] = None,
+) -> Tuple[np.ndarray, List[Dict]]:
     """
-    Encode PIL image to JPEG bytes.
+    Cut the center-cropped square and its (2^p x 2^p) grid from a single decode
+    of the image, resizing the whole grid in one pass, into one preallocated
+    batch.
+    source_size is the full-resolution size when img was decoded at a reduced
+    scale (see decode_image); the patch plan and coordinates always refer to it.
+    Returns a contiguous (N, 256, 256, 3) uint8 batch and, for each patch in the
+    same order, its patch_type and location in the original image.
     """
-    buf = BytesIO()
-    img.save(buf, format="JPEG", quality=quality, optimize=True)
-    return buf.getvalue()
+    if img.mode != "RGB":
+        img = img.convert("RGB")
+
+    w, h = source_size or img.size
+    side = min(w, h)
+    sq_left = (w - side) // 2
+    sq_top = (h - side) // 2
+
+    p = _choose_p_for_size(w, h)
+    grid_n = 2 ** p
+
+    cell = side // grid_n
+    if cell <= 0:
+        raise ValueError("Image too small to create grid patches.")
+
+    meta: List[Dict] = [{
+        "patch_type": "center_square",
+        "x": sq_left,
+        "y": sq_top,
+        "width": side,
+        "height": side,
+    }]
+    for row in range(grid_n):
+        for col in range(grid_n):
+            meta.append({
+                "patch_type": "grid",
+                "x": sq_left + col * cell,
+                "y": sq_top + row * cell,
+                "width": cell,
+                "height": cell,
+            })
+
+    # The grid cells tile the square, so the whole grid is resized in one pass
+    # to a (2^p * 256)-pixel mosaic and split into patches as array views. When
+    # that is a reduction, the center square is resized from the mosaic (edge
+    # padded by the few pixels the grid leaves over) instead of the source,
+    # which halves the resampling work. Pixels differ from the per-patch crop +
+    # resize path only near cell edges, where the one-pass kernel reads across,
+    # and by rounding in the center square: a mean under 0.5 levels and a
+    # 99th percentile of at most 2 levels per channel and patch. A reduced decode maps the
+    # boxes to sub-pixel regions of the smaller image.
+    sx, sy = img.size[0] / w, img.size[1] / h
+    span = cell * grid_n
+    box = (sq_left * sx, sq_top * sy, (sq_left + span) * sx, (sq_top + span) * sy)
+    mosaic = img.resize((PATCH_SIZE * grid_n, PATCH_SIZE * grid_n), resample=Image.BICUBIC, box=box)
+    tiles = np.asarray(mosaic)
+
+    batch = np.empty((len(meta), PATCH_SIZE, PATCH_SIZE, 3), dtype=np.uint8)
+    grid = tiles.reshape(grid_n, PATCH_SIZE, grid_n, PATCH_SIZE, 3).swapaxes(1, 2)
+    batch[1:] = grid.reshape(-1, PATCH_SIZE, PATCH_SIZE, 3)
+
+    if cell * sx > PATCH_SIZE:
+        extent = side * PATCH_SIZE / cell
+        pad = math.ceil(extent) - tiles.shape[0]
+        if pad > 0:
+            mosaic = Image.fromarray(np.pad(tiles, ((0, pad), (0, pad), (0, 0)), mode="edge"))
+        center = mosaic.resize((PATCH_SIZE, PATCH_SIZE), resample=Image.BICUBIC, box=(0, 0, extent, extent))
+    else:
+        box = (sq_left * sx, sq_top * sy, (sq_left + side) * sx, (sq_top + side) * sy)
+        center = img.resize((PATCH_SIZE, PATCH_SIZE), resample=Image.BICUBIC, box=box)
+    batch[0] = np.asarray(center)
+
+    return batch, meta
 
 
 # TODO:
@@ -53,24 +209,57 @@ def _upload_patch(
     s3_client,
     processed_bucket: str,
     key: str,
-    img: Image.Image,
+    patch: Patch,
+    patch_format: str = PATCH_FORMAT,
 ) -> str:
     """
-    Upload a patch image to S3 and return its s3:// URI.
+    Encode a patch in patch_format (unless it already is), upload it to S3 (or
+    the storage.Storage passed as s3_client) and return its URI.
     """
-    body = _encode_jpeg(img)
-    s3_client.put_object(
-        Bucket=processed_bucket,
-        Key=key,
-        Body=body,
-        ContentType="image/jpeg",
+    encoder = get_patch_encoder(patch_format)
+    storage = as_storage(s3_client)
+    storage.put(
+        processed_bucket,
+        key,
+        patch if isinstance(patch, bytes) else encoder.encode(patch),
+        content_type=encoder.content_type,
     )
-    return f"s3://{processed_bucket}/{key}"
+    return storage.uri(processed_bucket, key)
+
+def upload_patches(
+    s3_client,
+    processed_bucket: str,
+    uploads: List[Tuple[str, Patch, str]],
+    max_workers: int = PATCH_UPLOAD_WORKERS,
+) -> None:
+    """
+    Upload (key, patch, patch_format) triples concurrently through a bounded
+    thread pool sharing s3_client (or a storage.Storage). Returns once every
+    upload has succeeded; if one fails, pending uploads are cancelled and the
+    first error is raised.
+    """
+    storage = as_storage(s3_client)
+    if max_workers <= 1 or len(uploads) <= 1:
+        for key, patch, patch_format in uploads:
+            _upload_patch(storage, processed_bucket, key, patch, patch_format)
+        return
+
+    with ThreadPoolExecutor(max_workers=min(max_workers, len(uploads))) as pool:
+        futures = [
+            pool.submit(_upload_patch, storage, processed_bucket, key, patch, patch_format)
+            for key, patch, patch_format in uploads
+        ]
+        done, not_done = wait(futures, return_when=FIRST_EXCEPTION)
+        for f in not_done:
+            f.cancel()
+
+    for f in futures:
+        if f.done() and not f.cancelled() and f.exception() is not None:
+            raise f.exception()
 
 # TODO
 def _add_patch_record(
     patches: List[Dict],
-    patch_img: Image.Image,
     patch_type: str,
     x: int,
     y: int,
@@ -79,27 +268,107 @@ def _add_patch_record(
     processed_prefix: str,
     image_id: str,
     processed_bucket: str,
-    s3_client,
-) -> None:
+    patch_format: str = PATCH_FORMAT,
+    storage: Optional[Storage] = None,
+) -> str:
     """
     Store patch's metadata, so it can be eventually updated in DynamoDB.
+    Returns the S3 key the patch should be uploaded to. patch_path is its URI
+    in storage (S3 by default).
     """
-    patch_img = patch_img.resize((PATCH_SIZE, PATCH_SIZE), resample=Image.BICUBIC)
-
-    patch_id = str(uuid.uuid4())
-    key = f"{processed_prefix}/{image_id}/{patch_type}/{patch_id}.jpg"
-    s3_uri = _upload_patch(s3_client, processed_bucket, key, patch_img)
+    patch_id = patch_id_for(image_id, patch_type, x, y, width, height)
+    extension = get_patch_encoder(patch_format).extension
+    key = f"{processed_prefix}/{image_id}/{patch_type}/{patch_id}.{extension}"
 
     metadata: Dict = {
         "patch_id": patch_id,
         "patch_type": patch_type,
-        "patch_path": s3_uri,
+        "patch_path": storage.uri(processed_bucket, key) if storage else f"s3://{processed_bucket}/{key}",
+        "patch_format": patch_format,
         "patch_x": int(x),
         "patch_y": int(y),
         "patch_width": int(width),
         "patch_height": int(height),
     }
     patches.append(metadata)
+    return key
+
+def plan_patch_uploads(
+    batch: Sequence[Patch],
+    meta: List[Dict],
+    image_id: str,
+    processed_bucket: str,
+    processed_prefix: str,
+    patch_format: str = PATCH_FORMAT,
+    storage: Optional[Storage] = None,
+) -> Tuple[List[Dict], List[Tuple[str, Patch, str]]]:
+    """
+    Assign ids and S3 keys to an extracted patch batch (or its patches already
+    encoded, see encode_patches) without uploading it.
+    Returns the patch metadata dicts and the (key, patch, patch_format) triples
+    to pass to upload_patches. Uploading the same triples again is idempotent.
+    Pass the storage they will be uploaded to if it is not S3.
+    """
+    patches: List[Dict] = []
+    uploads: List[Tuple[str, Patch, str]] = []
+    for patch, m in zip(batch, meta):
+        key = _add_patch_record(
+            patches=patches,
+            patch_type=m["patch_type"],
+            x=m["x"],
+            y=m["y"],
+            width=m["width"],
+            height=m["height"],
+            processed_prefix=processed_prefix,
+            image_id=image_id,
+            processed_bucket=processed_bucket,
+            patch_format=patch_format,
+            storage=storage,
+        )
+        uploads.append((key, patch, patch_format))
+    return patches, uploads
+
+def encode_patches(batch: np.ndarray, patch_format: str = PATCH_FORMAT) -> List[bytes]:
+    """Encode every patch of an extracted batch in patch_format."""
+    encoder = get_patch_encoder(patch_format)
+    return [encoder.encode(patch) for patch in batch]
+
+def shard_patches(
+    batch: Sequence[Patch],
+    meta: List[Dict],
+    shard_writer,
+    patch_format: str = PATCH_FORMAT,
+    image_id: Optional[str] = None,
+) -> List[Dict]:
+    """
+    Encode an extracted patch batch (unless already encoded) into shard_writer
+    (see shards.ShardWriter) instead of one S3 object per patch. Each metadata
+    dict carries the patch's shard_uri, offset and length; patch_path is the
+    shard URI. Patch ids are derived from image_id when it is given.
+    """
+    encoder = get_patch_encoder(patch_format)
+    patches: List[Dict] = []
+    for patch, m in zip(batch, meta):
+        if image_id is not None:
+            patch_id = patch_id_for(image_id, m["patch_type"], m["x"], m["y"], m["width"], m["height"])
+        else:
+            patch_id = str(uuid.uuid4())
+        data = patch if isinstance(patch, bytes) else encoder.encode(patch)
+        loc = shard_writer.add(patch_id, data, patch_format)
+        patches.append({
+            "patch_id": patch_id,
+            "patch_type": m["patch_type"],
+            "patch_path": loc["shard_uri"],
+            "patch_format": patch_format,
+            "shard_uri": loc["shard_uri"],
+            "offset": loc["offset"],
+            "length": loc["length"],
+            "patch_x": int(m["x"]),
+            "patch_y": int(m["y"]),
+            "patch_width": int(m["width"]),
+            "patch_height": int(m["height"]),
+        })
+    return patches
 
 # TODO:
 def process_image_to_patches(
@@ -108,68 +377,34 @@ def process_image_to_patches(
     processed_bucket: str,
     processed_prefix: str,
     s3_client,
+    max_workers: int = PATCH_UPLOAD_WORKERS,
+    source_size: Optional[Tuple[int, int]] = None,
+    patch_format: str = PATCH_FORMAT,
+    shard_writer=None,
 ) -> List[Dict]:
     """
     Produce a center-cropped square from the full image, and (2^p x 2^p) grid patches
     from it. All patches are resized to 256x256 using bicubic resampling.
+    Patches are uploaded concurrently with at most max_workers uploads in flight.
+    Pass source_size when img came from a reduced decode (see decode_image).
+    Patch files are written in patch_format (see encoding.PATCH_ENCODERS), and
+    appended to shard_writer instead of uploaded one by one when it is given.
     Returns a list of patch metadata dicts suitable for writing to DynamoDB.
     """
-    if img.mode != "RGB":
-        img = img.convert("RGB")
-
-    square, sq_left, sq_top, sq_side = _center_crop_square(img)
-
-    p = _choose_p(img)
-    grid_n = 2 ** p  
-
-    cell = sq_side // grid_n
-    if cell <= 0:
-        raise ValueError("Image too small to create grid patches.")
-
-    patches: List[Dict] = []
+    batch, meta = extract_patches(img, source_size=source_size)
+    if shard_writer is not None:
+        return shard_patches(batch, meta, shard_writer, patch_format=patch_format, image_id=image_id)
 
-    # Center square patch
-    _add_patch_record(
-        patches=patches,
-        patch_img=square,
-        patch_type="center_square",
-        x=sq_left,
-        y=sq_top,
-        width=sq_side,
-        height=sq_side,
-        processed_prefix=processed_prefix,
+    patches, uploads = plan_patch_uploads(
+        batch=batch,
+        meta=meta,
         image_id=image_id,
         processed_bucket=processed_bucket,
-        s3_client=s3_client,
+        processed_prefix=processed_prefix,
+        patch_format=patch_format,
+        storage=as_storage(s3_client),
     )
-
-    # Grid patches
-    for row in range(grid_n):
-        for col in range(grid_n):
-            x0 = col * cell
-            y0 = row * cell
-            x1 = x0 + cell
-            y1 = y0 + cell
-
-            patch = square.crop((x0, y0, x1, y1))
-
-            orig_x = sq_left + x0
-            orig_y = sq_top + y0
-
-            _add_patch_record(
-                patches=patches,
-                patch_img=patch,
-                patch_type="grid",
-                x=orig_x,
-                y=orig_y,
-                width=cell,
-                height=cell,
-                processed_prefix=processed_prefix,
-                image_id=image_id,
-                processed_bucket=processed_bucket,
-                s3_client=s3_client,
-            )
-
+    upload_patches(s3_client, processed_bucket, uploads, max_workers=max_workers)
     return patches
 
 def process_training_image(
@@ -178,6 +413,10 @@ def process_training_image(
     processed_bucket: str,
     processed_prefix: str,
     s3_client,
+    max_workers: int = PATCH_UPLOAD_WORKERS,
+    source_size: Optional[Tuple[int, int]] = None,
+    patch_format: str = PATCH_FORMAT,
+    shard_writer=None,
 ) -> List[Dict]:
     return process_image_to_patches(
         img=img,
@@ -185,6 +424,10 @@ def process_training_image(
         processed_bucket=processed_bucket,
         processed_prefix=processed_prefix,
         s3_client=s3_client,
+        max_workers=max_workers,
+        source_size=source_size,
+        patch_format=patch_format,
+        shard_writer=shard_writer,
     )
 
 
@@ -194,6 +437,9 @@ def process_inference_image(
     processed_bucket: str,
     processed_prefix: str,
     s3_client,
+    max_workers: int = PATCH_UPLOAD_WORKERS,
+    source_size: Optional[Tuple[int, int]] = None,
+    patch_format: str = PATCH_FORMAT,
 ) -> List[Dict]:
     return process_image_to_patches(
         img=img,
@@ -201,4 +447,7 @@ def process_inference_image(
         processed_bucket=processed_bucket,
         processed_prefix=processed_prefix,
         s3_client=s3_client,
+        max_workers=max_workers,
+        source_size=source_size,
+        patch_format=patch_format,
     )
\ No newline at end of file
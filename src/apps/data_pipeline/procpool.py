@@ -0,0 +1,165 @@
+"""
+Process-pool execution for the driver's decode stage.
+
+Decoding, cropping, bicubic resizing and patch encoding are CPU-bound and
+mostly hold the GIL, so decode threads in one process share a single core.
+DecodePool runs that work in worker processes instead. The parent keeps all
+I/O: it copies each image's raw bytes into a shared-memory block, a worker
+decodes it from there, extracts and encodes the patches, and writes the encoded
+patches back into a second shared-memory block. Only the block names, patch
+lengths and patch metadata are pickled.
+"""
+from __future__ import annotations
+
+import io
+import multiprocessing as mp
+import os
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass
+from multiprocessing import shared_memory
+from typing import Dict, List, Optional, Tuple
+
+from src.apps.data_pipeline.process import (
+    PATCH_FORMAT,
+    REDUCED_DECODE,
+    decode_image,
+    encode_patches,
+    extract_patches,
+)
+
+# 0 decodes on threads in the driver process.
+DRIVER_DECODE_PROCESSES = int(os.getenv("DRIVER_DECODE_PROCESSES", "0"))
+
+
+@dataclass
+class DecodedImage:
+    width: int
+    height: int
+    meta: List[Dict]
+    encoded: List[bytes]
+
+    @property
+    def nbytes(self) -> int:
+        return sum(len(p) for p in self.encoded)
+
+
+class _SharedReader(io.RawIOBase):
+    """Seekable read-only file over a memoryview, without copying it."""
+
+    def __init__(self, view: memoryview):
+        self._view = view
+        self._pos = 0
+
+    def readable(self) -> bool:
+        return True
+
+    def seekable(self) -> bool:
+        return True
+
+    def readinto(self, b) -> int:
+        n = max(0, min(len(b), len(self._view) - self._pos))
+        b[:n] = self._view[self._pos:self._pos + n]
+        self._pos += n
+        return n
+
+    def seek(self, offset: int, whence: int = io.SEEK_SET) -> int:
+        if whence == io.SEEK_SET:
+            self._pos = offset
+        elif whence == io.SEEK_CUR:
+            self._pos += offset
+        else:
+            self._pos = len(self._view) + offset
+        return self._pos
+
+    def tell(self) -> int:
+        return self._pos
+
+
+def _decode_in_worker(
+    in_name: str,
+    size: int,
+    patch_format: str,
+    reduced: bool,
+) -> Optional[Tuple[str, List[int], List[Dict], int, int]]:
+    """
+    Worker side: decode the image in shared block in_name, extract and encode
+    its patches, and return (out block name, patch lengths, meta, width, height),
+    or None if the bytes are not an image. The parent unlinks both blocks.
+    """
+    shm_in = shared_memory.SharedMemory(name=in_name)
+    try:
+        view = shm_in.buf[:size]
+        try:
+            try:
+                img, (w, h) = decode_image(io.BufferedReader(_SharedReader(view)), reduced=reduced)
+            except Exception:
+                return None
+            batch, meta = extract_patches(img, source_size=(w, h))
+            del img
+        finally:
+            view.release()
+    finally:
+        shm_in.close()
+
+    encoded = encode_patches(batch, patch_format)
+    lengths = [len(p) for p in encoded]
+    shm_out = shared_memory.SharedMemory(create=True, size=max(1, sum(lengths)))
+    try:
+        offset = 0
+        for data in encoded:
+            shm_out.buf[offset:offset + len(data)] = data
+            offset += len(data)
+        return shm_out.name, lengths, meta, w, h
+    finally:
+        shm_out.close()
+
+
+class DecodePool:
+    """
+    A pool of decode worker processes. decode() is called from the driver's
+    decode-stage threads; run at least as many of those as there are processes.
+    """
+
+    def __init__(self, processes: int, reduced: bool = REDUCED_DECODE):
+        self.processes = processes
+        self.reduced = reduced
+        # spawn rather than fork: the driver has live threads (and boto3
+        # connection pools) by the time the pool starts.
+        self._executor = ProcessPoolExecutor(max_workers=processes, mp_context=mp.get_context("spawn"))
+
+    def decode(self, data: bytes, patch_format: str = PATCH_FORMAT) -> Optional[DecodedImage]:
+        """
+        Decode data and encode its patches in a worker process. Returns None if
+        data is not an image.
+        """
+        shm_in = shared_memory.SharedMemory(create=True, size=max(1, len(data)))
+        try:
+            shm_in.buf[:len(data)] = data
+            result = self._executor.submit(
+                _decode_in_worker, shm_in.name, len(data), patch_format, self.reduced,
+            ).result()
+        finally:
+            shm_in.close()
+            shm_in.unlink()
+
+        if result is None:
+            return None
+        out_name, lengths, meta, w, h = result
+        shm_out = shared_memory.SharedMemory(name=out_name)
+        try:
+            encoded, offset = [], 0
+            for n in lengths:
+                encoded.append(bytes(shm_out.buf[offset:offset + n]))
+                offset += n
+        finally:
+            shm_out.close()
+            shm_out.unlink()
+        return DecodedImage(width=w, height=h, meta=meta, encoded=encoded)
+
+    def warm_up(self) -> None:
+        """Start every worker process now instead of on first use."""
+        for f in [self._executor.submit(os.getpid) for _ in range(self.processes)]:
+            f.result()
+
+    def close(self) -> None:
+        self._executor.shutdown(wait=True)
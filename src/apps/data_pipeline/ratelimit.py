@@ -0,0 +1,245 @@
+"""
+Client-side rate limiting and retries for the AWS clients.
+
+Pushed hard, DynamoDB answers ProvisionedThroughputExceededException and S3
+answers SlowDown. limit_client() makes a boto3 client wait for a token from an
+AdaptiveRateLimiter before every request (retries included) and replaces its
+retry handler with one that retries throttling, 5xx and connection errors with
+jittered exponential backoff, up to AWS_MAX_ATTEMPTS attempts.
+
+The limiter is a token bucket whose rate follows AIMD: it does not limit at all
+until the first throttling response. A throttle multiplies the rate (at first,
+the rate requests were being sent at) by AWS_RATE_DECREASE, and lowers it
+further to the rate the service accepted lately; cuts come at most once per
+AWS_RATE_COOLDOWN_S, since requests already in flight are throttled too.
+Every successful request adds to the rate, about AWS_RATE_INCREASE_PER_S per
+second. The rate so settles just under what the service accepts, instead of
+images failing once botocore's retries run out.
+BatchWriteItem responses with UnprocessedItems count as throttles.
+
+There is one limiter per service and process (shared_rate_limiter), so all
+the driver's stage workers, or all the API's requests, share it. Set
+AWS_RATE_LIMIT=0 to leave clients to botocore's own retries.
+"""
+from __future__ import annotations
+
+import os
+import random
+import threading
+import time
+from typing import Dict, Optional
+
+from botocore.exceptions import ConnectionError as BotoConnectionError
+from botocore.exceptions import HTTPClientError
+
+AWS_RATE_LIMIT = os.getenv("AWS_RATE_LIMIT", "1") == "1"
+AWS_RATE_MIN_PER_S = float(os.getenv("AWS_RATE_MIN_PER_S", "1"))
+AWS_RATE_MAX_PER_S = float(os.getenv("AWS_RATE_MAX_PER_S", "10000"))
+AWS_RATE_INCREASE_PER_S = float(os.getenv("AWS_RATE_INCREASE_PER_S", "5"))
+AWS_RATE_DECREASE = float(os.getenv("AWS_RATE_DECREASE", "0.7"))
+AWS_RATE_COOLDOWN_S = float(os.getenv("AWS_RATE_COOLDOWN_S", "0.5"))
+AWS_MAX_ATTEMPTS = int(os.getenv("AWS_MAX_ATTEMPTS", "10"))
+AWS_RETRY_BASE_DELAY_S = float(os.getenv("AWS_RETRY_BASE_DELAY_S", "0.05"))
+AWS_RETRY_MAX_DELAY_S = float(os.getenv("AWS_RETRY_MAX_DELAY_S", "5"))
+
+THROTTLING_ERROR_CODES = {
+    "ProvisionedThroughputExceededException",
+    "RequestLimitExceeded",
+    "SlowDown",
+    "Throttling",
+    "ThrottlingException",
+    "ThrottledException",
+    "RequestThrottled",
+    "RequestThrottledException",
+    "TooManyRequestsException",
+}
+TRANSIENT_ERROR_CODES = {
+    "InternalError",
+    "InternalServerError",
+    "RequestTimeout",
+    "RequestTimeoutException",
+    "ServiceUnavailable",
+    "TransactionInProgressException",
+}
+
+# How long the rates requests are sent and accepted at are averaged over.
+_MEASURE_WINDOW_S = 0.5
+
+
+class AdaptiveRateLimiter:
+    """
+    Token bucket with an AIMD rate (see the module docstring). rate is None
+    while unlimited. Thread-safe; acquire() blocks the calling thread.
+    """
+
+    def __init__(
+        self,
+        name: str,
+        min_rate: float = AWS_RATE_MIN_PER_S,
+        max_rate: float = AWS_RATE_MAX_PER_S,
+        increase_per_s: float = AWS_RATE_INCREASE_PER_S,
+        decrease: float = AWS_RATE_DECREASE,
+        cooldown_s: float = AWS_RATE_COOLDOWN_S,
+    ):
+        self.name = name
+        self.min_rate = min_rate
+        self.max_rate = max_rate
+        self.increase_per_s = increase_per_s
+        self.decrease = decrease
+        self.cooldown_s = cooldown_s
+        self.rate: Optional[float] = None
+        self.throttles = 0
+        self.waited_s = 0.0
+        self._lock = threading.Lock()
+        self._tokens = 0.0
+        self._filled_at = time.monotonic()
+        self._cut_at = float("-inf")
+        self._window_start = self._filled_at
+        self._window_sent = 0
+        self._window_ok = 0
+        self._sent_rate = 0.0
+        self._ok_rate = 0.0
+
+    def acquire(self) -> None:
+        """Wait until a request may be sent."""
+        with self._lock:
+            now = time.monotonic()
+            self._roll(now)
+            self._window_sent += 1
+            if self.rate is None:
+                return
+            self._tokens = min(1.0, self._tokens + (now - self._filled_at) * self.rate)
+            self._filled_at = now
+            # Take the token now and sleep until it would have been there, so
+            # waiting threads are served in order.
+            self._tokens -= 1.0
+            wait = -self._tokens / self.rate if self._tokens < 0 else 0.0
+            self.waited_s += wait
+        if wait > 0:
+            time.sleep(wait)
+
+    def succeeded(self) -> None:
+        with self._lock:
+            self._roll(time.monotonic())
+            self._window_ok += 1
+            if self.rate is None:
+                return
+            # Only grow while the rate is being used, or a quiet spell would
+            # let it climb far past what the service accepts.
+            if self._sent_rate and self.rate > 2 * self._sent_rate:
+                return
+            self.rate = min(self.max_rate, self.rate + self.increase_per_s / self.rate)
+
+    def throttled(self) -> None:
+        with self._lock:
+            self.throttles += 1
+            now = time.monotonic()
+            if now - self._cut_at < self.cooldown_s:
+                return
+            self._cut_at = now
+            self._roll(now)
+            sent_rate, ok_rate = self._rates(now)
+            rate = (self.rate if self.rate is not None else sent_rate) * self.decrease
+            # What the service accepted lately is a closer bound than a cut
+            # from far above it, e.g. the unlimited rate before the first throttle.
+            if ok_rate:
+                rate = min(rate, ok_rate)
+            self.rate = max(self.min_rate, rate)
+            self._tokens = min(self._tokens, 0.0)
+            self._filled_at = now
+
+    def _roll(self, now: float) -> None:
+        """Close the measurement window once it is _MEASURE_WINDOW_S old."""
+        elapsed = now - self._window_start
+        if elapsed >= _MEASURE_WINDOW_S:
+            self._sent_rate = self._window_sent / elapsed
+            self._ok_rate = self._window_ok / elapsed
+            self._window_start, self._window_sent, self._window_ok = now, 0, 0
+
+    def _rates(self, now: float) -> tuple:
+        """(sent, accepted) per second over the last window, or so far in the first one."""
+        if self._sent_rate:
+            return self._sent_rate, self._ok_rate
+        elapsed = now - self._window_start
+        if elapsed <= 0:
+            return self.max_rate, 0.0
+        return self._window_sent / elapsed, self._window_ok / elapsed
+
+    def to_dict(self) -> Dict:
+        return {"rate_per_s": self.rate, "throttles": self.throttles, "waited_s": self.waited_s}
+
+
+_limiters: Dict[str, AdaptiveRateLimiter] = {}
+_limiters_lock = threading.Lock()
+
+
+def shared_rate_limiter(service: str) -> AdaptiveRateLimiter:
+    """The process-wide limiter for service ("s3", "dynamodb", ...)."""
+    with _limiters_lock:
+        limiter = _limiters.get(service)
+        if limiter is None:
+            limiter = _limiters[service] = AdaptiveRateLimiter(service)
+        return limiter
+
+
+def retry_delay(attempt: int) -> float:
+    """Jittered exponential backoff before retry number attempt (from 1)."""
+    delay = min(AWS_RETRY_MAX_DELAY_S, AWS_RETRY_BASE_DELAY_S * (2 ** (attempt - 1)))
+    return delay * random.uniform(0.5, 1.5)
+
+
+def is_throttle(response) -> bool:
+    """Whether a botocore (http_response, parsed) pair is a throttling error."""
+    http_response, parsed = response
+    code = (parsed.get("Error") or {}).get("Code")
+    return code in THROTTLING_ERROR_CODES or http_response.status_code == 429
+
+
+def limit_client(
+    client,
+    limiter: Optional[AdaptiveRateLimiter] = None,
+    max_attempts: int = AWS_MAX_ATTEMPTS,
+) -> Optional[AdaptiveRateLimiter]:
+    """
+    Route every request of a boto3 client through limiter (by default the
+    shared one for its service) and retry throttling and transient errors
+    with jittered backoff. For a resource, pass resource.meta.client.
+    Returns the limiter, or None if AWS_RATE_LIMIT is off.
+    """
+    if not AWS_RATE_LIMIT:
+        return None
+    service = client.meta.service_model.service_name
+    if limiter is None:
+        limiter = shared_rate_limiter(service)
+    event_name = client.meta.service_model.service_id.hyphenize()
+
+    def _before_send(**kwargs):
+        limiter.acquire()
+
+    def _needs_retry(response, attempts, caught_exception, **kwargs):
+        if caught_exception is not None:
+            retry = isinstance(caught_exception, (BotoConnectionError, HTTPClientError))
+        elif is_throttle(response):
+            limiter.throttled()
+            retry = True
+        else:
+            http_response, parsed = response
+            code = (parsed.get("Error") or {}).get("Code")
+            retry = http_response.status_code >= 500 or code in TRANSIENT_ERROR_CODES
+            if not retry:
+                limiter.succeeded()
+        if retry and attempts < max_attempts:
+            return retry_delay(attempts)
+        return None
+
+    def _after_batch_write(parsed, **kwargs):
+        if parsed.get("UnprocessedItems"):
+            limiter.throttled()
+
+    events = client.meta.events
+    # Replace botocore's retry handler, which gives up after a few throttles.
+    events.unregister(f"needs-retry.{event_name}", unique_id=f"retry-config-{event_name}")
+    events.register(f"needs-retry.{event_name}", _needs_retry, unique_id=f"retry-config-{event_name}")
+    events.register(f"before-send.{event_name}", _before_send)
+    events.register(f"after-call.{event_name}.BatchWriteItem", _after_batch_write)
+    return limiter
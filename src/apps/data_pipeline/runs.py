@@ -0,0 +1,216 @@
+"""
+Run-record bookkeeping for sharded processing runs.
+
+A processing run is split across num_shards driver tasks, each taking the keys
+whose hash lands on its shard_index (see shard_for_key). The run's RunRecord
+holds one entry per shard in a "shards" map (status, counts, task ARN, timing)
+plus run-level totals that every shard ADDs to when it finishes. The shard that
+finishes last sets the run-level status from the shard statuses.
+
+Shard statuses: pending -> running -> completed | completed_with_errors | failed
+(failed_to_start if its task could not be launched).
+"""
+from __future__ import annotations
+
+import hashlib
+import time
+from decimal import Decimal
+from typing import Dict, List, Optional
+
+from botocore.exceptions import ClientError
+
+FINISHED_SHARD_STATUSES = {"completed", "completed_with_errors", "failed", "failed_to_start"}
+
+
+def now_ms() -> int:
+    return int(time.time() * 1000)
+
+
+def shard_for_key(key: str, num_shards: int) -> int:
+    """Deterministic shard of an S3 key, the same in every process and run."""
+    digest = hashlib.md5(key.encode("utf-8")).digest()
+    return int.from_bytes(digest[:8], "big") % num_shards
+
+
+def shard_name(shard_index: int) -> str:
+    return f"{shard_index:03d}"
+
+
+def combine_shard_statuses(statuses: List[str]) -> str:
+    """Run-level status from the statuses of its shards."""
+    if any(s not in FINISHED_SHARD_STATUSES for s in statuses):
+        return "running"
+    if all(s == "completed" for s in statuses):
+        return "completed"
+    if all(s in ("failed", "failed_to_start") for s in statuses):
+        return "failed"
+    return "completed_with_errors"
+
+
+def create_run(runs_table, run_id: str, num_shards: int) -> None:
+    """Write a new run record with every shard pending."""
+    runs_table.put_item(Item={
+        "run_id": run_id,
+        "created_at": now_ms(),
+        "status": "running",
+        "num_shards": num_shards,
+        "shards": {shard_name(i): {"status": "pending"} for i in range(num_shards)},
+        "shards_finished": 0,
+        "images_total": 0,
+        "patches_total": 0,
+        "errors_total": 0,
+    })
+
+
+def set_shard_task(runs_table, run_id: str, shard_index: int, task_arn: Optional[str]) -> None:
+    """Record the ECS task launched for a shard, or that none could be."""
+    if task_arn:
+        runs_table.update_item(
+            Key={"run_id": run_id},
+            UpdateExpression="SET shards.#i.task_arn = :t",
+            ExpressionAttributeNames={"#i": shard_name(shard_index)},
+            ExpressionAttributeValues={":t": task_arn},
+        )
+    else:
+        finish_shard(runs_table, run_id, shard_index, "failed_to_start")
+
+
+def start_shard(runs_table, run_id: str, shard_index: int, num_shards: int) -> None:
+    """
+    Mark a shard running. Creates the run record first if the driver was
+    started without /process_data.
+    """
+    runs_table.update_item(
+        Key={"run_id": run_id},
+        UpdateExpression=(
+            "SET created_at = if_not_exists(created_at, :now), "
+            "#s = if_not_exists(#s, :running), "
+            "num_shards = if_not_exists(num_shards, :n), "
+            "shards = if_not_exists(shards, :empty)"
+        ),
+        ExpressionAttributeNames={"#s": "status"},
+        ExpressionAttributeValues={":now": now_ms(), ":running": "running", ":n": num_shards, ":empty": {}},
+    )
+    names = {"#i": shard_name(shard_index), "#s": "status"}
+    shard = ((get_run(runs_table, run_id) or {}).get("shards") or {}).get(shard_name(shard_index))
+    if shard is None:
+        runs_table.update_item(
+            Key={"run_id": run_id},
+            UpdateExpression="SET shards.#i = :shard",
+            ExpressionAttributeNames={"#i": shard_name(shard_index)},
+            ExpressionAttributeValues={":shard": {"status": "running", "started_at": now_ms()}},
+        )
+    elif shard.get("status") in FINISHED_SHARD_STATUSES:
+        # A finished shard run again (e.g. to retry its failed images): it is
+        # no longer finished, but the counts of earlier attempts are kept.
+        runs_table.update_item(
+            Key={"run_id": run_id},
+            UpdateExpression=(
+                "SET shards.#i.#s = :running, shards.#i.started_at = :now, #s = :running "
+                "ADD shards_finished :minus_one"
+            ),
+            ConditionExpression="shards.#i.#s = :previous",
+            ExpressionAttributeNames=names,
+            ExpressionAttributeValues={
+                ":running": "running",
+                ":now": now_ms(),
+                ":previous": shard["status"],
+                ":minus_one": -1,
+            },
+        )
+    else:
+        # Set fields one by one so a task_arn written by /process_data is kept.
+        runs_table.update_item(
+            Key={"run_id": run_id},
+            UpdateExpression="SET shards.#i.#s = :running, shards.#i.started_at = :now",
+            ExpressionAttributeNames=names,
+            ExpressionAttributeValues={":running": "running", ":now": now_ms()},
+        )
+
+
+def update_shard_metrics(runs_table, run_id: str, shard_index: int, metrics: Dict) -> None:
+    """Replace the live metrics snapshot (see metrics.py) on a shard's entry."""
+    runs_table.update_item(
+        Key={"run_id": run_id},
+        UpdateExpression="SET shards.#i.#m = :m, shards.#i.metrics_at = :now",
+        ExpressionAttributeNames={"#i": shard_name(shard_index), "#m": "metrics"},
+        ExpressionAttributeValues={":m": to_dynamo(metrics), ":now": now_ms()},
+    )
+
+
+def finish_shard(
+    runs_table,
+    run_id: str,
+    shard_index: int,
+    status: str,
+    images: int = 0,
+    patches: int = 0,
+    errors: int = 0,
+    summary: Optional[Dict] = None,
+) -> str:
+    """
+    Record a shard's final status, add its counts to the shard's and the run's
+    totals and, if this was the last shard to finish, set the run-level status.
+    The shard must already have an entry (create_run or start_shard); a shard
+    that has already finished is left as it is, so its counts are never added
+    twice. Returns the run-level status as of this update.
+    """
+    sets = [
+        "shards.#i.#s = :status",
+        "shards.#i.images = if_not_exists(shards.#i.images, :zero) + :img",
+        "shards.#i.patches = if_not_exists(shards.#i.patches, :zero) + :p",
+        "shards.#i.errors = if_not_exists(shards.#i.errors, :zero) + :e",
+        "shards.#i.finished_at = :now",
+    ]
+    values = {":status": status, ":img": images, ":p": patches, ":e": errors, ":now": now_ms(), ":one": 1, ":zero": 0}
+    finished = {f":done{n}": s for n, s in enumerate(sorted(FINISHED_SHARD_STATUSES))}
+    values.update(finished)
+    if summary is not None:
+        sets.append("shards.#i.summary = :summary")
+        values[":summary"] = to_dynamo(summary)
+
+    try:
+        resp = runs_table.update_item(
+            Key={"run_id": run_id},
+            UpdateExpression=(
+                "SET " + ", ".join(sets) + " "
+                "ADD shards_finished :one, images_total :img, patches_total :p, errors_total :e"
+            ),
+            ConditionExpression=f"NOT shards.#i.#s IN ({', '.join(finished)})",
+            ExpressionAttributeNames={"#i": shard_name(shard_index), "#s": "status"},
+            ExpressionAttributeValues=values,
+            ReturnValues="ALL_NEW",
+        )
+    except ClientError as exc:
+        if exc.response["Error"]["Code"] != "ConditionalCheckFailedException":
+            raise
+        return (get_run(runs_table, run_id) or {}).get("status", "running")
+    run = resp["Attributes"]
+    num_shards = int(run.get("num_shards", 1))
+    if int(run.get("shards_finished", 0)) < num_shards:
+        return "running"
+
+    statuses = [run["shards"].get(shard_name(i), {}).get("status", "pending") for i in range(num_shards)]
+    run_status = combine_shard_statuses(statuses)
+    runs_table.update_item(
+        Key={"run_id": run_id},
+        UpdateExpression="SET #s = :s",
+        ExpressionAttributeNames={"#s": "status"},
+        ExpressionAttributeValues={":s": run_status},
+    )
+    return run_status
+
+
+def get_run(runs_table, run_id: str) -> Optional[Dict]:
+    return runs_table.get_item(Key={"run_id": run_id}, ConsistentRead=True).get("Item")
+
+
+def to_dynamo(value):
+    """Floats (nested in dicts and lists too) as Decimal, as DynamoDB requires."""
+    if isinstance(value, float):
+        return Decimal(str(round(value, 4)))
+    if isinstance(value, dict):
+        return {k: to_dynamo(v) for k, v in value.items()}
+    if isinstance(value, list):
+        return [to_dynamo(v) for v in value]
+    return value
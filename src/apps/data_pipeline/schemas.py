@@ -13,7 +13,8 @@ class User:
 
 # We will store each inference's id, the user associated with the inference request,
 # the path to the uploaded image (for debugging), the image's name, the model's
-# predicted score, and supporting explanation.
+# predicted score, and supporting explanation. persist_status tracks whether the
+# upload and its patches have been written yet (pending / persisted).
 @dataclass
 class InferenceRecord:
     inference_id: str = field(default_factory=lambda: str(uuid.uuid4()))
@@ -23,10 +24,13 @@ class InferenceRecord:
     image_path: str = ""          
     score: float = 0.0   
     explanation: Optional[str] = None
+    persist_status: Optional[str] = None
 
 # We will store each image's id, name, path and dimensions. We will also store it's label 
 # (authentic) vs. inauthentic), sublabel (original vs. forgery vs. imitation), run, fold and 
 # dataset information for split reproducibility, attributed creator and actual creator.
+# Images whose bytes match an earlier image point at it with duplicate_of and
+# reuse its patches instead of having their own.
 @dataclass
 class ImageRecord:
     image_id: str = field(default_factory=lambda: str(uuid.uuid4()))
@@ -42,14 +46,22 @@ class ImageRecord:
     split: Optional[str] = None               # train / val / test / unassigned (used by LabelSplitIndex GSI)
     attributed_creator: Optional[str] = None
     actual_creator: Optional[str] = None
+    duplicate_of: Optional[str] = None
 
 # We will store each patch's id, path and associated image. We will also store
-# it's type (is it a grid patch, or center patch), dimensions and location.
+# it's type (is it a grid patch, or center patch), dimensions and location, and
+# the format the patch file is stored in (see data_pipeline/encoding.py). Patches
+# packed into a shard (see data_pipeline/shards.py) also store the shard and their
+# byte range within it.
 @dataclass
 class PatchRecord:
     patch_id: str = field(default_factory=lambda: str(uuid.uuid4()))
     created_at: int = field(default_factory=lambda: int(time.time() * 1000))
     patch_path: str = ""
+    patch_format: str = "jpeg"
+    shard_uri: Optional[str] = None
+    offset: Optional[int] = None
+    length: Optional[int] = None
     image_id: str = ""
     patch_type: str = ""
     patch_x: int = 0
@@ -59,6 +71,9 @@ class PatchRecord:
 
 # We will store each run's model artifacts (i.e., best weights and hyperparameter config.), 
 # information to reproduce the data splits and averaged metrics across folds.
+# Data-processing runs are split across num_shards driver tasks: shards maps each
+# shard ("000", "001", ...) to its status, counts and task ARN, and the *_total
+# counters add up every finished shard (see data_pipeline/runs.py).
 @dataclass
 class RunRecord:
     run_id: str = field(default_factory=lambda: str(uuid.uuid4()))
@@ -80,6 +95,12 @@ class RunRecord:
     std_f1: Optional[float] = None
     std_precision: Optional[float] = None
     std_recall: Optional[float] = None
+    num_shards: int = 1
+    shards: Dict[str, Dict[str, Any]] = field(default_factory=dict)
+    shards_finished: int = 0
+    images_total: int = 0
+    patches_total: int = 0
+    errors_total: int = 0
     
 # We will store each hyperparameter combination in a fold, including dataset information
 # for reproducibility, and whether this hyperparameter combination is the best in the
@@ -0,0 +1,233 @@
+"""
+Packed patch shards.
+
+Instead of one S3 object per patch, ShardWriter appends encoded patches from
+many images into a shard object of bounded size, plus a JSON index object next
+to it. Each PatchRecord then points at the shard (shard_uri) and its byte range
+(offset, length), and read_patch_bytes fetches a single patch with a ranged GET.
+
+Shards are buffered in memory and only uploaded when full or on close, so any
+work that must not happen before its patches are durable (DynamoDB records,
+archiving the raw image) is registered with ShardWriter.defer and runs right
+after the shards holding those patches have been uploaded, or is failed if one
+of them could not be. Uploads and deferred work run outside the writer's lock,
+in whichever thread filled or flushed the shard.
+"""
+from __future__ import annotations
+
+import json
+import os
+import threading
+from io import BytesIO
+from typing import Callable, Dict, Iterable, List, Optional
+
+import numpy as np
+
+from src.apps.data_pipeline.encoding import get_patch_encoder
+from src.apps.data_pipeline.storage import as_storage, read_uri
+
+# 0 disables sharding (one object per patch).
+PATCH_SHARD_MAX_MB = int(os.getenv("PATCH_SHARD_MAX_MB", "0"))
+
+
+class ShardWriter:
+    def __init__(
+        self,
+        storage,
+        bucket: str,
+        prefix: str,
+        max_shard_bytes: int,
+    ):
+        self.storage = as_storage(storage)
+        self.bucket = bucket
+        self.prefix = prefix.rstrip("/")
+        self.max_shard_bytes = max_shard_bytes
+        self.shards_written = 0
+        self.shards_failed = 0
+
+        self._lock = threading.Lock()
+        self._idle = threading.Condition(self._lock)
+        self._seq = 0
+        self._buf = BytesIO()
+        self._index: List[Dict] = []
+        # Shards taken off the buffer but not uploaded yet (uri -> seq), and
+        # the shards whose upload failed (uri -> error).
+        self._uploading: Dict[str, int] = {}
+        self._failed: Dict[str, Exception] = {}
+        # Each waiter holds the seqs of the shards it still waits for.
+        self._waiters: List[Dict] = []
+
+    def _shard_key(self, seq: int) -> str:
+        return f"{self.prefix}/{seq:05d}.shard"
+
+    @property
+    def current_shard_uri(self) -> str:
+        return self.storage.uri(self.bucket, self._shard_key(self._seq))
+
+    def add(self, patch_id: str, data: bytes, patch_format: str) -> Dict:
+        """
+        Append one encoded patch and return its location
+        (shard_uri, offset, length). Starts a new shard first if this patch
+        would push the current one past max_shard_bytes; the full one is then
+        uploaded by this call, after the patch has been added.
+        """
+        with self._lock:
+            full = None
+            if self._index and self._buf.tell() + len(data) > self.max_shard_bytes:
+                full = self._take_locked()
+
+            offset = self._buf.tell()
+            self._buf.write(data)
+            self._index.append({
+                "patch_id": patch_id,
+                "offset": offset,
+                "length": len(data),
+                "patch_format": patch_format,
+            })
+            loc = {"shard_uri": self.current_shard_uri, "offset": offset, "length": len(data)}
+        if full is not None:
+            self._upload(full)
+        return loc
+
+    def defer(
+        self,
+        fn: Callable[[], None],
+        on_failed: Callable[[Exception], None],
+        shard_uris: Optional[Iterable[str]] = None,
+    ) -> None:
+        """
+        Run fn once the shards in shard_uris (by default every shard holding
+        a patch added so far) have been uploaded. If one of them could not
+        be, or fn raises, on_failed gets the error instead.
+        """
+        with self._lock:
+            waiter = {"seqs": set(), "fn": fn, "on_failed": on_failed, "error": None}
+            if shard_uris is None:
+                waiter["seqs"].update(self._uploading.values())
+                if self._index:
+                    waiter["seqs"].add(self._seq)
+            else:
+                for uri in set(shard_uris):
+                    if uri in self._failed:
+                        waiter["error"] = waiter["error"] or self._failed[uri]
+                    elif uri in self._uploading:
+                        waiter["seqs"].add(self._uploading[uri])
+                    elif uri == self.current_shard_uri and self._index:
+                        waiter["seqs"].add(self._seq)
+            if waiter["seqs"]:
+                self._waiters.append(waiter)
+                return
+        self._run([waiter])
+
+    def flush(self) -> None:
+        with self._lock:
+            shard = self._take_locked()
+        if shard is not None:
+            self._upload(shard)
+
+    def close(self) -> None:
+        """Upload the last shard and wait for uploads other threads started."""
+        self.flush()
+        with self._idle:
+            while self._uploading:
+                self._idle.wait()
+
+    def _take_locked(self) -> Optional[Dict]:
+        """Take the current shard off the buffer for upload, or None if it is empty."""
+        if not self._index:
+            return None
+        key = self._shard_key(self._seq)
+        shard = {"seq": self._seq, "key": key, "body": self._buf.getvalue(), "index": self._index}
+        self._uploading[self.storage.uri(self.bucket, key)] = self._seq
+        self._seq += 1
+        self._buf = BytesIO()
+        self._index = []
+        return shard
+
+    def _upload(self, shard: Dict) -> None:
+        key = shard["key"]
+        error: Optional[Exception] = None
+        try:
+            self.storage.put(self.bucket, key, shard["body"], content_type="application/octet-stream")
+            self.storage.put(
+                self.bucket,
+                f"{key}.index.json",
+                json.dumps({"shard": key, "patches": shard["index"]}).encode("utf-8"),
+                content_type="application/json",
+            )
+        except Exception as exc:
+            # The images behind a failed shard stay unprocessed and are picked
+            # up next run; each one's deferred work is failed with this error.
+            error = exc
+            print(f"  ERROR uploading shard {key}: {exc}")
+
+        with self._idle:
+            del self._uploading[self.storage.uri(self.bucket, key)]
+            if error is None:
+                self.shards_written += 1
+            else:
+                self.shards_failed += 1
+                self._failed[self.storage.uri(self.bucket, key)] = error
+            due = []
+            for w in self._waiters:
+                if shard["seq"] in w["seqs"]:
+                    w["seqs"].discard(shard["seq"])
+                    w["error"] = w["error"] or error
+                    if not w["seqs"]:
+                        due.append(w)
+            self._waiters = [w for w in self._waiters if w["seqs"]]
+            self._idle.notify_all()
+        self._run(due)
+
+    @staticmethod
+    def _run(due: List[Dict]) -> None:
+        for w in due:
+            if w["error"] is not None:
+                w["on_failed"](w["error"])
+                continue
+            try:
+                w["fn"]()
+            except Exception as exc:
+                w["on_failed"](exc)
+
+
+def read_patch_bytes(s3_client, record: Dict) -> bytes:
+    """
+    Fetch the encoded bytes of one patch, with a ranged GET if it lives in a
+    shard and a plain GET otherwise.
+    """
+    if record.get("shard_uri"):
+        return read_uri(s3_client, record["shard_uri"], int(record["offset"]), int(record["length"]))
+    return read_uri(s3_client, record["patch_path"])
+
+
+def read_shard(s3_client, shard_uri: str) -> Dict[str, bytes]:
+    """
+    Fetch a whole shard and its index in two GETs, for readers that want every
+    patch in it. Returns encoded patch bytes keyed by patch_id.
+    """
+    index = json.loads(read_uri(s3_client, f"{shard_uri}.index.json"))
+    body = read_uri(s3_client, shard_uri)
+    return {e["patch_id"]: body[e["offset"]:e["offset"] + e["length"]] for e in index["patches"]}
+
+
+def load_patch(s3_client, record: Dict) -> np.ndarray:
+    """
+    Fetch and decode one patch to a (H, W, 3) uint8 array.
+    """
+    encoder = get_patch_encoder(record.get("patch_format") or "jpeg")
+    return encoder.decode(read_patch_bytes(s3_client, record))
+
+
+def make_shard_writer(
+    storage,
+    bucket: str,
+    prefix: str,
+    max_shard_mb: int = PATCH_SHARD_MAX_MB,
+) -> Optional[ShardWriter]:
+    """
+    A ShardWriter sized by max_shard_mb, or None when sharding is disabled.
+    """
+    if max_shard_mb <= 0:
+        return None
+    return ShardWriter(storage, bucket, prefix, max_shard_bytes=max_shard_mb * 1024 * 1024)
@@ -0,0 +1,238 @@
+"""
+Object storage backends for the processing pipeline.
+
+The driver reads raw images, writes patches, shards and manifests and archives
+originals through a Storage, addressed like S3 by (bucket, key):
+
+    S3Storage     the boto3 S3 client, as in production
+    LocalStorage  a directory tree, {root}/{bucket}/{key}
+
+LocalStorage lets the same driver process a local directory at disk speed (bulk
+backfills) and profile the pipeline without network I/O for the objects; the
+metadata still goes to DynamoDB. Whole-object reads return a read-only mmap of
+the file, which hashes and decodes without a copy into Python bytes. Writes go
+to a temporary file next to the target and are renamed over it, so readers
+never see a partial object, and archiving is a single rename.
+
+Select the backend with --storage (env DRIVER_STORAGE): "s3" or "local:<root>".
+Functions that take an s3_client accept a Storage as well (see as_storage).
+"""
+from __future__ import annotations
+
+import abc
+import mmap
+import os
+import shutil
+import uuid
+from typing import Dict, Iterable, Iterator, List, Optional
+
+from src.apps.data_pipeline.archive import copy_to, delete_keys
+from src.apps.data_pipeline.listing import iter_objects
+
+DRIVER_STORAGE = os.getenv("DRIVER_STORAGE", "s3")
+
+
+class Storage(abc.ABC):
+    """
+    The object operations the pipeline uses. renames is True when move() is
+    an atomic rename, so archiving needs no batched deletes.
+    """
+
+    renames = False
+
+    @abc.abstractmethod
+    def get(self, bucket: str, key: str, offset: Optional[int] = None, length: Optional[int] = None):
+        """The object's bytes (a bytes-like object), or length bytes from offset."""
+
+    @abc.abstractmethod
+    def put(self, bucket: str, key: str, data: bytes, content_type: Optional[str] = None) -> None:
+        ...
+
+    @abc.abstractmethod
+    def iter_objects(
+        self,
+        bucket: str,
+        prefix: str,
+        extensions: Optional[Iterable[str]] = None,
+        start_after: Optional[str] = None,
+        end_before: Optional[str] = None,
+        page_size: Optional[int] = None,
+    ) -> Iterator[Dict]:
+        """Objects under prefix as {"Key", "Size"} dicts in key order, as listing.iter_objects."""
+
+    @abc.abstractmethod
+    def copy(self, bucket: str, key: str, dest_key: str, size: Optional[int] = None) -> None:
+        ...
+
+    @abc.abstractmethod
+    def delete(self, bucket: str, keys: List[str]) -> Dict[str, str]:
+        """Delete keys; missing keys are not an error. Returns the keys that failed, with why."""
+
+    def move(self, bucket: str, key: str, dest_key: str, size: Optional[int] = None) -> None:
+        self.copy(bucket, key, dest_key, size=size)
+        failed = self.delete(bucket, [key])
+        if failed:
+            raise RuntimeError(f"Could not delete {key} after copying it: {failed[key]}")
+
+    @abc.abstractmethod
+    def uri(self, bucket: str, key: str) -> str:
+        ...
+
+
+class S3Storage(Storage):
+    def __init__(self, s3_client):
+        self.s3_client = s3_client
+
+    def get(self, bucket: str, key: str, offset: Optional[int] = None, length: Optional[int] = None) -> bytes:
+        params = {"Bucket": bucket, "Key": key}
+        if offset is not None:
+            params["Range"] = f"bytes={offset}-{offset + length - 1}"
+        return self.s3_client.get_object(**params)["Body"].read()
+
+    def put(self, bucket: str, key: str, data: bytes, content_type: Optional[str] = None) -> None:
+        params = {"Bucket": bucket, "Key": key, "Body": data}
+        if content_type:
+            params["ContentType"] = content_type
+        self.s3_client.put_object(**params)
+
+    def iter_objects(self, bucket, prefix, extensions=None, start_after=None, end_before=None, page_size=None):
+        return iter_objects(self.s3_client, bucket, prefix, extensions,
+                            start_after=start_after, end_before=end_before, page_size=page_size)
+
+    def copy(self, bucket: str, key: str, dest_key: str, size: Optional[int] = None) -> None:
+        copy_to(self.s3_client, bucket, key, dest_key, size=size)
+
+    def delete(self, bucket: str, keys: List[str]) -> Dict[str, str]:
+        return delete_keys(self.s3_client, bucket, keys)
+
+    def move(self, bucket: str, key: str, dest_key: str, size: Optional[int] = None) -> None:
+        copy_to(self.s3_client, bucket, key, dest_key, size=size)
+        self.s3_client.delete_object(Bucket=bucket, Key=key)
+
+    def uri(self, bucket: str, key: str) -> str:
+        return f"s3://{bucket}/{key}"
+
+
+def _is_temp(name: str) -> bool:
+    return name.startswith(".") and name.endswith(".tmp")
+
+
+def _read_file(path: str, offset: Optional[int] = None, length: Optional[int] = None):
+    """A read-only mmap of the whole file (b"" if empty), or bytes of one range."""
+    with open(path, "rb") as f:
+        if offset is not None:
+            f.seek(offset)
+            return f.read(length)
+        if os.fstat(f.fileno()).st_size == 0:
+            return b""
+        # The mapping stays valid after the file is closed (or renamed).
+        return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+
+class LocalStorage(Storage):
+    renames = True
+
+    def __init__(self, root: str):
+        self.root = os.path.abspath(root)
+
+    def path(self, bucket: str, key: str) -> str:
+        parts = key.split("/")
+        if not bucket or any(p in ("", ".", "..") for p in parts):
+            raise ValueError(f"Invalid key for local storage: {bucket}/{key}")
+        return os.path.join(self.root, bucket, *parts)
+
+    def get(self, bucket: str, key: str, offset: Optional[int] = None, length: Optional[int] = None):
+        return _read_file(self.path(bucket, key), offset, length)
+
+    def put(self, bucket: str, key: str, data: bytes, content_type: Optional[str] = None) -> None:
+        path = self.path(bucket, key)
+        tmp = self._temp_path(path)
+        with open(tmp, "wb") as f:
+            f.write(data)
+        os.replace(tmp, path)
+
+    def iter_objects(self, bucket, prefix, extensions=None, start_after=None, end_before=None, page_size=None):
+        base = os.path.join(self.root, bucket)
+        # Walk from the deepest directory the prefix names in full.
+        top = prefix.rsplit("/", 1)[0] + "/" if "/" in prefix else ""
+        for key, size in self._walk(os.path.join(base, *top.split("/")), top):
+            if not key.startswith(prefix) or (start_after is not None and key <= start_after):
+                continue
+            if end_before is not None and key >= end_before:
+                return
+            if extensions is None or os.path.splitext(key)[1].lower() in extensions:
+                yield {"Key": key, "Size": size}
+
+    def _walk(self, directory: str, key_prefix: str) -> Iterator[tuple]:
+        """(key, size) of every file under directory, in S3 key order."""
+        try:
+            entries = list(os.scandir(directory))
+        except (FileNotFoundError, NotADirectoryError):
+            return
+        # A directory's keys continue with "/", which decides where they sort.
+        entries.sort(key=lambda e: e.name + "/" if e.is_dir() else e.name)
+        for entry in entries:
+            if entry.is_dir():
+                yield from self._walk(entry.path, f"{key_prefix}{entry.name}/")
+            elif not _is_temp(entry.name):
+                yield f"{key_prefix}{entry.name}", entry.stat().st_size
+
+    def copy(self, bucket: str, key: str, dest_key: str, size: Optional[int] = None) -> None:
+        dest = self.path(bucket, dest_key)
+        tmp = self._temp_path(dest)
+        shutil.copyfile(self.path(bucket, key), tmp)
+        os.replace(tmp, dest)
+
+    def delete(self, bucket: str, keys: List[str]) -> Dict[str, str]:
+        failed: Dict[str, str] = {}
+        for key in keys:
+            try:
+                os.remove(self.path(bucket, key))
+            except FileNotFoundError:
+                pass
+            except (OSError, ValueError) as exc:
+                failed[key] = str(exc)
+        return failed
+
+    def move(self, bucket: str, key: str, dest_key: str, size: Optional[int] = None) -> None:
+        dest = self.path(bucket, dest_key)
+        os.makedirs(os.path.dirname(dest), exist_ok=True)
+        os.replace(self.path(bucket, key), dest)
+
+    def uri(self, bucket: str, key: str) -> str:
+        return "file://" + os.path.join(self.root, bucket, key)
+
+    @staticmethod
+    def _temp_path(path: str) -> str:
+        directory, name = os.path.split(path)
+        os.makedirs(directory, exist_ok=True)
+        return os.path.join(directory, f".{name}.{uuid.uuid4().hex}.tmp")
+
+
+def as_storage(storage_or_client) -> Storage:
+    """A Storage as is; anything else is taken to be a boto3 S3 client."""
+    if isinstance(storage_or_client, Storage):
+        return storage_or_client
+    return S3Storage(storage_or_client)
+
+
+def make_storage(spec: str, s3_client) -> Storage:
+    """Storage for a --storage value: "s3" or "local:<root directory>"."""
+    if spec == "s3":
+        return S3Storage(s3_client)
+    if spec.startswith("local:") and spec[len("local:"):]:
+        return LocalStorage(spec[len("local:"):])
+    raise ValueError(f"Unknown storage {spec!r}; expected 's3' or 'local:<root>'")
+
+
+def read_uri(s3_client, uri: str, offset: Optional[int] = None, length: Optional[int] = None) -> bytes:
+    """
+    Bytes of an s3:// or file:// URI as written by a Storage, or length bytes
+    from offset.
+    """
+    if uri.startswith("file://"):
+        with open(uri[len("file://"):], "rb") as f:
+            f.seek(offset or 0)
+            return f.read() if offset is None else f.read(length)
+    bucket, _, key = uri[len("s3://"):].partition("/")
+    return S3Storage(s3_client).get(bucket, key, offset, length)
@@ -0,0 +1,68 @@
+import boto3
+import pytest
+
+from src.apps.data_pipeline.dedup import DynamoContentIndex, LocalContentIndex
+
+moto = pytest.importorskip("moto")
+
+DIGEST = "ab" * 32
+
+
+@pytest.fixture(params=["local", "dynamo"])
+def index(request, tmp_path, monkeypatch):
+    if request.param == "local":
+        yield LocalContentIndex(str(tmp_path / "index.json"))
+        return
+    for name, value in {"AWS_ACCESS_KEY_ID": "test", "AWS_SECRET_ACCESS_KEY": "test",
+                        "AWS_DEFAULT_REGION": "us-east-1"}.items():
+        monkeypatch.setenv(name, value)
+    with moto.mock_aws():
+        ddb = boto3.resource("dynamodb", region_name="us-east-1")
+        table = ddb.create_table(
+            TableName="content-index",
+            KeySchema=[{"AttributeName": "content_hash", "KeyType": "HASH"}],
+            AttributeDefinitions=[{"AttributeName": "content_hash", "AttributeType": "S"}],
+            BillingMode="PAY_PER_REQUEST",
+        )
+        yield DynamoContentIndex(table)
+
+
+def test_inference_does_not_count_as_ingested(index):
+    index.record_inference(DIGEST, "inference-image", "inf-1", 0.25, "why", "v1")
+
+    assert index.get_image(DIGEST) is None
+    index.record_image(DIGEST, "training-image")
+    assert index.get_image(DIGEST)["image_id"] == "training-image"
+    assert index.get_inference(DIGEST)["image_id"] == "inference-image"
+
+
+def test_first_ingested_image_wins(index):
+    index.record_image(DIGEST, "first")
+    index.record_image(DIGEST, "second")
+
+    assert index.get_image(DIGEST)["image_id"] == "first"
+    assert index.get_inference(DIGEST) is None
+
+
+def test_inference_entry_tracks_last_inference(index):
+    index.record_inference(DIGEST, "image-1", "inf-1", 0.25, "why", "v1")
+    index.record_inference(DIGEST, "image-2", "inf-2", 0.75, None, "v2")
+
+    hit = index.get_inference(DIGEST)
+    assert (hit["image_id"], hit["inference_id"], hit["score"], hit["model_version"]) == ("image-2", "inf-2", 0.75, "v2")
+
+
+def test_entries_from_before_the_namespaces():
+    index = LocalContentIndex()
+    ingested, inferred = "01" * 32, "02" * 32
+    index._items = {
+        ingested: {"content_hash": ingested, "image_id": "training-image"},
+        inferred: {"content_hash": inferred, "image_id": "inference-image", "inference_id": "inf-1"},
+    }
+
+    assert index.get_image(ingested)["image_id"] == "training-image"
+    assert index.get_image(inferred) is None
+    index.record_image(ingested, "other")
+    index.record_image(inferred, "training-image")
+    assert index.get_image(ingested)["image_id"] == "training-image"
+    assert index.get_image(inferred)["image_id"] == "training-image"
@@ -0,0 +1,48 @@
+import numpy as np
+import pytest
+from PIL import Image
+
+from benchmarks.bench_decode import photo_like
+from benchmarks.bench_patch_extraction import check_parity, synthetic_image
+from src.apps.data_pipeline.process import PATCH_SIZE, extract_patches
+
+# Landscape and portrait, p = 1 and p = 2, grids that do and do not divide the
+# square evenly, and cells that are upscaled, kept and reduced.
+SIZES = [(300, 300), (640, 480), (513, 700), (1000, 1001), (1025, 1030), (1600, 1200), (1030, 2100), (3000, 2000)]
+
+
+@pytest.mark.parametrize("make_image", [synthetic_image, photo_like])
+@pytest.mark.parametrize("size", SIZES)
+def test_matches_per_patch_crop_and_resize(make_image, size):
+    check_parity(make_image(*size, seed=size[0]))
+
+
+def test_patch_boxes():
+    batch, meta = extract_patches(synthetic_image(3000, 2000))
+
+    assert batch.shape == (17, PATCH_SIZE, PATCH_SIZE, 3)
+    assert meta[0] == {"patch_type": "center_square", "x": 500, "y": 0, "width": 2000, "height": 2000}
+    assert [(m["x"], m["y"]) for m in meta[1:5]] == [(500, 0), (1000, 0), (1500, 0), (2000, 0)]
+    assert {(m["patch_type"], m["width"], m["height"]) for m in meta[1:]} == {("grid", 500, 500)}
+    assert meta[-1]["x"] + meta[-1]["width"] == 2500 and meta[-1]["y"] + meta[-1]["height"] == 2000
+
+
+def test_reduced_decode_keeps_full_resolution_boxes():
+    img = photo_like(2400, 1600)
+    full, full_meta = extract_patches(img)
+    reduced, reduced_meta = extract_patches(img.reduce(2), source_size=img.size)
+
+    assert reduced_meta == full_meta
+    assert reduced.shape == full.shape
+
+
+def test_converts_to_rgb():
+    img = synthetic_image(640, 480)
+    batch, _ = extract_patches(img.convert("RGBA"))
+
+    assert np.array_equal(batch, extract_patches(img)[0])
+
+
+def test_too_small():
+    with pytest.raises(ValueError):
+        extract_patches(Image.new("RGB", (1, 1)))
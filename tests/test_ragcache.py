@@ -0,0 +1,181 @@
+import asyncio
+
+import boto3
+import pytest
+
+from benchmarks.aws import BENCH_ENV
+from benchmarks.bench_rag_cache import StubBedrock, StubClients, ask
+from src.apps.backend import ragcache
+from src.apps.backend.offload import run_io
+from src.apps.backend.ragcache import DynamoRagStore, RagResponseCache, normalize_query, rag_cache_key
+
+KB, MODEL = "kb-1", "arn:aws:bedrock:us-east-1::foundation-model/stub"
+
+
+class Clock:
+    def __init__(self, now: float = 1000.0):
+        self.now = now
+
+    def __call__(self) -> float:
+        return self.now
+
+
+def computer(bedrock: StubBedrock, query: str = "q"):
+    """compute() for get_or_compute: one retrieve_and_generate call on the I/O threads."""
+    async def compute():
+        resp = await run_io(bedrock.retrieve_and_generate, {"text": query}, {})
+        return {"answer": resp["output"]["text"], "sources": []}
+
+    return compute
+
+
+def test_equivalent_phrasings_share_a_key():
+    variants = ["Who influenced Frida Kahlo?", "  who influenced   frida kahlo ", "WHO INFLUENCED FRIDA KAHLO??",
+                "Who influenced Frída Kahlo"]
+
+    assert {normalize_query(q) for q in variants} == {"who influenced frida kahlo"}
+    assert len({rag_cache_key(q, KB, MODEL) for q in variants}) == 1
+    assert rag_cache_key(variants[0], KB, MODEL) != rag_cache_key("Who influenced Hokusai?", KB, MODEL)
+    assert rag_cache_key(variants[0], KB, MODEL) != rag_cache_key(variants[0], "kb-2", MODEL)
+    assert rag_cache_key(variants[0], KB, MODEL) != rag_cache_key(variants[0], KB, "other-model")
+
+
+def test_hits_and_misses():
+    bedrock = StubBedrock(0.0)
+    cache = RagResponseCache(ttl_s=60, max_entries=8)
+
+    async def run():
+        first = await cache.get_or_compute("k", computer(bedrock))
+        second = await cache.get_or_compute("k", computer(bedrock))
+        return first, second
+
+    first, second = asyncio.run(run())
+    assert first == second == {"answer": "Answer to: q", "sources": []}
+    assert bedrock.calls == 1
+    assert cache.to_dict() == {"entries": 1, "hits": 1, "shared_hits": 0, "misses": 1, "collapsed": 0,
+                               "evictions": 0, "store_errors": 0}
+
+
+def test_concurrent_identical_queries_make_one_call():
+    bedrock = StubBedrock(0.05)
+    cache = RagResponseCache(ttl_s=60, max_entries=8)
+
+    async def run():
+        return await asyncio.gather(*(cache.get_or_compute("k", computer(bedrock)) for _ in range(10)))
+
+    results = asyncio.run(run())
+    assert bedrock.calls == 1
+    assert all(r == results[0] for r in results)
+    assert (cache.misses, cache.collapsed) == (1, 9)
+
+
+def test_expired_entries_are_fetched_again():
+    bedrock, clock = StubBedrock(0.0), Clock()
+    cache = RagResponseCache(ttl_s=60, max_entries=8, clock=clock)
+
+    async def run():
+        await cache.get_or_compute("k", computer(bedrock))
+        clock.now += 59
+        await cache.get_or_compute("k", computer(bedrock))
+        assert bedrock.calls == 1
+        clock.now += 2
+        await cache.get_or_compute("k", computer(bedrock))
+
+    asyncio.run(run())
+    assert bedrock.calls == 2
+    assert (cache.hits, cache.misses) == (1, 2)
+
+
+def test_least_recently_used_entry_is_evicted():
+    bedrock = StubBedrock(0.0)
+    cache = RagResponseCache(ttl_s=60, max_entries=2)
+
+    async def run():
+        for key in ("a", "b", "a", "c"):
+            await cache.get_or_compute(key, computer(bedrock))
+        assert bedrock.calls == 3
+        await cache.get_or_compute("a", computer(bedrock))
+        assert bedrock.calls == 3
+        await cache.get_or_compute("b", computer(bedrock))
+
+    asyncio.run(run())
+    assert bedrock.calls == 4
+    assert cache.evictions == 2 and cache.to_dict()["entries"] == 2
+
+
+def test_errors_are_not_cached():
+    bedrock = StubBedrock(0.02)
+    cache = RagResponseCache(ttl_s=60, max_entries=8)
+    bedrock.fail = True
+
+    async def run():
+        results = await asyncio.gather(*(cache.get_or_compute("k", computer(bedrock)) for _ in range(3)),
+                                       return_exceptions=True)
+        assert all(isinstance(r, RuntimeError) for r in results), results
+        assert bedrock.calls == 1 and cache.collapsed == 2
+        bedrock.fail = False
+        return await cache.get_or_compute("k", computer(bedrock))
+
+    assert asyncio.run(run())["answer"] == "Answer to: q"
+    assert bedrock.calls == 2 and cache.to_dict()["entries"] == 1
+
+
+def test_shared_store_answers_other_workers(monkeypatch):
+    moto = pytest.importorskip("moto")
+    for name, value in BENCH_ENV.items():
+        monkeypatch.setenv(name, value)
+    bedrock, clock = StubBedrock(0.0), Clock()
+
+    with moto.mock_aws():
+        table = boto3.resource("dynamodb", region_name=BENCH_ENV["AWS_REGION"]).create_table(
+            TableName="rag-cache",
+            KeySchema=[{"AttributeName": "cache_key", "KeyType": "HASH"}],
+            AttributeDefinitions=[{"AttributeName": "cache_key", "AttributeType": "S"}],
+            BillingMode="PAY_PER_REQUEST",
+        )
+        store = DynamoRagStore(table)
+        worker_a = RagResponseCache(ttl_s=60, max_entries=8, store=store, clock=clock)
+        worker_b = RagResponseCache(ttl_s=60, max_entries=8, store=store, clock=clock)
+        worker_c = RagResponseCache(ttl_s=60, max_entries=8, store=store, clock=clock)
+
+        async def run():
+            answer = await worker_a.get_or_compute("k", computer(bedrock))
+            assert await worker_b.get_or_compute("k", computer(bedrock)) == answer
+            # The store still holds the item after its expiry; it is ignored.
+            clock.now += 61
+            await worker_c.get_or_compute("k", computer(bedrock))
+
+        asyncio.run(run())
+
+    assert bedrock.calls == 2
+    assert (worker_b.shared_hits, worker_b.misses) == (1, 0)
+    assert (worker_c.shared_hits, worker_c.misses) == (0, 1)
+
+
+def test_rag_query_endpoint_caches_normalized_questions(monkeypatch):
+    for name, value in BENCH_ENV.items():
+        monkeypatch.setenv(name, value)
+    monkeypatch.setenv("KNOWLEDGE_BASE_ID", KB)
+    monkeypatch.delenv("DDB_RAG_CACHE_TABLE", raising=False)
+    monkeypatch.setattr(ragcache, "RAG_CACHE", True)
+    from src.apps.backend import main as app_module
+
+    bedrock = StubBedrock(0.0)
+    monkeypatch.setattr(app_module.app.state, "aws", StubClients(bedrock), raising=False)
+    app_module.get_rag_cache.cache_clear()
+    try:
+        async def run():
+            return [await ask(app_module.app, q) for q in ("What techniques did Hokusai use?",
+                                                           "what techniques did hokusai use",
+                                                           "Who influenced Hokusai?")]
+
+        responses = asyncio.run(run())
+        assert [status for status, _, _ in responses] == [200, 200, 200]
+        assert responses[0][1] == responses[1][1]
+        assert responses[0][1]["sources"] == [{"s3_uri": "s3://artguard-kb/artists.md",
+                                               "snippet": "Stubbed reference."}]
+        assert bedrock.calls == 2
+        stats = app_module.get_rag_cache().to_dict()
+        assert (stats["hits"], stats["misses"]) == (1, 2)
+    finally:
+        app_module.get_rag_cache.cache_clear()